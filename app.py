@@ -1,39 +1,580 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Request, Response, request, jsonify, render_template, stream_with_context
 import os
 import tempfile 
 import pathlib 
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 import json
 import uuid
-from datetime import datetime
+from datetime import datetime, timezone
 import requests
 import time
 from bs4 import BeautifulSoup
-from urllib.parse import urlparse, parse_qs
+from urllib.parse import urlparse, parse_qs, parse_qsl, urlencode, urlunparse, quote_plus, unquote_plus
 import urllib3
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 import re
 import tempfile
+import threading
+import sqlite3
+import zlib
+import hashlib
+import io
+import shutil
+import math
+import random
+import heapq
+import itertools
+import functools
+import contextvars
+from contextlib import contextmanager, nullcontext
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from types import SimpleNamespace
 from werkzeug.utils import secure_filename
+from werkzeug.datastructures import FileStorage
 import pathlib 
 from youtube_transcript_api import YouTubeTranscriptApi, TranscriptsDisabled, NoTranscriptFound, CouldNotRetrieveTranscript, FetchedTranscript
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
 
 # --- Basic App Configuration ---
+UPLOAD_SPOOL_MAX_MEMORY_BYTES = int(os.environ.get("UPLOAD_SPOOL_MAX_MEMORY_BYTES", str(1024 * 1024))) # Larger uploads spool to one temp file
+
+class StudyAssistantRequest(Request):
+    """Request that spools each uploaded file into a single SpooledTemporaryFile with a bounded in-memory size."""
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_MEMORY_BYTES, mode="rb+")
+
 def init_app():
     app = Flask(__name__, static_folder='static', template_folder='templates')
+    app.request_class = StudyAssistantRequest
     app.secret_key = os.urandom(24)
     # Removed DB config, upload folder (using Gemini directly)
     return app
 
 app = init_app()
 
-DEFAULT_GEMINI_MODEL = "gemini-2.5-flash-preview-05-20"
+DEFAULT_GEMINI_MODEL = os.environ.get("GEMINI_MODEL", "gemini-2.5-flash-preview-05-20")
 # gemini-2.5-flash-preview-05-20
+CHAT_MAX_HISTORY_TURNS = 10 # Chat turns (user + model pairs) sent to and returned from the model
+
+# --- Stage Tracing & Metrics (per-stage spans, Prometheus /metrics, optional OpenTelemetry) ---
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() == "true"
+OTEL_TRACING_ENABLED = os.environ.get("OTEL_TRACING_ENABLED", "false").lower() == "true" # Needs opentelemetry-api plus an SDK/exporter
+STAGE_LATENCY_BUCKETS_SECONDS = tuple(float(b) for b in os.environ.get(
+    "STAGE_LATENCY_BUCKETS_SECONDS", "0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30,60").split(","))
+STAGE_SIZE_UNITS = ("bytes", "chars", "tokens") # Span attributes summed into study_assistant_stage_size_total
+
+if OTEL_TRACING_ENABLED and otel_trace is None:
+    print("Warning: OTEL_TRACING_ENABLED is set but opentelemetry is not installed; only /metrics is recorded.")
+otel_tracer = otel_trace.get_tracer("study-assistant") if OTEL_TRACING_ENABLED and otel_trace else None
+
+class StageSpan:
+    """One timed stage of a request. Attributes (bytes, chars, tokens, cache_hit, ...) can be added while it runs."""
+    def __init__(self, stage, attributes):
+        self.stage = stage
+        self.attributes = dict(attributes)
+        self.duration = 0.0
+        self.outcome = "ok"
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+        return self
+
+class _NoopStageSpan:
+    def set(self, **attributes):
+        return self
+
+_current_stage_span = contextvars.ContextVar("current_stage_span", default=None)
+_request_stage_spans = contextvars.ContextVar("request_stage_spans", default=None)
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names, values):
+    return "{" + ",".join(f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)) + "}"
+
+class StageMetrics:
+    """Process-wide stage histograms and counters, rendered in the Prometheus text exposition format."""
+    def __init__(self, buckets):
+        self._lock = threading.Lock()
+        self._buckets = tuple(sorted(buckets))
+        self._durations = {} # (stage, outcome) -> [cumulative bucket counts..., sum, count]
+        self._sizes = Counter() # (stage, unit) -> total
+        self._cache = Counter() # (stage, "hit"/"miss") -> lookups
+
+    def record(self, span):
+        with self._lock:
+            series = self._durations.setdefault((span.stage, span.outcome), [0] * len(self._buckets) + [0.0, 0])
+            for i, upper in enumerate(self._buckets):
+                if span.duration <= upper:
+                    series[i] += 1
+            series[-2] += span.duration
+            series[-1] += 1
+            for unit in STAGE_SIZE_UNITS:
+                value = span.attributes.get(unit)
+                if isinstance(value, (int, float)) and not isinstance(value, bool) and value > 0:
+                    self._sizes[(span.stage, unit)] += value
+            if "cache_hit" in span.attributes:
+                self._cache[(span.stage, "hit" if span.attributes["cache_hit"] else "miss")] += 1
+
+    def render(self):
+        with self._lock:
+            durations = {key: list(series) for key, series in self._durations.items()}
+            sizes, cache = dict(self._sizes), dict(self._cache)
+        lines = [
+            "# HELP study_assistant_stage_duration_seconds Time spent in each request stage.",
+            "# TYPE study_assistant_stage_duration_seconds histogram",
+        ]
+        for key in sorted(durations):
+            series = durations[key]
+            bounds = [f"{upper:g}" for upper in self._buckets] + ["+Inf"]
+            for bound, count in zip(bounds, series[:-2] + [series[-1]]):
+                lines.append(f"study_assistant_stage_duration_seconds_bucket{_format_labels(('stage', 'outcome', 'le'), (*key, bound))} {count}")
+            labels = _format_labels(('stage', 'outcome'), key)
+            lines.append(f"study_assistant_stage_duration_seconds_sum{labels} {series[-2]:.6f}")
+            lines.append(f"study_assistant_stage_duration_seconds_count{labels} {series[-1]}")
+        lines += [
+            "# HELP study_assistant_stage_size_total Bytes, characters and tokens handled per stage.",
+            "# TYPE study_assistant_stage_size_total counter",
+        ]
+        lines += [f"study_assistant_stage_size_total{_format_labels(('stage', 'unit'), key)} {sizes[key]:g}" for key in sorted(sizes)]
+        lines += [
+            "# HELP study_assistant_stage_cache_lookups_total Cache lookups per stage by result.",
+            "# TYPE study_assistant_stage_cache_lookups_total counter",
+        ]
+        lines += [f"study_assistant_stage_cache_lookups_total{_format_labels(('stage', 'result'), key)} {cache[key]}" for key in sorted(cache)]
+        return "\n".join(lines) + "\n"
+
+stage_metrics = StageMetrics(STAGE_LATENCY_BUCKETS_SECONDS)
+
+def _otel_attributes(attributes):
+    return {f"study_assistant.{k}": v for k, v in attributes.items() if isinstance(v, (str, bool, int, float))}
+
+def _finish_span(span):
+    if METRICS_ENABLED:
+        stage_metrics.record(span)
+    request_spans = _request_stage_spans.get()
+    if request_spans is not None:
+        request_spans.append(span)
+
+@contextmanager
+def stage_span(stage, **attributes):
+    """
+    Time one stage of the current request. Yields a StageSpan; set an "error" attribute
+    (or raise) to record the stage as failed. Nested stages become child spans in OpenTelemetry.
+    """
+    span = StageSpan(stage, attributes)
+    otel_context = otel_tracer.start_as_current_span(f"study_assistant.{stage}") if otel_tracer else nullcontext()
+    token = _current_stage_span.set(span)
+    started = time.perf_counter()
+    with otel_context as otel_span:
+        try:
+            yield span
+        except BaseException:
+            span.outcome = "error"
+            raise
+        finally:
+            span.duration = time.perf_counter() - started
+            _current_stage_span.reset(token)
+            if span.attributes.get("error"):
+                span.outcome = "error"
+            if otel_span is not None:
+                otel_span.set_attributes(_otel_attributes(span.attributes))
+            _finish_span(span)
+
+def traced_stage(stage, **attributes):
+    """Decorator form of stage_span(); the function can add attributes through current_stage_span()."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage_span(stage, **attributes):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def record_stage(stage, duration, **attributes):
+    """Record a stage that was timed by hand (e.g. prompt assembly spread across a function)."""
+    span = StageSpan(stage, attributes)
+    span.duration = duration
+    if span.attributes.get("error"):
+        span.outcome = "error"
+    if otel_tracer:
+        end_ns = time.time_ns()
+        otel_span = otel_tracer.start_span(f"study_assistant.{stage}", start_time=end_ns - int(duration * 1e9),
+                                           attributes=_otel_attributes(span.attributes))
+        otel_span.end(end_time=end_ns)
+    _finish_span(span)
+
+def current_stage_span():
+    """The innermost open stage span, or a no-op stand-in outside any stage."""
+    return _current_stage_span.get() or _NoopStageSpan()
+
+def submit_in_context(executor, fn, *args):
+    """executor.submit() that runs fn in a copy of the caller's context, so worker spans join the request's trace."""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+@app.before_request
+def begin_request_trace():
+    _request_stage_spans.set([])
+
+def request_stage_summary():
+    """Per-stage span count and total seconds for the current request."""
+    summary = {}
+    for span in _request_stage_spans.get() or []:
+        entry = summary.setdefault(span.stage, {"count": 0, "seconds": 0.0})
+        entry["count"] += 1
+        entry["seconds"] = round(entry["seconds"] + span.duration, 3)
+    return summary
+
+# --- Offline Provider (local stand-in for Gemini and Custom Search, for load testing) ---
+API_PROVIDER = os.environ.get("API_PROVIDER", "gemini").lower() # "gemini" (Google APIs) or "offline"
+OFFLINE_LATENCY_MS = float(os.environ.get("OFFLINE_LATENCY_MS", "300")) # Mean simulated time to first token
+OFFLINE_LATENCY_JITTER_MS = float(os.environ.get("OFFLINE_LATENCY_JITTER_MS", "200"))
+OFFLINE_STREAM_CHUNK_CHARS = int(os.environ.get("OFFLINE_STREAM_CHUNK_CHARS", "80"))
+OFFLINE_STREAM_CHUNK_DELAY_MS = float(os.environ.get("OFFLINE_STREAM_CHUNK_DELAY_MS", "30"))
+OFFLINE_RATE_LIMIT_ERROR_RATE = float(os.environ.get("OFFLINE_RATE_LIMIT_ERROR_RATE", "0")) # Fraction of calls answered with a 429
+OFFLINE_FILE_PROCESSING_SECONDS = float(os.environ.get("OFFLINE_FILE_PROCESSING_SECONDS", "2")) # Uploads stay PROCESSING this long
+OFFLINE_NOTES_SECTIONS = int(os.environ.get("OFFLINE_NOTES_SECTIONS", "6")) # Controls canned notes length (~150 words each)
+OFFLINE_SEARCH_ENGINE_ID = "offline"
+OFFLINE_SEED = os.environ.get("OFFLINE_SEED") # Set for reproducible latency and 429 sequences
+OFFLINE_FIXTURES_DIR = os.environ.get("OFFLINE_FIXTURES_DIR") # Optional recorded pages/*.html and transcripts/*.json to serve
+LOCAL_DB_PREFIX = "offline_" if API_PROVIDER == "offline" else "" # Keeps canned pages and sessions out of the real local caches
+
+# Prompt markers identifying each generator's request; anything else is treated as chat
+_OFFLINE_TASK_MARKERS = (
+    ("Context for Quiz Generation", "quiz"),
+    ("Context for Flashcard Generation", "flashcards"),
+    ("Context for Mind Map Generation", "mindmap"),
+    ("distinct and relevant search queries", "search_queries"),
+    ("Evaluate the user's answer", "evaluate"),
+    ("creating comprehensive study notes", "notes"),
+)
+
+def _offline_prompt_text(contents):
+    """Flatten generate_content contents (strings, parts lists, role dicts) into prompt text; files are skipped."""
+    if isinstance(contents, str):
+        return contents
+    if isinstance(contents, dict):
+        return _offline_prompt_text(contents.get("parts", []))
+    if isinstance(contents, (list, tuple)):
+        return "\n".join(_offline_prompt_text(part) for part in contents)
+    return ""
+
+def _offline_fixture_for(kind, key, suffix):
+    """
+    Recorded fixture text from OFFLINE_FIXTURES_DIR/<kind>/: <key><suffix> if it exists,
+    otherwise one picked deterministically by hashing key. None without fixtures.
+    """
+    if not OFFLINE_FIXTURES_DIR:
+        return None
+    fixture_dir = pathlib.Path(OFFLINE_FIXTURES_DIR) / kind
+    exact = fixture_dir / f"{key}{suffix}"
+    if exact.is_file():
+        return exact.read_text(encoding='utf-8')
+    candidates = sorted(fixture_dir.glob(f"*{suffix}")) if fixture_dir.is_dir() else []
+    if not candidates:
+        return None
+    index = int(hashlib.sha1(key.encode('utf-8')).hexdigest(), 16) % len(candidates)
+    return candidates[index].read_text(encoding='utf-8')
+
+def _offline_key_terms(text, count=8):
+    """Most frequent longer words of the prompt, so canned output still varies with the input."""
+    words = [word for word in re.findall(r"[A-Za-z]{5,}", text) if word.lower() not in SEARCH_STOPWORDS]
+    terms = [word for word, _ in Counter(word.lower() for word in words).most_common(count)]
+    return terms + [f"concept{index}" for index in range(count - len(terms))]
+
+def _offline_count(pattern, text, default):
+    match = re.search(pattern, text)
+    return int(match.group(1)) if match else default
+
+def _offline_quiz_question(index, question_type, term, difficulty):
+    question = {"type": question_type, "question": f"Which statement about {term} is supported by the material? ({index + 1})",
+                "explanation": f"The material describes {term} this way.", "difficulty": difficulty}
+    if question_type == "MCQ":
+        question["options"] = [f"{term} is defined in the notes", f"{term} is unrelated", f"{term} is never mentioned", f"{term} contradicts the notes"]
+        question["correct_answer"] = question["options"][0]
+    elif question_type == "True/False":
+        question.update(question=f"True or false: the notes discuss {term}.", options=["True", "False"], correct_answer="True")
+    elif question_type == "Fill_in_the_Blank":
+        question.update(question=f"The notes explain ____ in section {index + 1}.", options=[], correct_answer=term)
+    elif question_type == "Matching":
+        question.update(question=f"Match each item about {term} with its description.",
+                        options={"column_a": [f"{term} {i}" for i in range(5)], "column_b": [f"description {i}" for i in (2, 0, 4, 1, 3)]},
+                        correct_answer=["0-1", "1-3", "2-0", "3-4", "4-2"])
+    else: # Short_Answer
+        question.update(question=f"Briefly explain {term}.", options=[], correct_answer=f"{term} as described in the notes.")
+    return question
+
+def offline_generate_text(task, prompt):
+    """Canned output for a task that passes the same parsing and schema checks as a real response."""
+    terms = _offline_key_terms(prompt)
+    if task == "quiz":
+        num_questions = _offline_count(r"exactly (\d+) questions", prompt, 5)
+        type_match = re.search(r"following type: ([\w/]+)", prompt) or re.search(r"following types: ([\w/, ]+)\.", prompt)
+        question_types = [t.strip() for t in type_match.group(1).split(",")] if type_match else ["MCQ"]
+        difficulty_match = re.search(r"Target the '(\w+)' level", prompt)
+        difficulty = difficulty_match.group(1) if difficulty_match else "Apply"
+        return json.dumps([_offline_quiz_question(i, question_types[i % len(question_types)], terms[i % len(terms)], difficulty)
+                           for i in range(num_questions)])
+    if task == "flashcards":
+        num_flashcards = _offline_count(r"exactly (\d+) flashcards", prompt, 10)
+        return json.dumps([{"question": f"What is {terms[i % len(terms)]}? ({i + 1})",
+                            "answer": f"$\\alpha_{i}$: {terms[i % len(terms)]} as summarized in the notes."} for i in range(num_flashcards)])
+    if task == "search_queries":
+        num_queries = _offline_count(r"generate (\d+) distinct", prompt, 3)
+        return json.dumps([f"{terms[i % len(terms)]} explained" for i in range(num_queries)])
+    if task == "mindmap":
+        lines = ["flowchart LR", f'    A["{terms[0].title()}"]']
+        for index, term in enumerate(terms[1:6], start=1):
+            lines.append(f"    A --> B{index}({term.title()})")
+            lines.append(f'    B{index} --> C{index}["{term} detail"]')
+        return "\n".join(lines)
+    if task == "evaluate":
+        return json.dumps({"score": 7, "feedback": "Covers the main points; mention the key terms from the notes more precisely."})
+    if task == "notes":
+        sections = [f"# Study Notes: {terms[0].title()}\n"]
+        for index in range(OFFLINE_NOTES_SECTIONS):
+            term = terms[index % len(terms)]
+            sections.append(f"## {index + 1}. {term.title()}\n\n" + " ".join(
+                [f"{term.title()} relates to {terms[(index + 1) % len(terms)]} and {terms[(index + 2) % len(terms)]} in the source material."] * 6)
+                + f"\n\n- Key point about {term}\n- Example: $E = mc^2$ applied to {term}\n")
+        return "\n".join(sections)
+    return f"Based on your notes, {terms[0]} is closely related to {terms[1]} and {terms[2]}. " * 4
+
+class _OfflineResult:
+    """Response shaped like GenerateContentResponse: candidates[0].content.parts[0].text, finish_reason, usage_metadata."""
+    def __init__(self, text, prompt_tokens, finish_reason=1):
+        self.text = text
+        self.candidates = [SimpleNamespace(content=SimpleNamespace(parts=[SimpleNamespace(text=text)], role="model"),
+                                           finish_reason=finish_reason, safety_ratings=[])]
+        self.prompt_feedback = SimpleNamespace(block_reason=None)
+        output_tokens = estimate_tokens(text)
+        self.usage_metadata = SimpleNamespace(prompt_token_count=prompt_tokens, candidates_token_count=output_tokens,
+                                              total_token_count=prompt_tokens + output_tokens, cached_content_token_count=0)
+
+class _OfflineStream:
+    """Streaming response: yields chunk results, then exposes the aggregated candidates like the SDK does."""
+    def __init__(self, provider, text, prompt_tokens):
+        self._provider, self._text, self._prompt_tokens = provider, text, prompt_tokens
+        self.candidates = []
+
+    def __iter__(self):
+        for start in range(0, len(self._text), OFFLINE_STREAM_CHUNK_CHARS):
+            if start:
+                time.sleep(OFFLINE_STREAM_CHUNK_DELAY_MS / 1000)
+            yield _OfflineResult(self._text[start:start + OFFLINE_STREAM_CHUNK_CHARS], self._prompt_tokens, finish_reason=0)
+        final = _OfflineResult(self._text, self._prompt_tokens)
+        self.candidates, self.usage_metadata = final.candidates, final.usage_metadata
+
+class OfflineGenerativeModel:
+    """Stand-in for genai.GenerativeModel."""
+    def __init__(self, model_name, system_instruction=None, generation_config=None, provider=None, cached_content=None):
+        self.model_name = model_name
+        self._system_instruction = system_instruction
+        self._generation_config = generation_config
+        self._provider = provider
+        self.cached_content = cached_content
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        prompt = _offline_prompt_text(contents)
+        task = next((task for marker, task in _OFFLINE_TASK_MARKERS if marker in prompt), "chat")
+        self._provider.simulate_call(task)
+        text = offline_generate_text(task, prompt)
+        prompt_tokens = estimate_tokens(prompt) + estimate_tokens(self._system_instruction or "") + \
+            (self._provider.cached_tokens(self.cached_content) if self.cached_content else 0)
+        return _OfflineStream(self._provider, text, prompt_tokens) if stream else _OfflineResult(text, prompt_tokens)
+
+    def count_tokens(self, contents):
+        return SimpleNamespace(total_tokens=estimate_tokens(_offline_prompt_text(contents)))
+
+class OfflineCachedContent:
+    """Stand-in for genai.caching.CachedContent handles."""
+    def __init__(self, provider, model, display_name, tokens, ttl):
+        self._provider = provider
+        self.name = f"cachedContents/offline-{uuid.uuid4().hex[:12]}"
+        self.model, self.display_name, self.tokens = model, display_name, tokens
+        self.expire_time = time.time() + ttl
+
+    def update(self, ttl):
+        self.expire_time = time.time() + ttl
+
+    def delete(self):
+        self._provider.delete_cached_content(self.name)
+
+class OfflineGenAI:
+    """
+    Local provider with the subset of the google.generativeai surface this app uses
+    (GenerativeModel, caching.CachedContent, upload_file/get_file/delete_file).
+    Latency, streaming pace, 429s and file PROCESSING time follow the OFFLINE_* settings.
+    """
+    types = genai.types # GenerationConfig and friends are plain data classes
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._random = random.Random(OFFLINE_SEED)
+        self._files = {}
+        self._cached_contents = {}
+        self._stats = {"calls": Counter(), "simulated_429": 0, "files_uploaded": 0, "caches_created": 0}
+        provider = self
+
+        class GenerativeModel(OfflineGenerativeModel):
+            def __init__(self, model_name, system_instruction=None, generation_config=None, **kwargs):
+                super().__init__(model_name, system_instruction, generation_config, provider=provider)
+
+            @classmethod
+            def from_cached_content(cls, cached_content, generation_config=None, **kwargs):
+                model = cls(cached_content.model, generation_config=generation_config)
+                model.cached_content = cached_content.name
+                return model
+
+        class CachedContent:
+            @staticmethod
+            def create(model, display_name=None, system_instruction=None, contents=None, ttl=3600, **kwargs):
+                provider.simulate_call("context_cache")
+                cached_content = OfflineCachedContent(provider, model, display_name,
+                                                      estimate_tokens(_offline_prompt_text(contents) + (system_instruction or "")), ttl)
+                with provider._lock:
+                    provider._cached_contents[cached_content.name] = cached_content
+                    provider._stats["caches_created"] += 1
+                return cached_content
+
+        self.GenerativeModel = GenerativeModel
+        self.caching = SimpleNamespace(CachedContent=CachedContent)
+
+    def simulate_call(self, task):
+        """Sleep for a jittered latency and maybe raise a 429 shaped like google.api_core's ResourceExhausted."""
+        with self._lock:
+            self._stats["calls"][task] += 1
+            delay = max(0.0, self._random.gauss(OFFLINE_LATENCY_MS, OFFLINE_LATENCY_JITTER_MS / 2)) / 1000
+            rate_limited = self._random.random() < OFFLINE_RATE_LIMIT_ERROR_RATE
+            if rate_limited:
+                self._stats["simulated_429"] += 1
+        time.sleep(delay)
+        if rate_limited:
+            raise google_exceptions.ResourceExhausted("Resource has been exhausted (e.g. check quota). Please retry in 1s.")
+
+    def cached_tokens(self, name):
+        with self._lock:
+            cached_content = self._cached_contents.get(name)
+        if cached_content is None:
+            raise google_exceptions.NotFound(f"CachedContent not found: {name}")
+        return cached_content.tokens
+
+    def delete_cached_content(self, name):
+        with self._lock:
+            self._cached_contents.pop(name, None)
+
+    def upload_file(self, path, display_name=None, mime_type=None, **kwargs):
+        self.simulate_call("upload")
+        gemini_file = SimpleNamespace(name=f"files/offline-{uuid.uuid4().hex[:12]}", display_name=display_name, mime_type=mime_type,
+                                      uri=None, uploaded_at=time.monotonic(), state=SimpleNamespace(name="PROCESSING"))
+        gemini_file.uri = f"offline://{gemini_file.name}"
+        with self._lock:
+            self._files[gemini_file.name] = gemini_file
+            self._stats["files_uploaded"] += 1
+        return self.get_file(gemini_file.name)
+
+    def get_file(self, name, **kwargs):
+        with self._lock:
+            gemini_file = self._files.get(name)
+        if gemini_file is None:
+            raise google_exceptions.NotFound(f"File not found: {name}")
+        ready = time.monotonic() - gemini_file.uploaded_at >= OFFLINE_FILE_PROCESSING_SECONDS
+        return SimpleNamespace(**{**vars(gemini_file), "state": SimpleNamespace(name="ACTIVE" if ready else "PROCESSING")})
+
+    def delete_file(self, name, **kwargs):
+        with self._lock:
+            if self._files.pop(name, None) is None:
+                raise google_exceptions.NotFound(f"File not found: {name}")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["calls"] = dict(self._stats["calls"])
+            stats["files"] = len(self._files)
+            stats["cached_contents"] = len(self._cached_contents)
+        return stats
+
+class _OfflineHTTPResponse:
+    """The parts of requests.Response that search_web and fetch_page read."""
+    def __init__(self, url, body, content_type, status_code=200, headers=None):
+        self.url, self.status_code = url, status_code
+        self.content = body.encode('utf-8')
+        self.headers = requests.structures.CaseInsensitiveDict({"Content-Type": content_type, **(headers or {})})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} Error for url: {self.url}", response=self)
+
+    def json(self):
+        return json.loads(self.content)
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+class OfflineWebClient:
+    """Stand-in for the HTTP session used for Custom Search and page fetches: canned results and pages, no network."""
+    def __init__(self, provider):
+        self._provider = provider
+
+    def get(self, url, params=None, **kwargs):
+        if url.startswith("https://www.googleapis.com/customsearch/"):
+            try:
+                self._provider.simulate_call("custom_search")
+            except google_exceptions.ResourceExhausted as e:
+                return _OfflineHTTPResponse(url, json.dumps({"error": {"code": 429, "message": str(e)}}), "application/json",
+                                            status_code=429, headers={"Retry-After": "1"})
+            query = (params or {}).get("q", "")
+            items = [{"link": f"https://offline.invalid/{quote_plus(query)}/{index}", "title": f"{query} ({index + 1})",
+                      "snippet": f"Background reading on {query}."} for index in range(int((params or {}).get("num", 5)))]
+            return _OfflineHTTPResponse(url, json.dumps({"items": items}), "application/json")
+        time.sleep(OFFLINE_LATENCY_MS / 4000) # Page fetches are cheaper than model calls
+        parsed_url = urlparse(url)
+        html = _offline_fixture_for("pages", pathlib.PurePosixPath(parsed_url.path).name or parsed_url.netloc, ".html")
+        if html is None:
+            page_topic = unquote_plus(parsed_url.path.strip("/").split("/")[0] or "offline page")
+            paragraphs = "".join(f"<p>{page_topic} paragraph {index}: reference material used for offline load testing.</p>" for index in range(20))
+            html = f"<html><head><title>{page_topic}</title></head><body><article>{paragraphs}</article></body></html>"
+        return _OfflineHTTPResponse(url, html, "text/html; charset=utf-8")
+
+class OfflineTranscriptApi:
+    """Stand-in for YouTubeTranscriptApi: one English transcript per video, from transcripts/<video_id>.json fixtures when present."""
+    def list_transcripts(self, video_id):
+        time.sleep(OFFLINE_LATENCY_MS / 4000)
+        fixture = _offline_fixture_for("transcripts", video_id, ".json")
+        segments = json.loads(fixture) if fixture else [
+            {"text": f"Lecture {video_id}, part {index}: the speaker walks through the next idea.", "start": index * 5.0, "duration": 5.0}
+            for index in range(60)]
+        transcript = SimpleNamespace(language="English", language_code="en", is_generated=False,
+                                     fetch=lambda: [SimpleNamespace(**segment) for segment in segments])
+        return SimpleNamespace(find_manually_created_transcript=lambda language_codes: transcript,
+                               find_generated_transcript=lambda language_codes: transcript)
 
 # --- API Configuration ---
 def configure_api():
-    """Configure Gemini API and ensure environment variables are set."""
+    """
+    Configure the Gemini API (or the offline provider when API_PROVIDER=offline).
+    Returns (genai_api, web_client, SEARCH_ENGINE_ID); web_client is None when HTTP goes to the real network.
+    """
+    if API_PROVIDER == "offline":
+        print("API_PROVIDER=offline: Gemini, Custom Search and page fetches are simulated locally; no quota is used.")
+        offline_genai = OfflineGenAI()
+        return offline_genai, OfflineWebClient(offline_genai), OFFLINE_SEARCH_ENGINE_ID
+    if API_PROVIDER != "gemini":
+        raise ValueError(f"Unknown API_PROVIDER '{API_PROVIDER}' (expected 'gemini' or 'offline').")
+
     GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
     SEARCH_ENGINE_ID = os.environ.get("SEARCH_ENGINE_ID")
 
@@ -43,12 +584,698 @@ def configure_api():
         raise ValueError("The SEARCH_ENGINE_ID environment variable is not set.")
 
     genai.configure(api_key=GOOGLE_API_KEY)
-    model = genai.GenerativeModel(DEFAULT_GEMINI_MODEL)
-    return model, genai, SEARCH_ENGINE_ID
+    return genai, None, SEARCH_ENGINE_ID
 
-model, genai_api, SEARCH_ENGINE_ID = configure_api()
+genai_api, web_client, SEARCH_ENGINE_ID = configure_api()
+transcript_api_class = OfflineTranscriptApi if API_PROVIDER == "offline" else YouTubeTranscriptApi
+
+# --- Gemini Model Registry ---
+GEMINI_MODEL_REGISTRY_MAX_ENTRIES = int(os.environ.get("GEMINI_MODEL_REGISTRY_MAX_ENTRIES", "64"))
+# Tasks that can be routed to their own model with GEMINI_MODEL_<TASK> (e.g. GEMINI_MODEL_SEARCH_QUERIES=gemini-2.0-flash-lite).
+# "context_cache" is the model session context caches are created for; only tasks routed to the same model use them.
+GEMINI_TASKS = ("notes", "search_queries", "quiz", "flashcards", "mindmap", "chat", "evaluate", "context_cache")
+
+def model_name_for(task):
+    """Model configured for a task, falling back to GEMINI_MODEL / DEFAULT_GEMINI_MODEL."""
+    if task not in GEMINI_TASKS:
+        raise ValueError(f"Unknown Gemini task: {task}")
+    return os.environ.get(f"GEMINI_MODEL_{task.upper()}") or DEFAULT_GEMINI_MODEL
+
+class GenerativeModelRegistry:
+    """
+    Process-wide LRU of GenerativeModel objects keyed by (model name, system
+    instruction hash, generation config), so requests reuse warm model/client
+    objects instead of constructing one per call.
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._models = OrderedDict()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def _get_or_build(self, key, build):
+        with self._lock:
+            model = self._models.get(key)
+            if model is not None:
+                self._models.move_to_end(key)
+                self._stats["hits"] += 1
+                return model
+            self._stats["misses"] += 1
+        model = build()
+        with self._lock:
+            model = self._models.setdefault(key, model)
+            self._models.move_to_end(key)
+            while len(self._models) > self.max_entries:
+                self._models.popitem(last=False)
+                self._stats["evictions"] += 1
+        return model
+
+    def get(self, model_name, system_instruction=None, generation_config=None):
+        instruction_hash = hashlib.sha256(system_instruction.encode('utf-8')).hexdigest() if system_instruction else None
+        key = ("model", model_name, instruction_hash, json.dumps(generation_config, sort_keys=True) if generation_config else None)
+        return self._get_or_build(key, lambda: genai_api.GenerativeModel(
+            model_name=model_name, system_instruction=system_instruction, generation_config=generation_config))
+
+    def get_cached(self, cached_content, generation_config=None):
+        key = ("cached", cached_content.name, json.dumps(generation_config, sort_keys=True) if generation_config else None)
+        return self._get_or_build(key, lambda: genai_api.GenerativeModel.from_cached_content(
+            cached_content, generation_config=generation_config))
+
+    def discard_cached(self, cached_content_name):
+        with self._lock:
+            for key in [k for k in self._models if k[0] == "cached" and k[1] == cached_content_name]:
+                del self._models[key]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._models)
+        return stats
+
+gemini_models = GenerativeModelRegistry(GEMINI_MODEL_REGISTRY_MAX_ENTRIES)
+
+def get_model(task, system_instruction=None, generation_config=None):
+    """Registry model for a task (see GEMINI_TASKS); generation_config is a plain dict."""
+    return gemini_models.get(model_name_for(task), system_instruction, generation_config)
+
+# --- Upstream Rate Limiting (token buckets with priority queueing) ---
+GEMINI_REQUESTS_PER_MINUTE = int(os.environ.get("GEMINI_REQUESTS_PER_MINUTE", "1000"))
+GEMINI_TOKENS_PER_MINUTE = int(os.environ.get("GEMINI_TOKENS_PER_MINUTE", "1000000"))
+CUSTOM_SEARCH_REQUESTS_PER_DAY = int(os.environ.get("CUSTOM_SEARCH_REQUESTS_PER_DAY", "100")) # Free tier; 0 disables the limit
+CUSTOM_SEARCH_REQUESTS_PER_MINUTE = int(os.environ.get("CUSTOM_SEARCH_REQUESTS_PER_MINUTE", "100"))
+GEMINI_QUOTA_RETRIES = int(os.environ.get("GEMINI_QUOTA_RETRIES", "2")) # Retries after an upstream 429, honoring its retry delay
+GEMINI_QUOTA_BACKOFF_SECONDS = 2.0 # First backoff when a 429 carries no retry delay; doubles per attempt
+
+PRIORITY_INTERACTIVE = 0 # A user is waiting on this exact answer (chat, answer evaluation)
+PRIORITY_STANDARD = 1
+PRIORITY_BULK = 2 # Batch generation that can wait (flashcards)
+RATE_LIMIT_MAX_WAIT_SECONDS = {
+    PRIORITY_INTERACTIVE: float(os.environ.get("RATE_LIMIT_MAX_WAIT_INTERACTIVE_SECONDS", "15")),
+    PRIORITY_STANDARD: float(os.environ.get("RATE_LIMIT_MAX_WAIT_STANDARD_SECONDS", "30")),
+    PRIORITY_BULK: float(os.environ.get("RATE_LIMIT_MAX_WAIT_BULK_SECONDS", "60")),
+}
+TASK_PRIORITIES = {
+    "chat": PRIORITY_INTERACTIVE,
+    "evaluate": PRIORITY_INTERACTIVE,
+    "notes": PRIORITY_STANDARD,
+    "search_queries": PRIORITY_STANDARD,
+    "quiz": PRIORITY_STANDARD,
+    "mindmap": PRIORITY_STANDARD,
+    "flashcards": PRIORITY_BULK,
+}
+
+class RateLimitExceeded(Exception):
+    """Raised when a call cannot get upstream capacity within its bounded queue wait."""
+    def __init__(self, limiter_name, retry_after):
+        super().__init__(f"429 Rate limit: {limiter_name} quota is busy, retry in {math.ceil(retry_after)} seconds.")
+        self.retry_after = retry_after
+
+class RateLimiter:
+    """
+    Token buckets for one upstream API (e.g. requests and tokens per minute).
+    Callers queue strictly by (priority, arrival) and wait at most max_wait for
+    capacity; pause() holds every caller after an upstream 429 until its
+    Retry-After has passed.
+    """
+    def __init__(self, name, limits):
+        self.name = name
+        # bucket -> (capacity, period_seconds); a capacity of 0 disables that bucket
+        self._limits = {key: (float(capacity), float(period)) for key, (capacity, period) in limits.items() if capacity > 0}
+        self._levels = {key: capacity for key, (capacity, _) in self._limits.items()}
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+        self._waiters = [] # heap of (priority, seq)
+        self._seq = itertools.count()
+        self._stats = {"acquired": 0, "queued": 0, "rejected": 0, "wait_seconds": 0.0, "upstream_429": 0}
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._updated = now
+        for key, (capacity, period) in self._limits.items():
+            self._levels[key] = min(capacity, self._levels[key] + elapsed * capacity / period)
+
+    def _seconds_until_available(self, cost, now):
+        wait = max(0.0, self._paused_until - now)
+        for key, amount in cost.items():
+            if key not in self._limits:
+                continue
+            capacity, period = self._limits[key]
+            deficit = min(amount, capacity) - self._levels[key] # Oversized requests wait for a full bucket
+            if deficit > 0:
+                wait = max(wait, deficit * period / capacity)
+        return wait
+
+    def acquire(self, cost, priority=PRIORITY_STANDARD, max_wait=None):
+        """
+        Take cost (e.g. {"requests": 1, "tokens": 1200}) from the buckets, waiting behind
+        higher-priority and earlier callers. Returns the seconds waited or raises RateLimitExceeded.
+        """
+        if max_wait is None:
+            max_wait = RATE_LIMIT_MAX_WAIT_SECONDS.get(priority, RATE_LIMIT_MAX_WAIT_SECONDS[PRIORITY_STANDARD])
+        start = time.monotonic()
+        deadline = start + max_wait
+        entry = (priority, next(self._seq))
+        with self._cond:
+            heapq.heappush(self._waiters, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    is_next = self._waiters[0] == entry
+                    wait = self._seconds_until_available(cost, now) if is_next else None
+                    if wait == 0:
+                        for key, amount in cost.items():
+                            if key in self._limits:
+                                self._levels[key] -= min(amount, self._limits[key][0])
+                        waited = now - start
+                        self._stats["acquired"] += 1
+                        self._stats["wait_seconds"] += waited
+                        if waited > 0.01:
+                            self._stats["queued"] += 1
+                        return waited
+                    remaining = deadline - now
+                    if remaining <= 0 or (wait is not None and wait > remaining):
+                        self._stats["rejected"] += 1
+                        raise RateLimitExceeded(self.name, wait if wait is not None else self.retry_after_hint())
+                    self._cond.wait(timeout=min(remaining, wait) if wait is not None else remaining)
+            finally:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+
+    def pause(self, seconds):
+        """Hold all callers for `seconds` (upstream asked us to back off)."""
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._stats["upstream_429"] += 1
+
+    def retry_after_hint(self):
+        """Rough seconds until a single request would be admitted, for Retry-After headers."""
+        with self._cond:
+            now = time.monotonic()
+            self._refill(now)
+            return self._seconds_until_available({"requests": 1}, now) + len(self._waiters)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats["queue_length"] = len(self._waiters)
+            stats["levels"] = {key: round(level, 1) for key, level in self._levels.items()}
+        stats["wait_seconds"] = round(stats["wait_seconds"], 2)
+        return stats
+
+gemini_rate_limiter = RateLimiter("gemini", {
+    "requests": (GEMINI_REQUESTS_PER_MINUTE, 60),
+    "tokens": (GEMINI_TOKENS_PER_MINUTE, 60),
+})
+# The daily bucket starts full on every process start; it smooths usage rather than tracking the exact quota day
+custom_search_rate_limiter = RateLimiter("custom_search", {
+    "requests": (CUSTOM_SEARCH_REQUESTS_PER_DAY, 24 * 3600),
+    "requests_per_minute": (CUSTOM_SEARCH_REQUESTS_PER_MINUTE, 60),
+})
+
+def is_quota_error(error):
+    error_text = str(error)
+    return "429" in error_text or "Resource has been exhausted" in error_text or "quota" in error_text.lower()
+
+def retry_after_from_error(error):
+    """Retry delay (seconds) suggested by a Gemini 429, if any."""
+    error_text = str(error)
+    match = re.search(r"retry_delay\s*\{\s*seconds:\s*(\d+)", error_text) or re.search(r"retry in ([\d.]+)\s*s", error_text, re.IGNORECASE)
+    return float(match.group(1)) if match else None
+
+def retry_after_from_response(response):
+    """Seconds from an HTTP Retry-After header (delta-seconds form), if present."""
+    value = response.headers.get("Retry-After", "") if response is not None else ""
+    return float(value) if value.strip().replace('.', '', 1).isdigit() else None
+
+def rate_limit_retry_after(result):
+    """Seconds a client should wait before retrying a quota/rate-limit error result, or None for other errors."""
+    error_text = str(result.get("error", "")).lower()
+    if "rate limit" in error_text or "quota" in error_text:
+        return max(1, math.ceil(gemini_rate_limiter.retry_after_hint()))
+    return None
+
+def rate_limited_error_response(result, status_code=500):
+    """JSON error response; quota/rate-limit errors become 429 with a Retry-After header."""
+    retry_after = rate_limit_retry_after(result)
+    if retry_after is not None:
+        return jsonify(result), 429, {"Retry-After": str(retry_after)}
+    return jsonify(result), status_code
+
+def with_retry_after(data, cause=None):
+    """
+    SSE/job variant of rate_limited_error_response(): once a stream is open its status and
+    headers are sent, so a quota/rate-limit error (in data, or in the error dict that caused
+    it) carries its delay as a "retry_after" field of the `error` event instead.
+    """
+    retry_after = rate_limit_retry_after(cause if cause is not None else data)
+    return dict(data, retry_after=retry_after) if retry_after is not None else data
+
+class _TracedStream:
+    """
+    A streamed Gemini response whose consumption is recorded as an `llm_stream` stage, from
+    the request to the last chunk, with tokens from the final usage_metadata. The `llm_call`
+    span of a streamed call only covers the time to the first chunk.
+    Other attributes (candidates, usage_metadata, ...) pass through to the response.
+    """
+    def __init__(self, response, task, started):
+        self._response = response
+        self._task = task
+        self._started = started
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def __iter__(self):
+        chunks, finished = 0, False
+        try:
+            for chunk in self._response:
+                chunks += 1
+                yield chunk
+            finished = True
+        finally:
+            # Stopped early (error, blocked prompt, client disconnect) counts as a failed stream
+            usage = getattr(self._response, 'usage_metadata', None) if finished else None
+            record_stage("llm_stream", time.perf_counter() - self._started, task=self._task, chunks=chunks,
+                         tokens=getattr(usage, 'total_token_count', 0) or 0,
+                         cached_tokens=getattr(usage, 'cached_content_token_count', 0) or 0,
+                         error=not finished)
+
+def _rate_limited_generate(model, contents, task, kwargs):
+    priority = TASK_PRIORITIES.get(task, PRIORITY_STANDARD)
+    prompt_size = len(json.dumps(contents, default=lambda o: getattr(o, 'name', None) or repr(o)))
+    cost = {"requests": 1, "tokens": (prompt_size + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN}
+    for attempt in range(GEMINI_QUOTA_RETRIES + 1):
+        waited = gemini_rate_limiter.acquire(cost, priority)
+        if waited > 1:
+            print(f"Gemini {task} request waited {waited:.1f}s for rate limit capacity")
+        try:
+            started = time.perf_counter()
+            with stage_span("llm_call", task=task, stream=bool(kwargs.get('stream')), attempt=attempt) as span:
+                response = model.generate_content(contents, **kwargs)
+                usage = None if kwargs.get('stream') else getattr(response, 'usage_metadata', None)
+                prompt_budgets.record_usage(task, usage)
+                if usage is not None:
+                    span.set(tokens=getattr(usage, 'total_token_count', 0) or 0,
+                             cached_tokens=getattr(usage, 'cached_content_token_count', 0) or 0)
+            return _TracedStream(response, task, started) if kwargs.get('stream') else response
+        except Exception as e:
+            if kwargs.get('stream') or not is_quota_error(e) or attempt == GEMINI_QUOTA_RETRIES:
+                raise
+            delay = retry_after_from_error(e) or GEMINI_QUOTA_BACKOFF_SECONDS * (2 ** attempt)
+            print(f"Gemini quota hit during {task}; backing off {delay:g}s (attempt {attempt + 1}/{GEMINI_QUOTA_RETRIES})")
+            gemini_rate_limiter.pause(delay)
+
+# --- Gemini Request Coalescing ---
+GEMINI_COALESCE_ENABLED = os.environ.get("GEMINI_COALESCE_ENABLED", "true").lower() == "true"
+
+class InFlightCoalescer:
+    """
+    Single-flight execution: concurrent calls with the same key share one
+    underlying call, and its result (or exception) is fanned out to every waiter.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight = {} # key -> Future
+        self._stats = {"calls": 0, "coalesced": 0}
+
+    def run(self, key, fn):
+        with self._lock:
+            self._stats["calls"] += 1
+            future = self._in_flight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._in_flight[key] = future
+            else:
+                self._stats["coalesced"] += 1
+        if not is_leader:
+            return future.result()
+        try:
+            result = fn()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["in_flight"] = len(self._in_flight)
+        return stats
+
+gemini_coalescer = InFlightCoalescer()
+
+def _generation_key(model, contents, kwargs):
+    """Hash of everything that determines a generate_content result: model, cached context, system instruction, config and prompt."""
+    payload = json.dumps({
+        "model": getattr(model, 'model_name', None),
+        "cached_content": getattr(model, 'cached_content', None),
+        "system_instruction": repr(getattr(model, '_system_instruction', None)),
+        "generation_config": repr(getattr(model, '_generation_config', None)),
+        "contents": contents,
+        "kwargs": kwargs,
+    }, sort_keys=True, default=lambda o: getattr(o, 'name', None) or repr(o)) # Uploaded files hash by name
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def gemini_generate(model, contents, task, **kwargs):
+    """
+    model.generate_content(contents, **kwargs) for a task (see TASK_PRIORITIES), admitted
+    by the Gemini rate limiter and with identical concurrent requests (double-clicks,
+    client retries) coalesced onto one upstream call. Streaming calls are not coalesced.
+    """
+    if kwargs.get('stream') or not GEMINI_COALESCE_ENABLED:
+        return _rate_limited_generate(model, contents, task, kwargs)
+    key = _generation_key(model, contents, kwargs)
+    return gemini_coalescer.run(key, lambda: _rate_limited_generate(model, contents, task, kwargs))
+
+# --- Structured Output (schema-constrained JSON responses) ---
+class SchemaValidationError(ValueError):
+    """Generated JSON does not match its schema; the message starts with the offending path (e.g. "$[2].options")."""
+
+_JSON_TYPES = {"object": dict, "array": list, "string": str, "integer": int, "number": (int, float), "boolean": bool}
+
+def _is_json_type(value, type_name):
+    if isinstance(value, bool) and type_name in ("integer", "number"):
+        return False
+    return isinstance(value, _JSON_TYPES[type_name])
+
+def compile_schema(schema):
+    """
+    Compile a JSON Schema subset (type, enum, const, required, properties, items,
+    minItems/maxItems, minLength, pattern, allOf, if/then) into a validator
+    function validate(value, path="$") that raises SchemaValidationError.
+    Sub-schemas are compiled once, so validating a response is a plain walk.
+    """
+    checks = []
+
+    if "type" in schema:
+        type_names = schema["type"] if isinstance(schema["type"], list) else [schema["type"]]
+        def check_type(value, path):
+            if not any(_is_json_type(value, type_name) for type_name in type_names):
+                raise SchemaValidationError(f"{path}: expected {' or '.join(type_names)}, got {type(value).__name__}")
+        checks.append(check_type)
+    if "const" in schema:
+        const = schema["const"]
+        def check_const(value, path):
+            if value != const:
+                raise SchemaValidationError(f"{path}: expected {json.dumps(const)}")
+        checks.append(check_const)
+    if "enum" in schema:
+        allowed = schema["enum"]
+        def check_enum(value, path):
+            if value not in allowed:
+                raise SchemaValidationError(f"{path}: {json.dumps(value)[:50]} is not one of {allowed}")
+        checks.append(check_enum)
+    if "minLength" in schema or "pattern" in schema:
+        min_length = schema.get("minLength", 0)
+        pattern = re.compile(schema["pattern"]) if "pattern" in schema else None
+        def check_string(value, path):
+            if not isinstance(value, str):
+                return
+            if len(value.strip()) < min_length:
+                raise SchemaValidationError(f"{path}: expected at least {min_length} non-blank characters")
+            if pattern and not pattern.search(value):
+                raise SchemaValidationError(f"{path}: {json.dumps(value)[:50]} does not match {pattern.pattern}")
+        checks.append(check_string)
+    if "minItems" in schema or "maxItems" in schema or "items" in schema:
+        min_items, max_items = schema.get("minItems", 0), schema.get("maxItems")
+        validate_item = compile_schema(schema["items"]) if "items" in schema else None
+        def check_array(value, path):
+            if not isinstance(value, list):
+                return
+            if len(value) < min_items or (max_items is not None and len(value) > max_items):
+                expected = min_items if min_items == max_items else f"{min_items}-{max_items if max_items is not None else 'any'}"
+                raise SchemaValidationError(f"{path}: expected {expected} items, got {len(value)}")
+            if validate_item:
+                for index, item in enumerate(value):
+                    validate_item(item, f"{path}[{index}]")
+        checks.append(check_array)
+    if "required" in schema or "properties" in schema:
+        required = schema.get("required", [])
+        property_validators = {key: compile_schema(sub_schema) for key, sub_schema in schema.get("properties", {}).items()}
+        def check_object(value, path):
+            if not isinstance(value, dict):
+                return
+            missing = [key for key in required if key not in value]
+            if missing:
+                raise SchemaValidationError(f"{path}: missing {', '.join(missing)}")
+            for key, validate_property in property_validators.items():
+                if key in value:
+                    validate_property(value[key], f"{path}.{key}")
+        checks.append(check_object)
+    for sub_schema in schema.get("allOf", []):
+        checks.append(compile_schema(sub_schema))
+    if "if" in schema and "then" in schema:
+        validate_condition, validate_then = compile_schema(schema["if"]), compile_schema(schema["then"])
+        def check_conditional(value, path):
+            try:
+                validate_condition(value, path)
+            except SchemaValidationError:
+                return
+            validate_then(value, path)
+        checks.append(check_conditional)
+
+    def validate(value, path="$"):
+        for check in checks:
+            check(value, path)
+    return validate
+
+# Keywords Gemini's response_schema (an OpenAPI subset) understands, mapped to its field names
+_GEMINI_SCHEMA_KEYWORDS = {"type": "type", "format": "format", "description": "description", "nullable": "nullable",
+                           "enum": "enum", "required": "required", "minItems": "min_items", "maxItems": "max_items"}
+
+def gemini_response_schema(schema):
+    """
+    Project a validation schema onto what Gemini can enforce while decoding. Constraints it
+    cannot express (allOf, if/then, pattern, ...) are left to the local validator; returns
+    None when the shape itself cannot be expressed (e.g. a value that may be a string or an array).
+    """
+    if isinstance(schema.get("type"), list) or "type" not in schema:
+        return None
+    projected = {_GEMINI_SCHEMA_KEYWORDS[key]: value for key, value in schema.items() if key in _GEMINI_SCHEMA_KEYWORDS}
+    if "enum" in projected:
+        projected["format"] = "enum"
+    if "items" in schema:
+        projected["items"] = gemini_response_schema(schema["items"])
+        if projected["items"] is None:
+            return None
+    if "properties" in schema:
+        projected["properties"] = {}
+        for key, sub_schema in schema["properties"].items():
+            projected["properties"][key] = gemini_response_schema(sub_schema)
+            if projected["properties"][key] is None:
+                return None
+    return projected
+
+def structured_output_config(schema):
+    """generation_config for JSON mode, constrained by the schema wherever Gemini can express it."""
+    generation_config = {"response_mime_type": "application/json"}
+    response_schema = gemini_response_schema(schema)
+    if response_schema is not None:
+        generation_config["response_schema"] = response_schema
+    return generation_config
+
+@traced_stage("json_validation")
+def parse_structured_output(text, validate):
+    """Parse a JSON-mode response and check it against its compiled schema (raises JSONDecodeError / SchemaValidationError)."""
+    current_stage_span().set(chars=len(text))
+    data = json.loads(text)
+    validate(data)
+    return data
+
+SEARCH_QUERIES_SCHEMA = {"type": "array", "minItems": 1, "items": {"type": "string", "minLength": 1}}
+
+FLASHCARDS_SCHEMA = {
+    "type": "array",
+    "minItems": 1,
+    "items": {
+        "type": "object",
+        "properties": {
+            "question": {"type": "string", "minLength": 1},
+            "answer": {"type": "string", "minLength": 1},
+        },
+        "required": ["question", "answer"],
+    },
+}
+
+def _quiz_question_variant(question_type, options_schema, answer_schema):
+    return {
+        "if": {"properties": {"type": {"const": question_type}}},
+        "then": {"properties": {"options": options_schema, "correct_answer": answer_schema}},
+    }
+
+_FIVE_STRINGS = {"type": "array", "minItems": 5, "maxItems": 5, "items": {"type": "string"}}
+_NO_OPTIONS = {"type": "array", "maxItems": 0}
+
+# "options" is an array or an object depending on the question type, which Gemini's
+# schema cannot express, so quizzes use JSON mode and rely on the local validator.
+QUIZ_SCHEMA = {
+    "type": "array",
+    "minItems": 1,
+    "items": {
+        "type": "object",
+        "properties": {
+            "type": {"type": "string", "enum": ["MCQ", "True/False", "Fill_in_the_Blank", "Short_Answer", "Matching"]},
+            "question": {"type": "string", "minLength": 1},
+            "options": {"type": ["array", "object"]},
+            "explanation": {"type": "string"},
+            "difficulty": {"type": "string"},
+        },
+        "required": ["type", "question", "options", "correct_answer", "explanation", "difficulty"],
+        "allOf": [
+            _quiz_question_variant("MCQ", {"type": "array", "minItems": 4, "maxItems": 4, "items": {"type": "string"}}, {"type": "string"}),
+            _quiz_question_variant("True/False", {"const": ["True", "False"]}, {"enum": ["True", "False"]}),
+            _quiz_question_variant("Fill_in_the_Blank", _NO_OPTIONS, {"type": ["string", "array"], "items": {"type": "string"}}),
+            _quiz_question_variant("Short_Answer", _NO_OPTIONS, {"type": "string"}),
+            _quiz_question_variant("Matching",
+                                   {"type": "object", "properties": {"column_a": _FIVE_STRINGS, "column_b": _FIVE_STRINGS}, "required": ["column_a", "column_b"]},
+                                   {"type": "array", "minItems": 5, "maxItems": 5, "items": {"type": "string", "pattern": r"^\d+-\d+$"}}),
+        ],
+    },
+}
+
+validate_search_queries = compile_schema(SEARCH_QUERIES_SCHEMA)
+validate_flashcard = compile_schema(FLASHCARDS_SCHEMA["items"])
+_validate_quiz_question_shape = compile_schema(QUIZ_SCHEMA["items"])
+
+def validate_quiz_question(question, path="$"):
+    _validate_quiz_question_shape(question, path)
+    # The one rule a schema cannot state: an MCQ answer must be one of its own options
+    if question["type"] == "MCQ" and question["correct_answer"] not in question["options"]:
+        raise SchemaValidationError(f"{path}.correct_answer: must match one of the MCQ options")
+
+def normalize_quiz_response(data):
+    """
+    Accept the two slips JSON mode still allows without a response schema: a single question
+    object instead of an array, and free-text questions (Fill_in_the_Blank, Short_Answer)
+    that omit their empty "options".
+    """
+    if isinstance(data, dict) and 'type' in data:
+        print("Warning: Received single question object, wrapping in list.")
+        data = [data]
+    if isinstance(data, list):
+        for question in data:
+            if isinstance(question, dict) and question.get('type') in ('Fill_in_the_Blank', 'Short_Answer'):
+                question.setdefault('options', [])
+    return data
+
+# --- Partial Batch Salvage (keep valid items, regenerate only the shortfall) ---
+BATCH_SALVAGE_MAX_ROUNDS = int(os.environ.get("BATCH_SALVAGE_MAX_ROUNDS", "1")) # Top-up requests per batch; 0 keeps valid items without topping up
+
+@traced_stage("json_validation")
+def split_valid_items(data, validate_item):
+    """
+    Validate a generated JSON array item by item. Returns (valid_items, rejection_messages);
+    raises SchemaValidationError only if the response is not an array at all.
+    """
+    if not isinstance(data, list):
+        raise SchemaValidationError(f"$: expected array, got {type(data).__name__}")
+    valid_items, rejected = [], []
+    for index, item in enumerate(data):
+        try:
+            validate_item(item, f"$[{index}]")
+            valid_items.append(item)
+        except SchemaValidationError as e:
+            rejected.append(str(e))
+    current_stage_span().set(items=len(valid_items), rejected=len(rejected))
+    return valid_items, rejected
+
+class BatchSalvageStats:
+    """Per-kind counts of items rejected from generated batches and how many of those batches were salvaged."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, kind, requested, first_pass_valid, rejected, delivered):
+        with self._lock:
+            stats = self._stats.setdefault(kind, {
+                "batches": 0, "batches_with_rejects": 0, "items_requested": 0, "items_rejected": 0,
+                "items_salvaged": 0, "items_topped_up": 0, "items_delivered": 0,
+            })
+            stats["batches"] += 1
+            stats["items_requested"] += requested
+            stats["items_rejected"] += rejected
+            stats["items_topped_up"] += delivered - first_pass_valid
+            stats["items_delivered"] += delivered
+            if rejected:
+                stats["batches_with_rejects"] += 1
+                stats["items_salvaged"] += first_pass_valid # Valid items a whole-batch rejection would have thrown away
+
+    def stats(self):
+        with self._lock:
+            result = {kind: dict(stats) for kind, stats in self._stats.items()}
+        for stats in result.values():
+            in_rejected_batches = stats["items_salvaged"] + stats["items_rejected"]
+            stats["salvage_rate"] = round(stats["items_salvaged"] / in_rejected_batches, 3) if in_rejected_batches else None
+        return result
+
+batch_salvage_stats = BatchSalvageStats()
+
+def top_up_batch(kind, items, rejected, requested, salvage_round, regenerate):
+    """
+    Keep a batch's valid items (at most `requested`) and ask regenerate(missing_count) -> list
+    of at most missing_count items for only the shortfall, instead of regenerating the whole
+    batch. The outermost call records the outcome in batch_salvage_stats.
+    """
+    items = items[:requested] # The model can return more items than it was asked for
+    first_pass_valid = len(items)
+    if rejected:
+        print(f"{kind.capitalize()} batch: kept {first_pass_valid} item(s), rejected {len(rejected)}: {'; '.join(rejected[:3])}")
+    missing = requested - first_pass_valid
+    if missing > 0 and salvage_round < BATCH_SALVAGE_MAX_ROUNDS:
+        print(f"Regenerating {missing} missing {kind} item(s)")
+        items = items + regenerate(missing)
+    if salvage_round == 0:
+        batch_salvage_stats.record(kind, requested, first_pass_valid, len(rejected), len(items))
+    return items
+
+def get_batch_salvage_stats():
+    return batch_salvage_stats.stats()
+
+# --- Shared HTTP Client ---
+HTTP_POOL_CONNECTIONS = int(os.environ.get("HTTP_POOL_CONNECTIONS", "32")) # Number of per-host pools kept alive
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", "10")) # Connections kept alive per host
+
+_http_stats = {"requests": 0, "new_connections": 0}
+_http_stats_lock = threading.Lock()
+
+def _count_http_stat(key):
+    with _http_stats_lock:
+        _http_stats[key] += 1
+
+class _CountingHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    def _new_conn(self):
+        _count_http_stat("new_connections")
+        return super()._new_conn()
+
+class _CountingHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    def _new_conn(self):
+        _count_http_stat("new_connections")
+        return super()._new_conn()
+
+class _CountingHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that records requests sent and TCP/TLS connections opened."""
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+    def send(self, request, *args, **kwargs):
+        _count_http_stat("requests")
+        return super().send(request, *args, **kwargs)
+
+_http_session = None
+_http_session_lock = threading.Lock()
 
-# --- Web Search Helper Functions (Keep as is, but check SEARCH_ENGINE_ID usage) ---
 def create_http_session():
     session = requests.Session()
     retries = Retry(
@@ -57,12 +1284,844 @@ def create_http_session():
         status_forcelist=[500, 502, 503, 504],
         allowed_methods=frozenset(['GET', 'POST'])
     )
-    session.mount('https://', HTTPAdapter(max_retries=retries))
+    adapter = _CountingHTTPAdapter(
+        pool_connections=HTTP_POOL_CONNECTIONS,
+        pool_maxsize=HTTP_POOL_MAXSIZE,
+        max_retries=retries
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
     return session
 
+def get_http_session():
+    """Return the process-wide pooled session (connections are kept alive and reused across calls and threads)."""
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                _http_session = create_http_session()
+    return _http_session
+
+def get_http_stats():
+    """Connection-reuse counters for the shared HTTP client."""
+    with _http_stats_lock:
+        stats = dict(_http_stats)
+    stats["reused_connections"] = max(0, stats["requests"] - stats["new_connections"])
+    stats["reuse_ratio"] = round(stats["reused_connections"] / stats["requests"], 3) if stats["requests"] else 0.0
+    return stats
+
+# --- Extraction Cache (persistent, content-addressed by normalized URL / video ID) ---
+EXTRACTION_CACHE_ENABLED = os.environ.get("EXTRACTION_CACHE_ENABLED", "true").lower() == "true"
+EXTRACTION_CACHE_PATH = os.environ.get("EXTRACTION_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), f"{LOCAL_DB_PREFIX}extraction_cache.db"))
+EXTRACTION_CACHE_MAX_BYTES = int(os.environ.get("EXTRACTION_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+EXTRACTION_CACHE_TTL_SECONDS = int(os.environ.get("EXTRACTION_CACHE_TTL_SECONDS", str(24 * 3600))) # Websites
+YOUTUBE_CACHE_TTL_SECONDS = int(os.environ.get("YOUTUBE_CACHE_TTL_SECONDS", str(7 * 24 * 3600))) # Transcripts rarely change
+
+class ExtractionCache:
+    """
+    SQLite-backed cache of extraction results stored as zlib-compressed JSON.
+    Entries carry a TTL plus optional ETag/Last-Modified validators so stale
+    entries can be revalidated instead of re-downloaded; the least recently
+    used entries are evicted once the stored size exceeds max_bytes.
+    """
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stale": 0, "revalidated": 0, "stores": 0, "evictions": 0}
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS extraction_cache (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                expires_at REAL NOT NULL,
+                last_accessed REAL NOT NULL,
+                etag TEXT,
+                last_modified TEXT
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_extraction_cache_lru ON extraction_cache (last_accessed)")
+        self._conn.commit()
+
+    def _count(self, key, amount=1):
+        self._stats[key] += amount
+
+    def get(self, key):
+        """
+        Return (value, is_fresh, validators) or (None, False, None) on a miss.
+        Stale entries are returned with is_fresh=False so callers can revalidate.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at, etag, last_modified FROM extraction_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self._count("misses")
+                return None, False, None
+            self._conn.execute("UPDATE extraction_cache SET last_accessed = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            is_fresh = row[1] > now
+            self._count("hits" if is_fresh else "stale")
+        value = json.loads(zlib.decompress(row[0]).decode('utf-8'))
+        return value, is_fresh, {"etag": row[2], "last_modified": row[3]}
+
+    def put(self, key, value, ttl_seconds, etag=None, last_modified=None):
+        blob = zlib.compress(json.dumps(value).encode('utf-8'))
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO extraction_cache (key, value, size, created_at, expires_at, last_accessed, etag, last_modified) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, blob, len(blob), now, now + ttl_seconds, now, etag, last_modified)
+            )
+            self._count("stores")
+            self._evict_locked()
+            self._conn.commit()
+
+    def refresh(self, key, ttl_seconds):
+        """Extend a stale entry's lifetime after a successful (304) revalidation."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE extraction_cache SET expires_at = ?, last_accessed = ? WHERE key = ?", (now + ttl_seconds, now, key)
+            )
+            self._conn.commit()
+            self._count("revalidated")
+
+    def _evict_locked(self):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM extraction_cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        to_delete = []
+        for key, size in self._conn.execute("SELECT key, size FROM extraction_cache ORDER BY last_accessed ASC"):
+            if total <= self.max_bytes:
+                break
+            to_delete.append((key,))
+            total -= size
+        self._conn.executemany("DELETE FROM extraction_cache WHERE key = ?", to_delete)
+        self._count("evictions", len(to_delete))
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            entries, total_bytes = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM extraction_cache").fetchone()
+        lookups = stats["hits"] + stats["stale"] + stats["misses"]
+        stats["entries"] = entries
+        stats["bytes"] = total_bytes
+        stats["hit_ratio"] = round((stats["hits"] + stats["revalidated"]) / lookups, 3) if lookups else 0.0
+        return stats
+
+def _create_extraction_cache():
+    if not EXTRACTION_CACHE_ENABLED:
+        return None
+    try:
+        return ExtractionCache(EXTRACTION_CACHE_PATH, EXTRACTION_CACHE_MAX_BYTES)
+    except Exception as e:
+        print(f"Warning: Extraction cache disabled, could not open {EXTRACTION_CACHE_PATH}: {e}")
+        return None
+
+extraction_cache = _create_extraction_cache()
+
+TRACKING_QUERY_PARAMS = ('utm_', 'fbclid', 'gclid', 'mc_cid', 'mc_eid', 'ref_src')
+
+def normalize_url(url):
+    """Normalize a URL for cache keys: lowercase scheme/host, drop default ports, fragments and tracking params, sort the query."""
+    parsed = urlparse(url.strip())
+    scheme = (parsed.scheme or 'http').lower()
+    host = (parsed.hostname or '').lower()
+    port = parsed.port
+    if port and not ((scheme == 'http' and port == 80) or (scheme == 'https' and port == 443)):
+        host = f"{host}:{port}"
+    query = sorted(
+        (k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True)
+        if not k.lower().startswith(TRACKING_QUERY_PARAMS)
+    )
+    return urlunparse((scheme, host, parsed.path or '/', parsed.params, urlencode(query), ''))
+
+def get_extraction_cache_stats():
+    return extraction_cache.stats() if extraction_cache else {"enabled": False}
+
+# --- Study Session Store (server-side notes/original text keyed by content_id) ---
+SESSION_STORE_ENABLED = os.environ.get("SESSION_STORE_ENABLED", "true").lower() == "true"
+SESSION_STORE_PATH = os.environ.get("SESSION_STORE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), f"{LOCAL_DB_PREFIX}study_sessions.db"))
+SESSION_STORE_MAX_BYTES = int(os.environ.get("SESSION_STORE_MAX_BYTES", str(500 * 1024 * 1024)))
+SESSION_TTL_SECONDS = int(os.environ.get("SESSION_TTL_SECONDS", str(24 * 3600))) # Sliding: extended on every access
+
+class StudySessionStore:
+    """
+    SQLite-backed store of study session artefacts (notes, original text, chat
+    history, ...) saved as zlib-compressed JSON under the session's content_id,
+    so follow-up requests only need to send the ID. Sessions expire after
+    ttl_seconds without access; the least recently used sessions are evicted
+    once the stored size exceeds max_bytes. Each session's retrieval index lives in
+    a separate table, so it is never returned as a session, and is deleted with it.
+    """
+    def __init__(self, path, max_bytes, ttl_seconds):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "expired": 0, "stores": 0, "updates": 0, "evictions": 0}
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS study_sessions (
+                session_id TEXT PRIMARY KEY,
+                data BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                expires_at REAL NOT NULL,
+                last_accessed REAL NOT NULL
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_study_sessions_lru ON study_sessions (last_accessed)")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS retrieval_indexes (
+                session_id TEXT PRIMARY KEY,
+                data BLOB NOT NULL,
+                size INTEGER NOT NULL
+            )""")
+        # Indexes used to be stored as "<content_id>/retrieval-index" sessions
+        self._conn.execute("DELETE FROM study_sessions WHERE session_id LIKE '%/retrieval-index'")
+        self._conn.commit()
+
+    def _get_locked(self, session_id, now):
+        row = self._conn.execute(
+            "SELECT data, expires_at FROM study_sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if row is None:
+            self._stats["misses"] += 1
+            return None
+        if row[1] <= now:
+            self._conn.execute("DELETE FROM study_sessions WHERE session_id = ?", (session_id,))
+            self._conn.execute("DELETE FROM retrieval_indexes WHERE session_id = ?", (session_id,))
+            self._conn.commit()
+            self._stats["expired"] += 1
+            return None
+        self._conn.execute(
+            "UPDATE study_sessions SET last_accessed = ?, expires_at = ? WHERE session_id = ?",
+            (now, now + self.ttl_seconds, session_id)
+        )
+        self._conn.commit()
+        self._stats["hits"] += 1
+        return row[0]
+
+    def get(self, session_id):
+        """Return the session dict, or None if it is unknown or expired. Access extends the TTL."""
+        if not session_id:
+            return None
+        with self._lock:
+            blob = self._get_locked(session_id, time.time())
+        return json.loads(zlib.decompress(blob).decode('utf-8')) if blob is not None else None
+
+    def put(self, session_id, data):
+        blob = zlib.compress(json.dumps(data).encode('utf-8'))
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO study_sessions (session_id, data, size, created_at, expires_at, last_accessed) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (session_id, blob, len(blob), now, now + self.ttl_seconds, now)
+            )
+            self._stats["stores"] += 1
+            self._evict_locked(now)
+            self._conn.commit()
+
+    def update(self, session_id, **fields):
+        """Merge fields into an existing session. Returns False if the session is unknown or expired."""
+        now = time.time()
+        with self._lock:
+            blob = self._get_locked(session_id, now)
+            if blob is None:
+                return False
+            data = json.loads(zlib.decompress(blob).decode('utf-8'))
+            data.update(fields)
+            blob = zlib.compress(json.dumps(data).encode('utf-8'))
+            self._conn.execute(
+                "UPDATE study_sessions SET data = ?, size = ? WHERE session_id = ?", (blob, len(blob), session_id)
+            )
+            self._stats["updates"] += 1
+            self._evict_locked(now)
+            self._conn.commit()
+        return True
+
+    def get_index(self, session_id):
+        """Return the stored retrieval index dict for a live session, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT r.data FROM retrieval_indexes r JOIN study_sessions s ON s.session_id = r.session_id "
+                "WHERE r.session_id = ? AND s.expires_at > ?", (session_id, time.time())
+            ).fetchone()
+        return json.loads(zlib.decompress(row[0]).decode('utf-8')) if row is not None else None
+
+    def put_index(self, session_id, data):
+        """Store a session's retrieval index. Returns False if the session is unknown or expired."""
+        blob = zlib.compress(json.dumps(data).encode('utf-8'))
+        now = time.time()
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM study_sessions WHERE session_id = ? AND expires_at > ?", (session_id, now)).fetchone() is None:
+                return False
+            self._conn.execute("INSERT OR REPLACE INTO retrieval_indexes (session_id, data, size) VALUES (?, ?, ?)",
+                               (session_id, blob, len(blob)))
+            self._evict_locked(now)
+            self._conn.commit()
+        return True
+
+    def _total_bytes_locked(self):
+        return self._conn.execute(
+            "SELECT (SELECT COALESCE(SUM(size), 0) FROM study_sessions) + (SELECT COALESCE(SUM(size), 0) FROM retrieval_indexes)"
+        ).fetchone()[0]
+
+    def _evict_locked(self, now):
+        cursor = self._conn.execute("DELETE FROM study_sessions WHERE expires_at <= ?", (now,))
+        self._stats["expired"] += cursor.rowcount
+        try:
+            total = self._total_bytes_locked()
+            if total <= self.max_bytes:
+                return
+            to_delete = []
+            for session_id, size in self._conn.execute(
+                    "SELECT s.session_id, s.size + COALESCE(r.size, 0) FROM study_sessions s "
+                    "LEFT JOIN retrieval_indexes r ON r.session_id = s.session_id ORDER BY s.last_accessed ASC"):
+                if total <= self.max_bytes:
+                    break
+                to_delete.append((session_id,))
+                total -= size
+            self._conn.executemany("DELETE FROM study_sessions WHERE session_id = ?", to_delete)
+            self._stats["evictions"] += len(to_delete)
+        finally:
+            # Indexes of expired or evicted sessions go with them
+            self._conn.execute("DELETE FROM retrieval_indexes WHERE session_id NOT IN (SELECT session_id FROM study_sessions)")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            entries = self._conn.execute("SELECT COUNT(*) FROM study_sessions").fetchone()[0]
+            total_bytes = self._total_bytes_locked()
+        stats["entries"] = entries
+        stats["bytes"] = total_bytes
+        return stats
+
+def _create_study_session_store():
+    if not SESSION_STORE_ENABLED:
+        return None
+    try:
+        return StudySessionStore(SESSION_STORE_PATH, SESSION_STORE_MAX_BYTES, SESSION_TTL_SECONDS)
+    except Exception as e:
+        print(f"Warning: Study session store disabled, could not open {SESSION_STORE_PATH}: {e}")
+        return None
+
+study_session_store = _create_study_session_store()
+
+def save_study_session(results):
+    """Persist a freshly processed session's artefacts. Returns True if they were stored."""
+    if not study_session_store:
+        return False
+    try:
+        study_session_store.put(results['content_id'], {
+            "title": results.get('title', ''),
+            "notes": results.get('notes', ''),
+            "original_text": results.get('original_text', ''),
+            "web_search_enabled": results.get('web_search_enabled', False),
+            "chat_history": [],
+        })
+        if gemini_context_cache:
+            gemini_context_cache.invalidate(results['content_id']) # Material (re)written
+        if RETRIEVAL_ENABLED:
+            # Build the retrieval index once per session, right after processing
+            index = build_retrieval_index(results.get('notes', ''), results.get('original_text', ''))
+            retrieval_index_cache.put(results['content_id'], index, SESSION_TTL_SECONDS)
+            study_session_store.put_index(results['content_id'], index.to_dict())
+        return True
+    except Exception as e:
+        print(f"Warning: Could not store study session {results.get('content_id')}: {e}")
+        return False
+
+def load_study_context(data):
+    """
+    Resolve the study material for a follow-up request. With a `content_id` the notes,
+    original text and chat history come from the server-side session store; otherwise
+    they are read from the request body. Returns a context dict, or a dict with
+    "error" and "status_code".
+    """
+    content_id = data.get('content_id')
+    if content_id and study_session_store and not data.get('notes') and not data.get('original_text'):
+        session = study_session_store.get(content_id)
+        if session is None:
+            return {"error": "Study session not found or expired. Please process the content again.", "status_code": 404}
+        session["content_id"] = content_id
+        session["from_store"] = True
+        return session
+    return {
+        "content_id": content_id,
+        "notes": data.get('notes'),
+        "original_text": data.get('original_text'),
+        "web_search_enabled": data.get('web_search_enabled', False),
+        "chat_history": data.get('history', []),
+        "from_store": False,
+    }
+
+def get_study_session_stats():
+    return study_session_store.stats() if study_session_store else {"enabled": False}
+
+# --- Search Result & Query Cache (TTL + LRU, memory or SQLite backend) ---
+SEARCH_CACHE_BACKEND = os.environ.get("SEARCH_CACHE_BACKEND", "memory").lower() # "memory", "sqlite" or "none"
+SEARCH_CACHE_PATH = os.environ.get("SEARCH_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), f"{LOCAL_DB_PREFIX}search_cache.db"))
+SEARCH_CACHE_MAX_ENTRIES = int(os.environ.get("SEARCH_CACHE_MAX_ENTRIES", "2000"))
+SEARCH_RESULTS_TTL_SECONDS = int(os.environ.get("SEARCH_RESULTS_TTL_SECONDS", str(6 * 3600)))
+SEARCH_QUERIES_TTL_SECONDS = int(os.environ.get("SEARCH_QUERIES_TTL_SECONDS", str(24 * 3600)))
+
+class MemoryTTLCache:
+    """Thread-safe in-process TTL cache with LRU eviction by entry count."""
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # key -> (expires_at, value)
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry[1]
+
+    def put(self, key, value, ttl_seconds):
+        with self._lock:
+            self._entries[key] = (time.time() + ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "entries": len(self._entries)}
+
+class SQLiteTTLCache:
+    """TTL cache persisted in SQLite (shared across processes), LRU-evicted by entry count per namespace."""
+    def __init__(self, path, namespace, max_entries):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS ttl_cache (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                last_accessed REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_ttl_cache_lru ON ttl_cache (namespace, last_accessed)")
+        self._conn.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM ttl_cache WHERE namespace = ? AND key = ? AND expires_at > ?", (self.namespace, key, now)
+            ).fetchone()
+            if row is None:
+                self._stats["misses"] += 1
+                return None
+            self._conn.execute("UPDATE ttl_cache SET last_accessed = ? WHERE namespace = ? AND key = ?", (now, self.namespace, key))
+            self._conn.commit()
+            self._stats["hits"] += 1
+        return json.loads(row[0])
+
+    def put(self, key, value, ttl_seconds):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO ttl_cache (namespace, key, value, expires_at, last_accessed) VALUES (?, ?, ?, ?, ?)",
+                (self.namespace, key, json.dumps(value), now + ttl_seconds, now)
+            )
+            self._conn.execute("DELETE FROM ttl_cache WHERE namespace = ? AND expires_at <= ?", (self.namespace, now))
+            excess = self._conn.execute("SELECT COUNT(*) FROM ttl_cache WHERE namespace = ?", (self.namespace,)).fetchone()[0] - self.max_entries
+            if excess > 0:
+                self._conn.execute(
+                    "DELETE FROM ttl_cache WHERE namespace = ? AND key IN "
+                    "(SELECT key FROM ttl_cache WHERE namespace = ? ORDER BY last_accessed ASC LIMIT ?)",
+                    (self.namespace, self.namespace, excess)
+                )
+                self._stats["evictions"] += excess
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM ttl_cache WHERE namespace = ?", (self.namespace,)).fetchone()[0]
+            return {**self._stats, "entries": entries}
+
+def create_ttl_cache(namespace):
+    """Build a cache for `namespace` using the configured SEARCH_CACHE_BACKEND (None when disabled)."""
+    if SEARCH_CACHE_BACKEND == "none":
+        return None
+    if SEARCH_CACHE_BACKEND == "sqlite":
+        try:
+            return SQLiteTTLCache(SEARCH_CACHE_PATH, namespace, SEARCH_CACHE_MAX_ENTRIES)
+        except Exception as e:
+            print(f"Warning: Could not open {SEARCH_CACHE_PATH} for {namespace} cache, falling back to memory: {e}")
+    return MemoryTTLCache(SEARCH_CACHE_MAX_ENTRIES)
+
+search_results_cache = create_ttl_cache("search_results")
+search_queries_cache = create_ttl_cache("search_queries")
+
+def _cache_key(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+def get_search_cache_stats():
+    """Hit/miss counters; every hit is one Custom Search request (or Gemini call) not spent."""
+    stats = {"backend": SEARCH_CACHE_BACKEND}
+    if search_results_cache:
+        results_stats = search_results_cache.stats()
+        stats["search_results"] = results_stats
+        stats["custom_search_requests_saved"] = results_stats["hits"]
+    if search_queries_cache:
+        queries_stats = search_queries_cache.stats()
+        stats["search_queries"] = queries_stats
+        stats["gemini_query_generations_saved"] = queries_stats["hits"]
+    return stats
+
+# --- Retrieval Index (chunking + BM25 over notes and original text) ---
+RETRIEVAL_ENABLED = os.environ.get("RETRIEVAL_ENABLED", "true").lower() == "true"
+RETRIEVAL_CHUNK_CHARS = int(os.environ.get("RETRIEVAL_CHUNK_CHARS", "1200"))
+RETRIEVAL_CHUNK_OVERLAP_CHARS = int(os.environ.get("RETRIEVAL_CHUNK_OVERLAP_CHARS", "150"))
+RETRIEVAL_INDEX_CACHE_ENTRIES = int(os.environ.get("RETRIEVAL_INDEX_CACHE_ENTRIES", "64"))
+QUIZ_CONTEXT_TOKEN_BUDGET = int(os.environ.get("QUIZ_CONTEXT_TOKEN_BUDGET", "3000"))
+FLASHCARD_CONTEXT_TOKEN_BUDGET = int(os.environ.get("FLASHCARD_CONTEXT_TOKEN_BUDGET", "2500"))
+CHAT_CONTEXT_TOKEN_BUDGET = int(os.environ.get("CHAT_CONTEXT_TOKEN_BUDGET", "3000"))
+CHARS_PER_TOKEN = 4 # Rough estimate for English prose
+
+SEARCH_STOPWORDS = frozenset("""
+a an and are as at be but by for from has have how in is it its of on or that the their then there these this
+to was were what when where which who why will with you your i we they he she not no do does did can could
+""".split())
+
+def estimate_tokens(text):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN if text else 0
+
+def tokenize_for_search(text):
+    return [t for t in re.findall(r"[a-z0-9]+", text.lower()) if t not in SEARCH_STOPWORDS and len(t) > 1]
+
+def chunk_text(text, source, chunk_chars=None, overlap_chars=None):
+    """
+    Split text into ~chunk_chars chunks on paragraph boundaries; paragraphs longer than
+    a chunk are hard-split with overlap_chars of overlap. Returns [{"source", "position", "text"}].
+    """
+    chunk_chars = chunk_chars or RETRIEVAL_CHUNK_CHARS
+    overlap_chars = RETRIEVAL_CHUNK_OVERLAP_CHARS if overlap_chars is None else overlap_chars
+    pieces = []
+    for paragraph in re.split(r"\n\s*\n", text or ""):
+        paragraph = paragraph.strip()
+        if len(paragraph) <= chunk_chars:
+            if paragraph:
+                pieces.append(paragraph)
+            continue
+        step = max(1, chunk_chars - overlap_chars)
+        pieces.extend(paragraph[i:i + chunk_chars] for i in range(0, len(paragraph), step) if paragraph[i:i + chunk_chars].strip())
+
+    chunks = []
+    current = ""
+    for piece in pieces:
+        if current and len(current) + len(piece) + 2 > chunk_chars:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return [{"source": source, "position": i, "text": chunk} for i, chunk in enumerate(chunks)]
+
+class BM25Index:
+    """
+    Okapi BM25 over text chunks. Postings are plain dicts/lists so the index can be
+    stored with the study session and reloaded without re-tokenizing.
+    """
+    def __init__(self, chunks, postings=None, doc_lengths=None, k1=1.5, b=0.75):
+        self.chunks = chunks
+        self.k1 = k1
+        self.b = b
+        if postings is None:
+            postings = {}
+            doc_lengths = []
+            for chunk_id, chunk in enumerate(chunks):
+                terms = tokenize_for_search(chunk["text"])
+                doc_lengths.append(len(terms))
+                term_counts = {}
+                for term in terms:
+                    term_counts[term] = term_counts.get(term, 0) + 1
+                for term, tf in term_counts.items():
+                    postings.setdefault(term, []).append([chunk_id, tf])
+        self.postings = postings # term -> [[chunk_id, term_frequency], ...]
+        self.doc_lengths = doc_lengths
+        self.avg_doc_length = (sum(doc_lengths) / len(doc_lengths)) if doc_lengths else 0.0
+
+    def scores(self, query):
+        """Return {chunk_id: score} for chunks matching any query term."""
+        n_docs = len(self.chunks)
+        scores = {}
+        for term in set(tokenize_for_search(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for chunk_id, tf in postings:
+                length_norm = 1 - self.b + self.b * (self.doc_lengths[chunk_id] / self.avg_doc_length if self.avg_doc_length else 1)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + self.k1 * length_norm)
+        return scores
+
+    def to_dict(self):
+        return {"chunks": self.chunks, "postings": self.postings, "doc_lengths": self.doc_lengths}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["chunks"], data["postings"], data["doc_lengths"])
+
+retrieval_index_cache = MemoryTTLCache(RETRIEVAL_INDEX_CACHE_ENTRIES)
+
+def build_retrieval_index(notes, original_text):
+    return BM25Index(chunk_text(notes, "notes") + chunk_text(original_text, "original"))
+
+def get_retrieval_index(context):
+    """
+    Return the BM25 index for a study context (see load_study_context), or None when
+    retrieval is disabled. Indexes are built once per session: kept in memory, stored
+    with the session, and only rebuilt for sessions that did not come from the store.
+    """
+    if not RETRIEVAL_ENABLED or not (context.get('notes') or context.get('original_text')):
+        return None
+    content_id = context.get('content_id')
+    stored = bool(content_id and context.get('from_store'))
+    if stored:
+        index = retrieval_index_cache.get(content_id)
+        if index is not None:
+            return index
+        index_data = study_session_store.get_index(content_id)
+        if index_data is not None:
+            index = BM25Index.from_dict(index_data)
+            retrieval_index_cache.put(content_id, index, SESSION_TTL_SECONDS)
+            return index
+    index = build_retrieval_index(context.get('notes') or "", context.get('original_text') or "")
+    if stored:
+        retrieval_index_cache.put(content_id, index, SESSION_TTL_SECONDS)
+        study_session_store.put_index(content_id, index.to_dict())
+    return index
+
+def retrieve_study_context(index, query, token_budget, avoid_text="", fill=False):
+    """
+    Pick the chunks most relevant to query within token_budget and return
+    (notes_snippet, original_text_snippet) with chunks in document order.
+    Chunks that match avoid_text (e.g. existing questions) are demoted so repeated
+    calls move on to material not covered yet. With fill=True (or when nothing
+    matches) the remaining budget is filled with unmatched chunks in document order.
+    Small documents are returned whole.
+    """
+    chunks = index.chunks
+    total_tokens = sum(estimate_tokens(c["text"]) for c in chunks)
+    if total_tokens <= token_budget:
+        selected = list(range(len(chunks)))
+    else:
+        scores = index.scores(query) if query else {}
+        if avoid_text:
+            for chunk_id, penalty in index.scores(avoid_text).items():
+                scores[chunk_id] = scores.get(chunk_id, 0.0) - 0.5 * penalty
+        ranked = sorted((i for i in scores if scores[i] > 0), key=lambda i: -scores[i])
+        if fill or not ranked:
+            # Unmatched chunks in document order (notes before original text), demoted chunks last
+            ranked += [i for i in range(len(chunks)) if i not in scores]
+            ranked += sorted((i for i in scores if scores[i] <= 0), key=lambda i: -scores[i])
+        selected = []
+        used_tokens = 0
+        for chunk_id in ranked:
+            chunk_tokens = estimate_tokens(chunks[chunk_id]["text"])
+            if used_tokens + chunk_tokens > token_budget:
+                continue
+            selected.append(chunk_id)
+            used_tokens += chunk_tokens
+    selected.sort()
+    notes_snippet = "\n\n[...]\n\n".join(chunks[i]["text"] for i in selected if chunks[i]["source"] == "notes")
+    original_snippet = "\n\n[...]\n\n".join(chunks[i]["text"] for i in selected if chunks[i]["source"] == "original")
+    return notes_snippet, original_snippet
+
+def coverage_query(notes):
+    """Query made of the notes' headings and bold key terms, used when there is no user question."""
+    headings = re.findall(r"^\s*#{1,6}\s*(.+)$", notes or "", flags=re.MULTILINE)
+    key_terms = re.findall(r"\*\*([^*\n]{2,80})\*\*", notes or "")
+    return " ".join(headings + key_terms)
+
+# --- Prompt Budgets (token accounting per task and source) ---
+PROMPT_TOKEN_COUNTER = os.environ.get("PROMPT_TOKEN_COUNTER", "estimate").lower() # "estimate" (chars / CHARS_PER_TOKEN) or "gemini" (count_tokens calls)
+
+# Per-task input-token caps by prompt source. "files" is charged but never trimmed; "total"
+# (None = unbounded) lets charged sources squeeze the trimmable ones. Override any entry
+# with PROMPT_BUDGET_<TASK>_<SOURCE>, e.g. PROMPT_BUDGET_NOTES_WEB=8000 or PROMPT_BUDGET_CHAT_TOTAL=12000.
+PROMPT_BUDGET_SOURCES = ("user_context", "text", "files", "web", "history")
+DEFAULT_PROMPT_BUDGETS = {
+    "notes": {"user_context": 1000, "text": 7500, "web": 5000},
+    "search_queries": {"text": 500},
+    "quiz": {"text": QUIZ_CONTEXT_TOKEN_BUDGET, "history": 1000},
+    "flashcards": {"text": FLASHCARD_CONTEXT_TOKEN_BUDGET, "history": 2000},
+    "mindmap": {"text": 7500},
+    "chat": {"text": 4000, "web": 1250, "history": 8000}, # Retrieved excerpts are further capped at CHAT_CONTEXT_TOKEN_BUDGET
+    "evaluate": {"text": 1250},
+}
+
+def _load_prompt_budgets():
+    budgets = {}
+    for task, caps in DEFAULT_PROMPT_BUDGETS.items():
+        caps = dict(caps, total=None)
+        for source in PROMPT_BUDGET_SOURCES + ("total",):
+            override = os.environ.get(f"PROMPT_BUDGET_{task.upper()}_{source.upper()}")
+            if override:
+                caps[source] = int(override)
+        budgets[task] = caps
+    return budgets
+
+PROMPT_BUDGETS = _load_prompt_budgets()
+
+class PromptBudget:
+    """
+    Token allocation for one prompt. charge() accounts for content that is sent as-is
+    (files, user context); fit()/fit_items() trim trimmable sources to what their cap
+    and the task total still allow.
+    """
+    def __init__(self, manager, task):
+        self.manager = manager
+        self.task = task
+        self.caps = PROMPT_BUDGETS.get(task, {"total": None})
+        self.used = Counter()
+        self.truncated = Counter()
+
+    def tokens_for(self, source):
+        """Tokens still available to source (its cap minus what it used, bounded by the task total)."""
+        cap = self.caps.get(source)
+        available = math.inf if cap is None else cap - self.used[source]
+        if self.caps.get("total") is not None:
+            available = min(available, self.caps["total"] - sum(self.used.values()))
+        return max(0, available)
+
+    def char_budget(self, source):
+        tokens = self.tokens_for(source)
+        return None if tokens == math.inf else tokens * CHARS_PER_TOKEN
+
+    def charge(self, source, content):
+        tokens = self.manager.count_tokens(content, self.task)
+        self.used[source] += tokens
+        return tokens
+
+    def fit(self, source, text, max_tokens=None):
+        """Return text cut to the source's remaining budget (or max_tokens, if smaller) and charge it."""
+        text = text or ""
+        tokens = self.tokens_for(source)
+        if max_tokens is not None:
+            tokens = min(tokens, max_tokens)
+        if tokens != math.inf and len(text) > tokens * CHARS_PER_TOKEN:
+            text = text[:int(tokens * CHARS_PER_TOKEN)]
+            self.truncated[source] += 1
+        self.charge(source, text)
+        return text
+
+    def fit_items(self, source, items, text_of=str):
+        """Keep the most recent items (in order) whose combined size fits the source's budget, and charge them."""
+        available = self.tokens_for(source)
+        kept, used = [], 0
+        for item in reversed(items):
+            tokens = estimate_tokens(text_of(item))
+            if used + tokens > available:
+                self.truncated[source] += 1
+                break
+            kept.append(item)
+            used += tokens
+        kept.reverse()
+        self.used[source] += used
+        return kept
+
+    def finish(self):
+        """Record this prompt's allocation in the manager's stats; returns the prompt's total tokens."""
+        self.manager.record_allocation(self.task, self.used, self.truncated)
+        return sum(self.used.values())
+
+class PromptBudgetManager:
+    """Counts prompt tokens, hands out per-task PromptBudgets and aggregates usage_metadata per task."""
+    def __init__(self, counter):
+        self.counter = counter
+        self._lock = threading.Lock()
+        self._stats = {} # task -> {"prompts", "budgeted_tokens", "sources", "truncations", "calls", "prompt_tokens", ...}
+
+    def start(self, task):
+        return PromptBudget(self, task)
+
+    def count_tokens(self, content, task=None):
+        """Tokens for a string or an uploaded file. Files count as 0 unless PROMPT_TOKEN_COUNTER=gemini."""
+        if self.counter == "gemini":
+            try:
+                return get_model(task or "notes").count_tokens(content).total_tokens
+            except Exception as e:
+                print(f"Warning: count_tokens failed, falling back to the estimate: {e}")
+        return estimate_tokens(content) if isinstance(content, str) else 0
+
+    def _task_stats(self, task):
+        return self._stats.setdefault(task, {
+            "prompts": 0, "budgeted_tokens": 0, "sources": Counter(), "truncations": Counter(),
+            "calls": 0, "prompt_tokens": 0, "output_tokens": 0, "cached_tokens": 0, "total_tokens": 0,
+        })
+
+    def record_allocation(self, task, used, truncated):
+        with self._lock:
+            stats = self._task_stats(task)
+            stats["prompts"] += 1
+            stats["budgeted_tokens"] += sum(used.values())
+            stats["sources"].update(used)
+            stats["truncations"].update(truncated)
+
+    def record_usage(self, task, usage_metadata):
+        """Add a response's usage_metadata (prompt, output and cached token counts) to the task's totals."""
+        if usage_metadata is None:
+            return
+        with self._lock:
+            stats = self._task_stats(task)
+            stats["calls"] += 1
+            stats["prompt_tokens"] += getattr(usage_metadata, 'prompt_token_count', 0) or 0
+            stats["output_tokens"] += getattr(usage_metadata, 'candidates_token_count', 0) or 0
+            stats["cached_tokens"] += getattr(usage_metadata, 'cached_content_token_count', 0) or 0
+            stats["total_tokens"] += getattr(usage_metadata, 'total_token_count', 0) or 0
+
+    def stats(self):
+        with self._lock:
+            return {task: {k: dict(v) if isinstance(v, Counter) else v for k, v in stats.items()}
+                    for task, stats in self._stats.items()}
+
+    def render_metrics(self):
+        """Prometheus lines for token usage reported by Gemini, per task and kind."""
+        lines = [
+            "# HELP study_assistant_llm_tokens_total Tokens reported in Gemini usage_metadata per task.",
+            "# TYPE study_assistant_llm_tokens_total counter",
+        ]
+        for task, stats in sorted(self.stats().items()):
+            for kind in ("prompt", "output", "cached", "total"):
+                lines.append(f"study_assistant_llm_tokens_total{_format_labels(('task', 'kind'), (task, kind))} {stats[kind + '_tokens']}")
+        return "\n".join(lines) + "\n"
+
+prompt_budgets = PromptBudgetManager(PROMPT_TOKEN_COUNTER)
+
+def get_prompt_budget_stats():
+    return prompt_budgets.stats()
+
+# --- Web Search Helper Functions (Keep as is, but check SEARCH_ENGINE_ID usage) ---
+@traced_stage("search")
 def search_web(query, num_results=5):
     """Search with retries and better error handling"""
-    if not SEARCH_ENGINE_ID or not os.environ.get("GOOGLE_API_KEY"):
+    if not SEARCH_ENGINE_ID or not (web_client or os.environ.get("GOOGLE_API_KEY")):
         print("Warning: Web search disabled. Missing GOOGLE_API_KEY or SEARCH_ENGINE_ID.")
         return []
     url = "https://www.googleapis.com/customsearch/v1"
@@ -73,82 +2132,230 @@ def search_web(query, num_results=5):
         "num": num_results,
     }
 
-    session = create_http_session()
+    cache_key = _cache_key(" ".join(query.lower().split()), num_results)
+    if search_results_cache:
+        cached = search_results_cache.get(cache_key)
+        current_stage_span().set(cache_hit=cached is not None)
+        if cached is not None:
+            print(f"Search cache hit for '{query}'")
+            return cached
+
+    try:
+        custom_search_rate_limiter.acquire({"requests": 1, "requests_per_minute": 1}, PRIORITY_STANDARD,
+                                           max_wait=RATE_LIMIT_MAX_WAIT_SECONDS[PRIORITY_INTERACTIVE])
+    except RateLimitExceeded as e:
+        print(f"Search skipped for '{query}': {e}")
+        return []
+
+    session = web_client or get_http_session()
     try:
         response = session.get(url, params=params, timeout=10)
+        if response.status_code == 429:
+            delay = retry_after_from_response(response) or 60
+            print(f"Search quota hit; pausing Custom Search for {delay:g}s")
+            custom_search_rate_limiter.pause(delay)
         response.raise_for_status()
         results = response.json()
         # Return link and snippet for better context
-        return [{"link": item['link'], "snippet": item.get('snippet', '')} for item in results.get('items', [])]
+        items = [{"link": item['link'], "snippet": item.get('snippet', '')} for item in results.get('items', [])]
+        current_stage_span().set(results=len(items))
+        if items and search_results_cache:
+            search_results_cache.put(cache_key, items, SEARCH_RESULTS_TTL_SECONDS)
+        return items
     except Exception as e:
         print(f"Search error: {str(e)}")
+        current_stage_span().set(error=str(e))
         return []
 
-def fetch_page_content(url):
-    """Fetch content with better headers and timeout handling"""
+PAGE_FETCH_MAX_BYTES = int(os.environ.get("PAGE_FETCH_MAX_BYTES", str(1024 * 1024))) # Stop reading bodies after ~1 MB
+PAGE_TEXT_MAX_CHARS = 15000
+
+PAGE_REQUEST_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "en-US,en;q=0.5",
+    "Accept-Encoding": "gzip, deflate",
+    "Connection": "keep-alive",
+    "Referer": "https://www.google.com/"
+}
+
+def _read_capped_body(response, max_bytes):
+    """Read a streamed response body up to max_bytes. Returns (body_bytes, truncated)."""
+    chunks = []
+    total = 0
+    truncated = False
+    for chunk in response.iter_content(chunk_size=64 * 1024):
+        if not chunk: continue
+        chunks.append(chunk)
+        total += len(chunk)
+        if total >= max_bytes:
+            truncated = True
+            break
+    return b"".join(chunks)[:max_bytes], truncated
+
+def extract_page_title(soup):
+    """Return og:title or <title> text from a parsed page, or None."""
+    meta_title = soup.find('meta', property='og:title')
+    if meta_title and meta_title.get('content'):
+        return meta_title['content'].strip()
+    title_tag = soup.find('title')
+    if title_tag and title_tag.text:
+        return title_tag.text.strip()
+    return None
+
+def extract_page_text(soup):
+    """Extract the main readable text from a parsed page (mutates soup)."""
+    # More robust content extraction
+    for element in soup(['script', 'style', 'nav', 'footer', 'header', 'form', 'aside', 'figure', 'img']):
+        element.decompose()
+
+    # Try common main content tags
+    main_content = soup.find('article') or soup.find('main') or soup.find('div', role='main') or soup.find('div', class_=re.compile("content|main|post|body", re.I)) or soup.body
+
+    text_parts = []
+    if main_content:
+         # Prioritize text within paragraphs, headings, list items
+        for element in main_content.find_all(['p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'li', 'pre', 'code', 'blockquote', 'td'], recursive=True):
+             # Get text, strip whitespace, handle None case
+            element_text = element.get_text(separator=' ', strip=True)
+            if element_text:
+                text_parts.append(element_text)
+    else:
+         # Fallback: Get all text from body if specific tags fail
+        body_text = soup.body.get_text(separator=' ', strip=True) if soup.body else ""
+        if body_text:
+             text_parts.append(body_text)
+
+    full_text = '\n'.join(text_parts)
+    # Remove excessive blank lines
+    full_text = re.sub(r'\n\s*\n', '\n\n', full_text)
+    return full_text[:PAGE_TEXT_MAX_CHARS]  # Limit to 15k characters
+
+def fetch_page(url, timeout=15, max_bytes=None, validators=None):
+    """
+    Fetch a page once and parse it once.
+    Returns {"text", "title", "metadata"}; on failure "text" is empty and "error" is set.
+    If validators (etag/last_modified) are given and the server answers 304, "not_modified" is True.
+    """
+    if max_bytes is None:
+        max_bytes = PAGE_FETCH_MAX_BYTES
+    result = {"text": "", "title": None, "metadata": {}}
+    headers = dict(PAGE_REQUEST_HEADERS)
+    if validators:
+        if validators.get("etag"): headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"): headers["If-Modified-Since"] = validators["last_modified"]
     try:
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-            "Accept-Language": "en-US,en;q=0.5",
-            "Accept-Encoding": "gzip, deflate",
-            "Connection": "keep-alive",
-            "Referer": "https://www.google.com/"
-        }
-        session = create_http_session()
-        response = session.get(url, headers=headers, timeout=15)
-        response.raise_for_status() # Check for HTTP errors
-
-        content_type = response.headers.get('Content-Type', '')
-        if 'text/html' not in content_type:
-            print(f"Skipping non-HTML content at {url}")
-            return "" # Skip non-html content
-
-        soup = BeautifulSoup(response.content, 'html.parser')
-        # More robust content extraction
-        for element in soup(['script', 'style', 'nav', 'footer', 'header', 'form', 'aside', 'figure', 'img']):
-            element.decompose()
-
-        # Try common main content tags
-        main_content = soup.find('article') or soup.find('main') or soup.find('div', role='main') or soup.find('div', class_=re.compile("content|main|post|body", re.I)) or soup.body
-
-        text_parts = []
-        if main_content:
-             # Prioritize text within paragraphs, headings, list items
-            for element in main_content.find_all(['p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'li', 'pre', 'code', 'blockquote', 'td'], recursive=True):
-                 # Get text, strip whitespace, handle None case
-                element_text = element.get_text(separator=' ', strip=True)
-                if element_text:
-                    text_parts.append(element_text)
-        else:
-             # Fallback: Get all text from body if specific tags fail
-            body_text = soup.body.get_text(separator=' ', strip=True) if soup.body else ""
-            if body_text:
-                 text_parts.append(body_text)
-
-        full_text = '\n'.join(text_parts)
-        # Remove excessive blank lines
-        full_text = re.sub(r'\n\s*\n', '\n\n', full_text)
-        return full_text[:15000]  # Limit to 15k characters
+        session = web_client or get_http_session()
+        with session.get(url, headers=headers, timeout=timeout, stream=True) as response:
+            if response.status_code == 304:
+                result["not_modified"] = True
+                return result
+            response.raise_for_status() # Check for HTTP errors
+
+            content_type = response.headers.get('Content-Type', '')
+            result["metadata"] = {
+                "final_url": response.url,
+                "content_type": content_type,
+                "etag": response.headers.get('ETag'),
+                "last_modified": response.headers.get('Last-Modified'),
+            }
+            if 'text/html' not in content_type:
+                print(f"Skipping non-HTML content at {url}")
+                result["error"] = f"Non-HTML content ({content_type or 'unknown type'})"
+                return result # Skip non-html content
+
+            body, truncated = _read_capped_body(response, max_bytes)
+
+        result["metadata"]["bytes_read"] = len(body)
+        result["metadata"]["truncated"] = truncated
+        current_stage_span().set(bytes=len(body))
+        if truncated:
+            print(f"Stopped reading {url} after {len(body)} bytes (cap {max_bytes}).")
+
+        with stage_span("html_parse", bytes=len(body)) as parse_span:
+            soup = BeautifulSoup(body, 'html.parser')
+            result["title"] = extract_page_title(soup)
+            meta_description = soup.find('meta', attrs={'name': 'description'}) or soup.find('meta', property='og:description')
+            if meta_description and meta_description.get('content'):
+                result["metadata"]["description"] = meta_description['content'].strip()
+            result["text"] = extract_page_text(soup)
+            parse_span.set(chars=len(result["text"]))
+        return result
     except requests.exceptions.RequestException as e:
         print(f"Network error fetching {url}: {str(e)}")
-        return ""
+        result["error"] = f"Network error: {str(e)}"
+        return result
     except Exception as e:
         print(f"Error processing {url}: {str(e)}")
-        return ""
+        result["error"] = str(e)
+        return result
+
+def cached_fetch_page(url):
+    """fetch_page() backed by the extraction cache, revalidating stale entries with ETag/Last-Modified."""
+    if not extraction_cache:
+        return fetch_page(url)
+    cache_key = f"url:{normalize_url(url)}"
+    try:
+        cached, is_fresh, validators = extraction_cache.get(cache_key)
+    except Exception as e:
+        print(f"Warning: Extraction cache lookup failed for {url}: {e}")
+        return fetch_page(url)
+    current_stage_span().set(cache_hit=cached is not None and is_fresh)
+    if cached is not None and is_fresh:
+        return cached
+
+    has_validators = validators and (validators.get("etag") or validators.get("last_modified"))
+    page = fetch_page(url, validators=validators if (cached is not None and has_validators) else None)
+    if page.get("not_modified"):
+        print(f"Cache revalidated (304) for {url}")
+        extraction_cache.refresh(cache_key, EXTRACTION_CACHE_TTL_SECONDS)
+        return cached
+    if page["text"] and not page.get("error"):
+        try:
+            extraction_cache.put(
+                cache_key, page, EXTRACTION_CACHE_TTL_SECONDS,
+                etag=page["metadata"].get("etag"), last_modified=page["metadata"].get("last_modified")
+            )
+        except Exception as e:
+            print(f"Warning: Failed to store {url} in extraction cache: {e}")
+    return page
+
+@traced_stage("page_fetch")
+def fetch_page_content(url):
+    """Fetch a page and return only its main text ("" on failure)."""
+    page = cached_fetch_page(url)
+    current_stage_span().set(chars=len(page["text"]), error=page.get("error"))
+    return page["text"]
 
+@traced_stage("query_generation")
 def generate_search_queries(context_text, num_queries=3):
-    """Generate relevant search queries using Gemini."""
+    """Generate relevant search queries using Gemini, cached by a fingerprint of the context."""
+    # Only the budgeted head of the context reaches the prompt, so it fully determines the output
+    budget = prompt_budgets.start("search_queries")
+    context_text = budget.fit("text", context_text)
+    budget.finish()
+    cache_key = _cache_key(DEFAULT_GEMINI_MODEL, context_text, num_queries)
+    if search_queries_cache:
+        cached = search_queries_cache.get(cache_key)
+        current_stage_span().set(cache_hit=cached is not None)
+        if cached is not None:
+            print("Search query cache hit.")
+            return cached
+    queries = _generate_search_queries(context_text, num_queries)
+    if queries and search_queries_cache:
+        search_queries_cache.put(cache_key, queries, SEARCH_QUERIES_TTL_SECONDS)
+    return queries
+
+def _generate_search_queries(context_text, num_queries):
     prompt = f"""
     Context:
-    {context_text[:2000]} # Limit context for query generation
+    {context_text}
 
     Based on the context provided above, generate {num_queries} distinct and relevant search queries to find additional information that could enhance understanding of the topic. Focus on key concepts, ambiguities, or areas needing elaboration present in the text.
     Return the queries as a JSON array of strings, for example: ["query1", "query2", "query3"].
-    Ensure the response is ONLY the valid JSON array and nothing else.
     """
     try:
-        response = model.generate_content(prompt)
+        response = gemini_generate(get_model("search_queries", generation_config=structured_output_config(SEARCH_QUERIES_SCHEMA)), prompt, task="search_queries")
         if not response.candidates:
             print("No candidates in search query response")
             return []
@@ -166,33 +2373,12 @@ def generate_search_queries(context_text, num_queries=3):
                  return []
 
 
-        # Improved JSON parsing
-        cleaned_text = text.strip()
-        if cleaned_text.startswith("```json"):
-            cleaned_text = cleaned_text[7:]
-        if cleaned_text.endswith("```"):
-            cleaned_text = cleaned_text[:-3]
-        cleaned_text = cleaned_text.strip()
-
+        # JSON mode with a response schema: the text is the array itself
         try:
-            queries = json.loads(cleaned_text)
-            if isinstance(queries, list) and all(isinstance(q, str) for q in queries):
-                return queries[:num_queries] # Ensure correct number
-            else:
-                print(f"Invalid query format received: {cleaned_text}")
-                # Attempt to extract queries if format is slightly off
-                found_queries = re.findall(r'"(.*?)"', cleaned_text)
-                if found_queries and len(found_queries) <= num_queries:
-                    print(f"Attempting recovery, extracted: {found_queries}")
-                    return found_queries
-                return []
-        except json.JSONDecodeError as e:
-            print(f"Error parsing search queries JSON: {cleaned_text}, Error: {str(e)}")
-            # Attempt regex extraction as fallback
-            found_queries = re.findall(r'"(.*?)"', cleaned_text)
-            if found_queries and len(found_queries) <= num_queries:
-                 print(f"JSON failed, attempting recovery, extracted: {found_queries}")
-                 return found_queries
+            queries = parse_structured_output(text, validate_search_queries)
+            return queries[:num_queries] # Ensure correct number
+        except (json.JSONDecodeError, SchemaValidationError) as e:
+            print(f"Invalid search queries JSON: {text[:200]}, Error: {str(e)}")
             return []
     except Exception as e:
         print(f"Error generating search queries with Gemini: {str(e)}")
@@ -200,6 +2386,61 @@ def generate_search_queries(context_text, num_queries=3):
         if "API key not valid" in str(e):
              print("Please check your GOOGLE_API_KEY.")
         return []
+WEB_SEARCH_MAX_WORKERS = int(os.environ.get("WEB_SEARCH_MAX_WORKERS", "6"))
+WEB_SEARCH_DEADLINE_SECONDS = float(os.environ.get("WEB_SEARCH_DEADLINE_SECONDS", "30"))
+
+def gather_web_context(search_queries, results_per_query, ref_label, format_entry, context, char_budget):
+    """
+    Run all searches concurrently, then fetch every candidate page concurrently.
+    Pages are consumed in query/result order so "[{ref_label} N]" numbering matches a
+    serial run; once `context` grows past char_budget the remaining fetches are cancelled.
+    format_entry(source_ref, url_data, content) returns the text appended per source.
+    Returns (context, web_sources_list).
+    """
+    web_sources_list = []
+    if not search_queries:
+        return context, web_sources_list
+    deadline = time.time() + WEB_SEARCH_DEADLINE_SECONDS
+    executor = ThreadPoolExecutor(max_workers=WEB_SEARCH_MAX_WORKERS, thread_name_prefix="web-search")
+    try:
+        # --- Stage 1: searches ---
+        print(f"Searching for: {search_queries}")
+        search_futures = [submit_in_context(executor, search_web, query, results_per_query) for query in search_queries]
+        candidates = []
+        processed_urls = set()
+        for query, future in zip(search_queries, search_futures):
+            try:
+                urls_data = future.result(timeout=max(0, deadline - time.time()))
+            except Exception as e:
+                print(f"Search for '{query}' failed or timed out: {e}")
+                continue
+            print(f"Found URLs for '{query}': {[u['link'] for u in urls_data]}")
+            for url_data in urls_data:
+                if url_data['link'] in processed_urls: continue
+                processed_urls.add(url_data['link'])
+                candidates.append(url_data)
+
+        # --- Stage 2: page fetches ---
+        fetch_futures = [submit_in_context(executor, fetch_page_content, url_data['link']) for url_data in candidates]
+        source_counter = 1
+        for url_data, future in zip(candidates, fetch_futures):
+            try:
+                content = future.result(timeout=max(0, deadline - time.time()))
+            except Exception as e:
+                print(f"Fetching {url_data['link']} failed or timed out: {e}")
+                continue
+            if content:
+                source_ref = f"{ref_label} {source_counter}"
+                web_sources_list.append({"ref": source_ref, "url": url_data['link']})
+                context += format_entry(source_ref, url_data, content)
+                source_counter += 1
+                if len(context) > char_budget:
+                    print("Web context limit reached.")
+                    break
+        return context, web_sources_list
+    finally:
+        # Outstanding fetches are no longer needed once the budget is filled
+        executor.shutdown(wait=False, cancel_futures=True)
 
 
 # --- Content Processing Functions ---
@@ -245,7 +2486,7 @@ def extract_from_youtube(url):
     """Extract content from YouTube video with better transcript and connection error handling"""
     try:
         video_id = extract_video_id(url)
-        api = YouTubeTranscriptApi()
+        api = transcript_api_class()
 
         # --- Try fetching transcripts ---
         try:
@@ -334,7 +2575,7 @@ def extract_from_youtube(url):
         title = f"YouTube Video (ID: {video_id})"
         try:
             video_url = f"https://www.youtube.com/watch?v={video_id}"
-            session = create_http_session()
+            session = web_client or get_http_session()
             response = session.get(video_url, headers={"User-Agent": "Mozilla/5.0", "Accept-Language": "en-US,en;q=0.5"}, timeout=10) # Increased timeout slightly
             response.raise_for_status()
             soup = BeautifulSoup(response.content, 'html.parser')
@@ -371,10 +2612,13 @@ def extract_from_youtube(url):
         print(error_msg)
         return {"error": error_msg}
 
+@traced_stage("url_fetch")
 def extract_from_website(url):
-    """Extract text content from a website URL"""
+    """Extract text content and title from a website URL with a single fetch"""
     try:
-        content = fetch_page_content(url)
+        page = cached_fetch_page(url)
+        content = page["text"]
+        current_stage_span().set(chars=len(content), error=page.get("error"))
         if not content:
             # Check if URL might be a direct link to PDF, etc.
             parsed_url = urlparse(url)
@@ -382,40 +2626,424 @@ def extract_from_website(url):
                  return {"error": f"Direct file link detected ({url}). Please upload files directly."}
             return {"error": f"No extractable text content found at {url}. The page might be dynamic (JavaScript-heavy) or empty."}
 
-        # Try to get a better title
-        title = f"Website: {urlparse(url).netloc}" # Default title
-        try:
-            # Re-fetch small part just for title (or use previous response if cached/efficient)
-            session = create_http_session()
-            response = session.get(url, headers={"User-Agent": "Mozilla/5.0"}, timeout=5, stream=True) # Stream to get head quickly
-            response.raise_for_status()
-            # Read only enough to find the title
-            html_head = response.raw.read(2048).decode('utf-8', errors='ignore')
-            response.close()
-            soup = BeautifulSoup(html_head, 'html.parser')
-            title_tag = soup.find('title')
-            meta_title = soup.find('meta', property='og:title')
-            if meta_title and meta_title.get('content'):
-                title = meta_title['content'].strip()
-            elif title_tag and title_tag.text:
-                 title = title_tag.text.strip()
-
-        except Exception as title_e:
-            print(f"Could not fetch website title for {url}: {title_e}")
-
+        title = page["title"] or f"Website: {urlparse(url).netloc}" # Default title
 
         return {
             "title": title,
             "text": content,
             "source": url,
-            "type": "website"
+            "type": "website",
+            "metadata": page["metadata"]
         }
     except Exception as e:
         print(f"Website processing failed for {url}: {str(e)}")
         return {"error": f"Website processing failed: {str(e)}"}
 
-def upload_file_to_gemini(file_storage):
-    """Uploads a file to Gemini API and returns the file object upon success."""
+# --- Concurrent URL Ingestion ---
+URL_INGEST_MAX_WORKERS = int(os.environ.get("URL_INGEST_MAX_WORKERS", "8"))
+URL_INGEST_PER_HOST_LIMIT = int(os.environ.get("URL_INGEST_PER_HOST_LIMIT", "2"))
+URL_INGEST_DEADLINE_SECONDS = float(os.environ.get("URL_INGEST_DEADLINE_SECONDS", "60"))
+
+_host_semaphores = {}
+_host_semaphores_lock = threading.Lock()
+
+def _get_host_semaphore(host):
+    """Return the process-wide semaphore limiting concurrent fetches to one host."""
+    with _host_semaphores_lock:
+        semaphore = _host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = threading.BoundedSemaphore(URL_INGEST_PER_HOST_LIMIT)
+            _host_semaphores[host] = semaphore
+        return semaphore
+
+def is_youtube_url(url):
+    return 'youtube.com' in url or 'youtu.be' in url
+
+@traced_stage("transcript_fetch")
+def _extract_from_youtube_cached(url):
+    """extract_from_youtube() backed by the extraction cache, keyed by video ID."""
+    try:
+        video_id = extract_video_id(url)
+    except ValueError:
+        video_id = None
+    if not extraction_cache or not video_id:
+        return extract_from_youtube(url)
+
+    cache_key = f"youtube:{video_id}"
+    try:
+        cached, is_fresh, _ = extraction_cache.get(cache_key)
+    except Exception as e:
+        print(f"Warning: Extraction cache lookup failed for {url}: {e}")
+        cached, is_fresh = None, False
+    current_stage_span().set(cache_hit=cached is not None and is_fresh)
+    if cached is not None and is_fresh:
+        print(f"Extraction cache hit for YouTube video {video_id}")
+        return {**cached, "source": url}
+
+    content_data = extract_from_youtube(url)
+    current_stage_span().set(chars=len(content_data.get("text", "")), error=content_data.get("error"))
+    if 'error' not in content_data:
+        try:
+            extraction_cache.put(cache_key, content_data, YOUTUBE_CACHE_TTL_SECONDS)
+        except Exception as e:
+            print(f"Warning: Failed to store YouTube video {video_id} in extraction cache: {e}")
+    return content_data
+
+def extract_from_url(url):
+    """Extract content from a single URL, dispatching on YouTube vs website."""
+    host = urlparse(url).netloc.lower()
+    if is_youtube_url(url):
+        host = 'youtube.com' # All YouTube hosts share the same backend
+    with _get_host_semaphore(host):
+        if is_youtube_url(url):
+            return _extract_from_youtube_cached(url)
+        return extract_from_website(url)
+
+def ingest_urls(urls, deadline_seconds=None):
+    """
+    Extract content from several URLs concurrently.
+    Returns a list of (url, content_data) tuples in input order; content_data is
+    either the extraction result or {"error": ...} (including deadline timeouts).
+    """
+    urls = [u.strip() for u in urls if u and u.strip()]
+    if not urls:
+        return []
+    if deadline_seconds is None:
+        deadline_seconds = URL_INGEST_DEADLINE_SECONDS
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(URL_INGEST_MAX_WORKERS, len(urls))), thread_name_prefix="url-ingest")
+    try:
+        futures = [submit_in_context(executor, extract_from_url, url) for url in urls]
+        done, not_done = wait(futures, timeout=deadline_seconds)
+        results = []
+        for url, future in zip(urls, futures):
+            if future in not_done:
+                future.cancel()
+                results.append((url, {"error": f"Timed out after {deadline_seconds:g} seconds while fetching content."}))
+                continue
+            try:
+                results.append((url, future.result()))
+            except Exception as e:
+                results.append((url, {"error": f"Failed to process URL: {str(e)}"}))
+        return results
+    finally:
+        # Don't block the request on stragglers that missed the deadline
+        executor.shutdown(wait=False, cancel_futures=True)
+
+# --- Dependency-Aware Task Runner ---
+INITIAL_FEATURES_MAX_WORKERS = int(os.environ.get("INITIAL_FEATURES_MAX_WORKERS", "3"))
+INITIAL_FEATURES_DEADLINE_SECONDS = float(os.environ.get("INITIAL_FEATURES_DEADLINE_SECONDS", "240"))
+TASK_GRAPH_STOP_CHECK_SECONDS = 0.5 # How often run_task_graph polls should_stop while tasks run
+
+def run_task_graph(tasks, deadline_seconds, max_workers=4, thread_name_prefix="task", should_stop=None):
+    """
+    Run named tasks concurrently under one shared deadline, starting each task as soon
+    as its dependencies have finished.
+    tasks maps name -> (fn, deps); fn is called with a dict of its dependencies' results.
+    Returns {name: result}. A task that raises, misses the deadline, or depends on a
+    failed task gets {"error": ...} without affecting unrelated tasks.
+    If should_stop() becomes true, unfinished tasks are abandoned with {"error": "Cancelled."}.
+    """
+    deadline = time.monotonic() + deadline_seconds
+    stop_error = {"error": f"Timed out after {deadline_seconds:g} seconds."}
+    results = {}
+    pending = dict(tasks)
+    running = {} # future -> task name
+
+    # Tasks that can never become ready (dependency cycles) fail up front
+    ordered = set()
+    while True:
+        ready = [name for name, (_, deps) in tasks.items()
+                 if name not in ordered and all(d in ordered or d not in tasks for d in deps)]
+        if not ready:
+            break
+        ordered.update(ready)
+    for name in set(tasks) - ordered:
+        results[name] = {"error": "Dependency cycle detected."}
+        del pending[name]
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(tasks) or 1)), thread_name_prefix=thread_name_prefix)
+    try:
+        while pending or running:
+            # Start (or skip) every task whose dependencies are resolved, until nothing changes
+            progressed = True
+            while progressed:
+                progressed = False
+                for name, (fn, deps) in list(pending.items()):
+                    unknown = [d for d in deps if d not in tasks]
+                    if unknown:
+                        results[name] = {"error": f"Unknown dependency: {', '.join(unknown)}."}
+                    elif not all(d in results for d in deps):
+                        continue
+                    else:
+                        failed = [d for d in deps if isinstance(results[d], dict) and 'error' in results[d]]
+                        if failed:
+                            results[name] = {"error": f"Skipped because {', '.join(failed)} failed."}
+                        else:
+                            running[submit_in_context(executor, fn, {d: results[d] for d in deps})] = name
+                    del pending[name]
+                    progressed = True
+
+            if not running:
+                break
+
+            remaining = max(0, deadline - time.monotonic())
+            if should_stop is not None:
+                if should_stop():
+                    stop_error = {"error": "Cancelled."}
+                    break
+                remaining = min(remaining, TASK_GRAPH_STOP_CHECK_SECONDS)
+            done, _ = wait(running, timeout=remaining, return_when=FIRST_COMPLETED)
+            if not done and time.monotonic() >= deadline:
+                break # Shared deadline reached
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    print(f"Task '{name}' failed: {str(e)}")
+                    results[name] = {"error": f"Task failed: {str(e)}"}
+
+        for future, name in running.items():
+            future.cancel()
+            results[name] = dict(stop_error)
+        for name in pending:
+            results[name] = dict(stop_error)
+        return results
+    finally:
+        # Don't block the request on stragglers that missed the deadline
+        executor.shutdown(wait=False, cancel_futures=True)
+
+# --- Gemini File Upload Cache (deduplicated by content hash) ---
+GEMINI_FILE_CACHE_ENABLED = os.environ.get("GEMINI_FILE_CACHE_ENABLED", "true").lower() == "true"
+GEMINI_FILE_EXPIRY_MARGIN_SECONDS = int(os.environ.get("GEMINI_FILE_EXPIRY_MARGIN_SECONDS", "1800")) # Stop reusing handles this close to expiry
+GEMINI_FILE_IDLE_SECONDS = int(os.environ.get("GEMINI_FILE_IDLE_SECONDS", str(6 * 3600))) # Delete handles unused for this long
+GEMINI_FILE_JANITOR_INTERVAL_SECONDS = int(os.environ.get("GEMINI_FILE_JANITOR_INTERVAL_SECONDS", "300"))
+GEMINI_FILE_DEFAULT_LIFETIME_SECONDS = 47 * 3600 # Gemini keeps uploaded files for 48 hours
+
+class GeminiFileCache:
+    """
+    Process-wide map of SHA-256 digest -> ACTIVE Gemini file handle.
+    Handles are reference counted while requests use them; a background
+    janitor deletes unreferenced handles that are idle or close to their
+    server-side expiration.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {} # digest -> entry dict
+        self._names = {} # Gemini file name -> digest
+        self._digest_locks = {} # digest -> {"lock", "holders"}, only while an upload holds or waits on it
+        self._janitor = None
+        self._stats = {"hits": 0, "misses": 0, "deleted": 0}
+
+    def lock_digest(self, digest):
+        """
+        Serialize uploads of identical content so duplicates wait for the first upload.
+        Every call must be paired with unlock_digest(digest).
+        """
+        with self._lock:
+            digest_lock = self._digest_locks.setdefault(digest, {"lock": threading.Lock(), "holders": 0})
+            digest_lock["holders"] += 1 # Counts waiters too, so the lock isn't dropped under them
+        digest_lock["lock"].acquire()
+
+    def unlock_digest(self, digest):
+        with self._lock:
+            digest_lock = self._digest_locks[digest]
+            digest_lock["lock"].release()
+            digest_lock["holders"] -= 1
+            if digest_lock["holders"] == 0:
+                del self._digest_locks[digest]
+
+    def acquire(self, digest):
+        """Return a cached ACTIVE file handle for digest (incrementing its refcount) or None."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None or entry["expires_at"] - GEMINI_FILE_EXPIRY_MARGIN_SECONDS <= now:
+                self._stats["misses"] += 1
+                return None
+            entry["refcount"] += 1
+            entry["last_used"] = now
+            self._stats["hits"] += 1
+            return entry["file_object"]
+
+    def add(self, digest, file_object):
+        """Register a freshly uploaded ACTIVE file with a refcount of 1."""
+        expiration = getattr(file_object, 'expiration_time', None)
+        try:
+            expires_at = expiration.timestamp() if expiration else None
+        except Exception:
+            expires_at = None
+        if not expires_at:
+            expires_at = time.time() + GEMINI_FILE_DEFAULT_LIFETIME_SECONDS
+        with self._lock:
+            self._entries[digest] = {
+                "file_object": file_object,
+                "expires_at": expires_at,
+                "last_used": time.time(),
+                "refcount": 1,
+            }
+            self._names[file_object.name] = digest
+        self.start_janitor()
+
+    def release(self, file_name):
+        """Drop one reference to a file. Returns False if the file is not managed by the cache."""
+        with self._lock:
+            digest = self._names.get(file_name)
+            if digest is None:
+                return False
+            entry = self._entries[digest]
+            entry["refcount"] = max(0, entry["refcount"] - 1)
+            entry["last_used"] = time.time()
+            return True
+
+    def sweep(self):
+        """Delete unreferenced handles that are idle or near expiry."""
+        now = time.time()
+        expired = []
+        with self._lock:
+            for digest, entry in list(self._entries.items()):
+                if entry["refcount"] > 0:
+                    continue
+                near_expiry = entry["expires_at"] - GEMINI_FILE_EXPIRY_MARGIN_SECONDS <= now
+                idle = now - entry["last_used"] >= GEMINI_FILE_IDLE_SECONDS
+                if near_expiry or idle:
+                    del self._entries[digest]
+                    self._names.pop(entry["file_object"].name, None)
+                    expired.append(entry["file_object"].name)
+        for file_name in expired:
+            try:
+                genai_api.delete_file(file_name)
+                print(f"Janitor deleted cached Gemini file: {file_name}")
+            except Exception as delete_error:
+                print(f"Warning: Janitor failed to delete Gemini file {file_name}: {delete_error}")
+        with self._lock:
+            self._stats["deleted"] += len(expired)
+        return len(expired)
+
+    def _janitor_loop(self):
+        while True:
+            time.sleep(GEMINI_FILE_JANITOR_INTERVAL_SECONDS)
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Warning: Gemini file janitor error: {e}")
+
+    def start_janitor(self):
+        with self._lock:
+            if self._janitor is None:
+                self._janitor = threading.Thread(target=self._janitor_loop, name="gemini-file-janitor", daemon=True)
+                self._janitor.start()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["in_use"] = sum(1 for e in self._entries.values() if e["refcount"] > 0)
+            stats["digest_locks"] = len(self._digest_locks)
+        return stats
+
+gemini_file_cache = GeminiFileCache() if GEMINI_FILE_CACHE_ENABLED else None
+
+def release_gemini_file(file_name):
+    """Release a file used by a request: cached handles are kept for reuse, others are deleted."""
+    if gemini_file_cache and gemini_file_cache.release(file_name):
+        print(f"Released cached Gemini file: {file_name}")
+        return
+    try:
+        genai_api.delete_file(file_name)
+        print(f"Deleted Gemini file: {file_name}")
+    except Exception as delete_error:
+        # Log but don't fail the request
+        print(f"Warning: Failed to delete Gemini file {file_name}: {delete_error}")
+
+GEMINI_FILE_PROCESSING_TIMEOUT_SECONDS = float(os.environ.get("GEMINI_FILE_PROCESSING_TIMEOUT_SECONDS", "60")) # Per file, counted from the end of its upload
+GEMINI_POLL_INITIAL_INTERVAL_SECONDS = 0.5
+GEMINI_POLL_MAX_INTERVAL_SECONDS = 5.0
+GEMINI_POLL_WAIT_FRACTION = 0.2 # Poll interval as a fraction of the time already waited, so a ready file is seen within ~20%
+GEMINI_UPLOAD_MAX_WORKERS = int(os.environ.get("GEMINI_UPLOAD_MAX_WORKERS", "4"))
+
+def upload_file_to_gemini(file_storage, timeout_seconds=None):
+    """
+    Uploads a file to Gemini API and returns the file object upon success.
+    `timeout_seconds` bounds the wait for processing, counted from when the upload itself
+    finishes. The result always carries "processing_seconds".
+    """
+    start_time = time.time()
+    if timeout_seconds is None:
+        timeout_seconds = GEMINI_FILE_PROCESSING_TIMEOUT_SECONDS
+    result = _upload_file_to_gemini(file_storage, timeout_seconds)
+    result["processing_seconds"] = round(time.time() - start_time, 2)
+    return result
+
+def upload_files_to_gemini(file_storages, timeout_seconds=None):
+    """
+    Upload several files concurrently. Each file gets its own processing timeout once its
+    upload finishes, so queueing behind other uploads doesn't eat into it.
+    Returns a list of (file_storage, result) tuples in input order.
+    """
+    file_storages = list(file_storages)
+    if not file_storages:
+        return []
+    max_workers = max(1, min(GEMINI_UPLOAD_MAX_WORKERS, len(file_storages)))
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gemini-upload") as executor:
+        futures = [submit_in_context(executor, upload_file_to_gemini, fs, timeout_seconds) for fs in file_storages]
+        results = []
+        for file_storage, future in zip(file_storages, futures):
+            try:
+                results.append((file_storage, future.result()))
+            except Exception as e:
+                results.append((file_storage, {"error": f"Failed to upload/process file '{file_storage.filename}': {str(e)}"}))
+    return results
+
+UPLOAD_READ_CHUNK_BYTES = 1024 * 1024
+
+# Leading-byte signatures used to sniff MIME types when the browser sends none
+FILE_SIGNATURES = [
+    (0, b'%PDF', 'application/pdf'),
+    (0, b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (0, b'\xff\xd8\xff', 'image/jpeg'),
+    (0, b'ID3', 'audio/mp3'),
+    (0, b'\xff\xfb', 'audio/mp3'),
+    (0, b'\xff\xf3', 'audio/mp3'),
+    (0, b'OggS', 'audio/ogg'),
+    (0, b'fLaC', 'audio/flac'),
+    (8, b'WAVE', 'audio/wav'),
+    (8, b'AVI ', 'video/x-msvideo'),
+    (8, b'WEBP', 'image/webp'),
+    (4, b'ftypqt', 'video/quicktime'),
+    (4, b'ftypM4A', 'audio/mp4'),
+    (4, b'ftyp', 'video/mp4'),
+    (0, b'\x00\x00\x01\xba', 'video/mpeg'),
+]
+
+def sniff_mime_type(head):
+    """Guess a MIME type from the first bytes of a file, or None."""
+    for offset, signature, mime_type in FILE_SIGNATURES:
+        if head[offset:offset + len(signature)] == signature:
+            return mime_type
+    return None
+
+def hash_and_sniff_stream(stream, chunk_size=UPLOAD_READ_CHUNK_BYTES):
+    """
+    Read a seekable stream once in fixed-size chunks, computing its SHA-256 and keeping
+    only the leading bytes for MIME sniffing. Returns (hexdigest, head_bytes, size).
+    """
+    stream.seek(0)
+    hasher = hashlib.sha256()
+    head = b""
+    size = 0
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        if len(head) < 64:
+            head += chunk[:64 - len(head)]
+        hasher.update(chunk)
+        size += len(chunk)
+    stream.seek(0)
+    return hasher.hexdigest(), head, size
+
+def _upload_file_to_gemini(file_storage, timeout_seconds):
     original_filename = file_storage.filename
     filename = secure_filename(original_filename)
     if not filename:
@@ -425,8 +3053,22 @@ def upload_file_to_gemini(file_storage):
     temp_id = str(uuid.uuid4())
     print(f"Preparing secure filename: {filename} (Temp ID: {temp_id}) for Gemini upload.")
 
+    try:
+        digest, head, file_size = hash_and_sniff_stream(file_storage.stream)
+    except Exception as e:
+        print(f"Error reading uploaded file {original_filename}: {str(e)}")
+        return {"error": f"Failed to read uploaded file '{original_filename}': {str(e)}"}
+    print(f"Read {file_size} bytes for {filename} (sha256 {digest[:12]}...)")
+
     mime_type = file_storage.mimetype
     if not mime_type or mime_type == 'application/octet-stream':
+        sniffed_mime_type = sniff_mime_type(head)
+    else:
+        sniffed_mime_type = None
+    if sniffed_mime_type:
+        mime_type = sniffed_mime_type
+        print(f"Sniffed MIME type for {original_filename} as {mime_type}")
+    elif not mime_type or mime_type == 'application/octet-stream':
         ext = os.path.splitext(original_filename)[1].lower()
         mime_map = {
              '.pdf': 'application/pdf',
@@ -458,42 +3100,61 @@ def upload_file_to_gemini(file_storage):
 
     temp_file_path = None
     gemini_file = None
+    digest_locked = False
     try:
-        file_bytes = file_storage.read()
-        file_storage.seek(0) # Reset stream position in case it's needed again (though unlikely here)
-
-        # Create a temporary file to store the bytes
-        with tempfile.NamedTemporaryFile(delete=False, suffix=pathlib.Path(filename).suffix) as temp_file:
-            temp_file.write(file_bytes)
-            temp_file_path = temp_file.name # Get the path
-
-        print(f"Uploading temporary file {temp_file_path} for {filename} ({mime_type}) to Gemini...")
-
-        # Upload using the file path
-        gemini_file = genai_api.upload_file(
-            path=temp_file_path,
-            display_name=filename, # Use secure filename as display name
-            mime_type=mime_type
-        )
+        with stage_span("file_upload", bytes=file_size, mime_type=mime_type) as upload_span:
+            # Reuse an ACTIVE handle for identical content instead of uploading again
+            if gemini_file_cache:
+                gemini_file_cache.lock_digest(digest)
+                digest_locked = True
+                cached_file = gemini_file_cache.acquire(digest)
+                upload_span.set(cache_hit=cached_file is not None)
+                if cached_file is not None:
+                    print(f"Reusing cached Gemini file {cached_file.name} for {filename} (sha256 {digest[:12]}...)")
+                    return {"file_object": cached_file, "original_filename": original_filename, "sha256": digest, "cached": True}
+
+            # Upload straight from the request's spooled file; only copy if the stream isn't a real file object
+            upload_source = file_storage.stream
+            if not isinstance(upload_source, io.IOBase):
+                with tempfile.NamedTemporaryFile(delete=False, suffix=pathlib.Path(filename).suffix) as temp_file:
+                    shutil.copyfileobj(upload_source, temp_file, UPLOAD_READ_CHUNK_BYTES)
+                    temp_file_path = temp_file.name # Get the path
+                upload_source = temp_file_path
+            upload_source_label = temp_file_path or "request stream"
+            print(f"Uploading {upload_source_label} for {filename} ({mime_type}, {file_size} bytes) to Gemini...")
+
+            gemini_file = genai_api.upload_file(
+                path=upload_source,
+                display_name=filename, # Use secure filename as display name
+                mime_type=mime_type
+            )
         print(f"Upload initiated for {filename}. Gemini file name: {gemini_file.name}. Waiting for processing...")
 
-        # Polling loop
-        polling_attempts = 0
-        max_polling_attempts = 12 # e.g., 1 minute if sleep is 5s
-        while gemini_file.state.name == "PROCESSING" and polling_attempts < max_polling_attempts:
-            time.sleep(5)
-            polling_attempts += 1
-            try:
-                 gemini_file = genai_api.get_file(gemini_file.name)
-                 print(f"File {gemini_file.name} state: {gemini_file.state.name} (Attempt {polling_attempts}/{max_polling_attempts})")
-            except Exception as poll_error:
-                 print(f"Error polling file status for {gemini_file.name}: {poll_error}")
-                 # Don't immediately fail, maybe a transient issue
-                 if polling_attempts >= max_polling_attempts:
-                    raise RuntimeError(f"Failed to get file status after multiple attempts: {poll_error}")
+        with stage_span("upload_polling", mime_type=mime_type) as polling_span:
+            # Polling loop: the interval grows with the time already waited (sub-second at first),
+            # and the file is always checked at least once before it can time out
+            polling_attempts = 0
+            polling_started = time.time()
+            deadline = polling_started + timeout_seconds
+            while gemini_file.state.name == "PROCESSING":
+                if polling_attempts and time.time() >= deadline:
+                    break
+                waited = time.time() - polling_started
+                poll_interval = min(max(GEMINI_POLL_INITIAL_INTERVAL_SECONDS, waited * GEMINI_POLL_WAIT_FRACTION), GEMINI_POLL_MAX_INTERVAL_SECONDS)
+                time.sleep(max(0, min(poll_interval, deadline - time.time())))
+                polling_attempts += 1
+                try:
+                     gemini_file = genai_api.get_file(gemini_file.name)
+                     print(f"File {gemini_file.name} state: {gemini_file.state.name} (Attempt {polling_attempts})")
+                except Exception as poll_error:
+                     print(f"Error polling file status for {gemini_file.name}: {poll_error}")
+                     # Don't immediately fail, maybe a transient issue
+                     if time.time() >= deadline:
+                        raise RuntimeError(f"Failed to get file status after multiple attempts: {poll_error}")
+            polling_span.set(attempts=polling_attempts, state=gemini_file.state.name)
 
         if gemini_file.state.name == "PROCESSING":
-             print(f"File processing timed out for {filename} after {max_polling_attempts * 5} seconds.")
+             print(f"File processing timed out for {filename} after {polling_attempts} status checks.")
              # Attempt deletion here if timed out
              try:
                  genai_api.delete_file(gemini_file.name)
@@ -513,8 +3174,10 @@ def upload_file_to_gemini(file_storage):
             return {"error": f"File processing failed for '{original_filename}' (State: {gemini_file.state.name})"}
 
         print(f"File {filename} ({gemini_file.name}) is ACTIVE.")
+        if gemini_file_cache:
+            gemini_file_cache.add(digest, gemini_file)
         # Return the gemini_file object itself, along with original name for reference
-        return {"file_object": gemini_file, "original_filename": original_filename}
+        return {"file_object": gemini_file, "original_filename": original_filename, "sha256": digest, "cached": False}
 
     except Exception as e:
         print(f"Error uploading/processing file {original_filename} with Gemini: {str(e)}")
@@ -530,6 +3193,8 @@ def upload_file_to_gemini(file_storage):
         return {"error": f"Failed to upload/process file '{original_filename}': {str(e)}"}
 
     finally:
+        if digest_locked:
+            gemini_file_cache.unlock_digest(digest)
         # Delete the local temporary file
         if temp_file_path and os.path.exists(temp_file_path):
             try:
@@ -538,10 +3203,11 @@ def upload_file_to_gemini(file_storage):
             except Exception as delete_temp_error:
                 print(f"Warning: Failed to delete local temporary file {temp_file_path}: {delete_temp_error}")
 
-def process_content(content_items, topic=None, description=None, web_search=True):
+@traced_stage("prompt_build", task="notes")
+def prepare_notes_request(content_items, topic=None, description=None, web_search=True):
     """
-    Process mixed content sources (text, file objects), user topic/desc,
-    and generate enhanced notes using direct multimodal input.
+    Build the multimodal notes prompt from mixed content sources (text, file objects),
+    user topic/desc and optional web search. Returns a notes request dict or {"error": ...}.
     """
     if not content_items and not (topic and description):
          return {"error": "No content provided (URLs, files, or topic/description)."}
@@ -588,12 +3254,14 @@ def process_content(content_items, topic=None, description=None, web_search=True
         return {"error": "No processable content found after initial filtering."}
 
     # --- Build Prompt for Notes Generation (Multimodal) ---
+    budget = prompt_budgets.start("notes")
     notes_prompt_parts = []
     notes_prompt_parts.append("You are an expert academic assistant tasked with creating comprehensive study notes in English.")
 
     user_context_prompt = ""
     if topic: user_context_prompt += f"User Provided Topic: {topic}\n"
     if description: user_context_prompt += f"User Provided Description:\n{description}\n"
+    user_context_prompt = budget.fit("user_context", user_context_prompt)
     if user_context_prompt:
          notes_prompt_parts.append("**User Context:**")
          notes_prompt_parts.append(user_context_prompt)
@@ -609,8 +3277,9 @@ def process_content(content_items, topic=None, description=None, web_search=True
         notes_prompt_parts.append("\n*Textual Content:*")
         # Now combine text snippets
         combined_text_for_prompt = "\n\n---\n\n".join(text_contents) # Assign value here
-        notes_prompt_parts.append(combined_text_for_prompt[:30000])
-        if len(combined_text_for_prompt) > 30000:
+        text_for_prompt = budget.fit("text", combined_text_for_prompt)
+        notes_prompt_parts.append(text_for_prompt)
+        if len(text_for_prompt) < len(combined_text_for_prompt):
             notes_prompt_parts.append("\n[... Additional textual content truncated for brevity in prompt ...]")
 
     if file_objects:
@@ -620,6 +3289,7 @@ def process_content(content_items, topic=None, description=None, web_search=True
             display_name = getattr(file_obj, 'display_name', file_obj.name)
             notes_prompt_parts.append(f"\n--- File: {display_name} (MIME: {file_obj.mime_type}) ---")
             notes_prompt_parts.append(file_obj)
+            budget.charge("files", file_obj)
         notes_prompt_parts.append("\n(Analyze the full content of the files referenced above)")
 
     print(f"Generating notes from {source_count} primary sources ({len(text_contents)} text, {len(file_objects)} files).")
@@ -632,40 +3302,25 @@ def process_content(content_items, topic=None, description=None, web_search=True
     # Generate queries based on available text (user context + extracted text)
     # Now combined_text_for_prompt is guaranteed to exist
     context_for_search_query = user_context_prompt + combined_text_for_prompt
-    if web_search and SEARCH_ENGINE_ID and context_for_search_query.strip(): # Check if context is not empty
+    if web_search and SEARCH_ENGINE_ID and context_for_search_query.strip() and budget.tokens_for("web") > 0:
         print("Web search enabled. Generating queries...")
         search_queries = generate_search_queries(context_for_search_query, num_queries=3)
         print(f"Generated queries: {search_queries}")
         if search_queries:
-            web_search_context += "\n\n--- Relevant Web Search Results ---\n"
-            source_counter = 1
-            processed_urls = set()
-
-            for i, query in enumerate(search_queries, 1):
-                print(f"Searching for: '{query}'")
-                urls_data = search_web(query, num_results=2)
-                print(f"Found URLs: {[u['link'] for u in urls_data]}")
-
-                for url_data in urls_data:
-                    url = url_data['link']
-                    if url in processed_urls: continue
-                    print(f"Fetching content from: {url}")
-                    content = fetch_page_content(url)
-                    processed_urls.add(url)
-                    if content:
-                        source_ref = f"Source {source_counter}"
-                        web_sources_list.append({"ref": source_ref, "url": url})
-                        web_search_context += f"\n[{source_ref}]\nURL: {url}\nSnippet: {url_data.get('snippet','')}\nContent Summary:\n{content[:1000]}...\n"
-                        source_counter += 1
-                        if len(web_search_context) > 20000:
-                            print("Web context limit reached.")
-                            break
-                if len(web_search_context) > 20000: break
+            web_search_context, web_sources_list = gather_web_context(
+                search_queries,
+                results_per_query=2,
+                ref_label="Source",
+                format_entry=lambda source_ref, url_data, content: f"\n[{source_ref}]\nURL: {url_data['link']}\nSnippet: {url_data.get('snippet','')}\nContent Summary:\n{content[:1000]}...\n",
+                context="\n\n--- Relevant Web Search Results ---\n",
+                char_budget=budget.char_budget("web")
+            )
+            budget.charge("web", web_search_context)
     # --- End Web Search ---
 
     if web_search_context:
         notes_prompt_parts.append(f"**Additional Context from Web Search:**\n{web_search_context}")
-        notes_prompt_parts.append(f"\nWhen incorporating information *only* found in web sources, cite using the format [{web_sources_list[i]['ref']}] corresponding to the source list below. Do not cite the primary content or user context.")
+        notes_prompt_parts.append("\nWhen incorporating information *only* found in web sources, cite using the format [Source N] corresponding to the source list below. Do not cite the primary content or user context.")
 
     # Calculate dynamic length based on combined *text* length for guidance
     content_length = len(combined_text_for_prompt) + len(user_context_prompt)
@@ -696,12 +3351,79 @@ def process_content(content_items, topic=None, description=None, web_search=True
              web_source_listing_for_prompt += f"*   [{src['ref']}] {src['url']}\n"
         notes_prompt_parts.append(web_source_listing_for_prompt)
 
+    prompt_text = "".join(part for part in notes_prompt_parts if isinstance(part, str))
+    budget.finish()
+    current_stage_span().set(chars=len(prompt_text), tokens=estimate_tokens(prompt_text), files=len(file_objects))
+
+    return {
+        "prompt_parts": notes_prompt_parts,
+        "titles": titles,
+        "original_text": combined_original_text,
+        "file_objects": file_objects,
+        "web_sources": web_sources_list,
+        "web_source_listing": web_source_listing_for_prompt,
+        "web_search": web_search,
+    }
+
+def finalize_notes(notes_request, notes_text):
+    """Append web source listing, derive a title and build the notes result dict."""
+    # Append web source list to final output
+    if notes_request["web_sources"]:
+         notes_text += notes_request["web_source_listing"]
+
+    # Generate title
+    titles = notes_request["titles"]
+    if not titles:
+        combined_title = "Processed Content"
+    elif len(titles) == 1:
+        combined_title = titles[0]
+    elif len(titles) <= 3:
+        combined_title = " & ".join(titles)
+    else:
+        combined_title = f"{titles[0]} & {len(titles) - 1} other sources"
+
+    content_session_id = str(uuid.uuid4())
+
+    return {
+        "content_id": content_session_id,
+        "title": combined_title,
+        "notes": notes_text,
+        "original_text": notes_request["original_text"], # Return only textual original content
+        "web_search_enabled": notes_request["web_search"],
+        "processed_file_names": [f.name for f in notes_request["file_objects"]],
+        "status": "success"
+    }
+
+def notes_generation_error(e):
+    """Map an exception raised during notes generation to a user-facing error dict."""
+    print(f"Error during multimodal notes generation: {str(e)}")
+    if "429" in str(e) or "Resource has been exhausted" in str(e):
+        return {"error": "Rate limit or quota exceeded. Please try again later."}
+    elif "Deadline Exceeded" in str(e) or "504" in str(e) or "timeout" in str(e):
+         return {"error": "Notes generation timed out. The content might be too large or complex for the current model/settings."}
+    # Handle specific API errors if needed
+    elif "API key not valid" in str(e):
+         return {"error": "Invalid Google API Key. Please check your configuration."}
+    elif "permission" in str(e).lower():
+         return {"error": f"API Permission Error: {str(e)}"}
+    return {"error": f"Failed to generate notes: {str(e)}"}
+
+def process_content(content_items, topic=None, description=None, web_search=True):
+    """
+    Process mixed content sources (text, file objects), user topic/desc,
+    and generate enhanced notes using direct multimodal input.
+    """
+    notes_request = prepare_notes_request(content_items, topic, description, web_search)
+    if 'error' in notes_request:
+        return notes_request
 
     # --- API Call ---
     try:
-        notes_generation_model = genai.GenerativeModel(DEFAULT_GEMINI_MODEL)
-        notes_response = notes_generation_model.generate_content(
-            notes_prompt_parts,
+        notes_generation_model = get_model("notes")
+        notes_response = gemini_generate(
+            notes_generation_model,
+            notes_request["prompt_parts"],
+            task="notes",
             request_options={"timeout": 600}
             )
 
@@ -727,46 +3449,226 @@ def process_content(content_items, topic=None, description=None, web_search=True
                  print(f"Full notes response object: {notes_response}")
                  return {"error": "Failed to generate notes: No valid response text found."}
 
-        # Append web source list to final output
-        if web_sources_list:
-             notes_text += web_source_listing_for_prompt
-
-        # Generate title
-        if not titles:
-            combined_title = "Processed Content"
-        elif len(titles) == 1:
-            combined_title = titles[0]
-        elif len(titles) <= 3:
-            combined_title = " & ".join(titles)
-        else:
-            combined_title = f"{titles[0]} & {len(titles) - 1} other sources"
-
-        content_session_id = str(uuid.uuid4())
+        return finalize_notes(notes_request, notes_text)
+    except Exception as e:
+        return notes_generation_error(e)
 
-        return {
-            "content_id": content_session_id,
-            "title": combined_title,
-            "notes": notes_text,
-            "original_text": combined_original_text, # Return only textual original content
-            "web_search_enabled": web_search,
-            "processed_file_names": [f.name for f in file_objects],
-            "status": "success"
-        }
+def stream_notes(notes_request):
+    """
+    Generate notes with Gemini's stream mode.
+    Yields {"text": chunk} dicts as chunks arrive, or a single {"error": ...} dict on failure.
+    """
+    try:
+        notes_generation_model = get_model("notes")
+        notes_response = gemini_generate(
+            notes_generation_model,
+            notes_request["prompt_parts"],
+            task="notes",
+            stream=True,
+            request_options={"timeout": 600}
+            )
+        received_text = False
+        for chunk in notes_response:
+            if not (chunk.candidates and chunk.candidates[0].content and chunk.candidates[0].content.parts):
+                block_reason = getattr(getattr(chunk, 'prompt_feedback', None), 'block_reason', None)
+                if block_reason:
+                    print(f"Notes generation blocked. Reason: {block_reason}")
+                    yield {"error": f"Content processing failed due to prompt block: {block_reason}"}
+                    return
+                continue
+            chunk_text = "".join(part.text for part in chunk.candidates[0].content.parts if getattr(part, 'text', None))
+            if chunk_text:
+                received_text = True
+                yield {"text": chunk_text}
+
+        if not received_text:
+            print("Critical: Notes stream finished without any text.")
+            yield {"error": "Failed to generate notes: No valid response text found."}
+            return
+
+        prompt_budgets.record_usage("notes", getattr(notes_response, 'usage_metadata', None))
+        candidate = notes_response.candidates[0] if notes_response.candidates else None
+        finish_reason = getattr(candidate, 'finish_reason', None)
+        if finish_reason and finish_reason != 1: # 1 = STOP
+            print(f"Warning: Notes generation may be incomplete. Finish Reason: {finish_reason}")
+            safety_ratings = getattr(candidate, 'safety_ratings', None)
+            if safety_ratings and any(r.probability >= 3 for r in safety_ratings):
+                yield {"text": "\n\n[Note: Content may be truncated due to safety filters.]"}
     except Exception as e:
-        print(f"Error during multimodal notes generation: {str(e)}")
-        if "429" in str(e) or "Resource has been exhausted" in str(e):
-            return {"error": "Rate limit or quota exceeded. Please try again later."}
-        elif "Deadline Exceeded" in str(e) or "504" in str(e) or "timeout" in str(e):
-             return {"error": "Notes generation timed out. The content might be too large or complex for the current model/settings."}
-        # Handle specific API errors if needed
-        elif "API key not valid" in str(e):
-             return {"error": "Invalid Google API Key. Please check your configuration."}
-        elif "permission" in str(e).lower():
-             return {"error": f"API Permission Error: {str(e)}"}
-        return {"error": f"Failed to generate notes: {str(e)}"}
+        yield notes_generation_error(e)
+
+# --- Gemini Context Cache (study material cached once per session) ---
+GEMINI_CONTEXT_CACHE_ENABLED = os.environ.get("GEMINI_CONTEXT_CACHE_ENABLED", "true").lower() == "true"
+GEMINI_CONTEXT_CACHE_TTL_SECONDS = int(os.environ.get("GEMINI_CONTEXT_CACHE_TTL_SECONDS", "1800"))
+GEMINI_CONTEXT_CACHE_REFRESH_MARGIN_SECONDS = int(os.environ.get("GEMINI_CONTEXT_CACHE_REFRESH_MARGIN_SECONDS", "300")) # Extend TTL when less than this is left
+GEMINI_CONTEXT_CACHE_MIN_TOKENS = int(os.environ.get("GEMINI_CONTEXT_CACHE_MIN_TOKENS", "4096")) # Smaller material uses retrieval snippets instead
+GEMINI_CONTEXT_CACHE_MAX_CHARS = int(os.environ.get("GEMINI_CONTEXT_CACHE_MAX_CHARS", "1500000"))
+GEMINI_CONTEXT_CACHE_MAX_ENTRIES = int(os.environ.get("GEMINI_CONTEXT_CACHE_MAX_ENTRIES", "32"))
+GEMINI_CONTEXT_CACHE_FAILURE_BACKOFF_SECONDS = 600
+
+STUDY_CONTEXT_SYSTEM_INSTRUCTION = """You are a helpful study assistant. The user's study material (generated study notes and the original source text) is provided at the start of this conversation as the "cached study material". Follow the instructions given in each request and ground your output in that material."""
+CACHED_NOTES_PLACEHOLDER = "[The full Study Notes are provided in the cached study material above.]"
+CACHED_ORIGINAL_TEXT_PLACEHOLDER = "[The full Original Text is provided in the cached study material above.]"
+
+class GeminiContextCache:
+    """
+    Process-wide map of content_id -> Gemini CachedContent holding that session's
+    notes and original text, so chat turns and quiz/flashcard/mind map batches
+    send only their task prompt. Handles are keyed by a fingerprint of the
+    material (changed material invalidates the old handle), their TTL is extended
+    while in use, and the least recently used handles are deleted beyond max_entries.
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # content_id -> entry dict
+        self._session_locks = {}
+        self._stats = {"hits": 0, "creates": 0, "refreshes": 0, "invalidations": 0, "failures": 0, "skipped_small": 0}
+
+    def _session_lock(self, content_id):
+        with self._lock:
+            return self._session_locks.setdefault(content_id, threading.Lock())
+
+    def get_or_create(self, content_id, notes, original_text):
+        """Return a CachedContent for the session's material, or None if caching is not worthwhile or fails."""
+        material = build_cached_study_material(notes, original_text)
+        if estimate_tokens(material) < GEMINI_CONTEXT_CACHE_MIN_TOKENS or len(material) > GEMINI_CONTEXT_CACHE_MAX_CHARS:
+            with self._lock:
+                self._stats["skipped_small"] += 1
+            return None
+        fingerprint = hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+        with self._session_lock(content_id): # Concurrent generators of one session share a single create
+            now = time.time()
+            with self._lock:
+                entry = self._entries.get(content_id)
+                if entry is not None:
+                    self._entries.move_to_end(content_id)
+            if entry is not None and entry["fingerprint"] != fingerprint:
+                self.invalidate(content_id) # Material changed
+                entry = None
+            if entry is not None and entry["cached_content"] is None:
+                if entry["retry_after"] > now:
+                    return None
+                entry = None
+            if entry is not None and entry["expires_at"] <= now:
+                entry = None
+            if entry is not None:
+                if entry["expires_at"] - now < GEMINI_CONTEXT_CACHE_REFRESH_MARGIN_SECONDS:
+                    try:
+                        entry["cached_content"].update(ttl=GEMINI_CONTEXT_CACHE_TTL_SECONDS)
+                        entry["expires_at"] = now + GEMINI_CONTEXT_CACHE_TTL_SECONDS
+                        with self._lock:
+                            self._stats["refreshes"] += 1
+                    except Exception as e:
+                        print(f"Warning: Could not extend Gemini context cache for {content_id}: {e}")
+                        entry = None
+            if entry is not None:
+                with self._lock:
+                    self._stats["hits"] += 1
+                return entry["cached_content"]
+
+            try:
+                cached_content = genai_api.caching.CachedContent.create(
+                    model=model_name_for("context_cache"),
+                    display_name=f"study-session-{content_id}"[:128],
+                    system_instruction=STUDY_CONTEXT_SYSTEM_INSTRUCTION,
+                    contents=[
+                        {"role": "user", "parts": [material]},
+                        {"role": "model", "parts": ["I have read the study material and will use it for the following requests."]},
+                    ],
+                    ttl=GEMINI_CONTEXT_CACHE_TTL_SECONDS,
+                )
+                print(f"Created Gemini context cache {cached_content.name} for session {content_id} (~{estimate_tokens(material)} tokens)")
+                new_entry = {"cached_content": cached_content, "fingerprint": fingerprint,
+                             "expires_at": now + GEMINI_CONTEXT_CACHE_TTL_SECONDS, "retry_after": 0}
+                stat = "creates"
+            except Exception as e:
+                print(f"Warning: Could not create Gemini context cache for {content_id}, using prompt snippets: {e}")
+                cached_content = None
+                new_entry = {"cached_content": None, "fingerprint": fingerprint,
+                             "expires_at": 0, "retry_after": now + GEMINI_CONTEXT_CACHE_FAILURE_BACKOFF_SECONDS}
+                stat = "failures"
+            with self._lock:
+                self._entries[content_id] = new_entry
+                self._entries.move_to_end(content_id)
+                self._stats[stat] += 1
+                evicted = []
+                while len(self._entries) > self.max_entries:
+                    evicted_id, evicted_entry = self._entries.popitem(last=False)
+                    self._session_locks.pop(evicted_id, None)
+                    evicted.append(evicted_entry["cached_content"])
+            for evicted_content in evicted:
+                self._delete(evicted_content)
+            return cached_content
+
+    def invalidate(self, content_id):
+        """Forget and delete the session's handle (e.g. after its material changed)."""
+        with self._lock:
+            entry = self._entries.pop(content_id, None)
+            if entry is not None:
+                self._stats["invalidations"] += 1
+        if entry is not None:
+            self._delete(entry["cached_content"])
+
+    def discard(self, cached_content, error):
+        """Drop a handle that failed during generation so the next request recreates it."""
+        error_text = str(error).lower()
+        if not cached_content or not any(marker in error_text for marker in ("cache", "not found", "404", "403")):
+            return
+        with self._lock:
+            content_ids = [cid for cid, e in self._entries.items()
+                           if e["cached_content"] is not None and e["cached_content"].name == cached_content.name]
+        for content_id in content_ids:
+            self.invalidate(content_id)
+
+    def _delete(self, cached_content):
+        if cached_content is None:
+            return
+        gemini_models.discard_cached(cached_content.name)
+        try:
+            cached_content.delete()
+        except Exception as e:
+            print(f"Warning: Failed to delete Gemini context cache {cached_content.name}: {e}")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = sum(1 for e in self._entries.values() if e["cached_content"] is not None)
+        return stats
+
+gemini_context_cache = GeminiContextCache(GEMINI_CONTEXT_CACHE_MAX_ENTRIES) if GEMINI_CONTEXT_CACHE_ENABLED else None
+
+def build_cached_study_material(notes, original_text):
+    return (
+        "--- Start of Study Material ---\n"
+        f"**Study Notes:**\n{notes or ''}\n\n"
+        f"**Original Text:**\n{original_text or ''}\n"
+        "--- End of Study Material ---"
+    )
+
+def get_context_cache(context, task):
+    """
+    Return the session's CachedContent for a stored study context (see load_study_context),
+    or None. A cache only serves tasks routed to the model it was created for.
+    """
+    if not gemini_context_cache or not context.get('content_id') or not context.get('from_store'):
+        return None
+    if model_name_for(task) != model_name_for("context_cache"):
+        return None
+    return gemini_context_cache.get_or_create(context['content_id'], context.get('notes'), context.get('original_text'))
+
+def study_model_for(task, cached_content, generation_config=None):
+    """Model for a study-material task: bound to the session's cached material when there is one."""
+    if cached_content is not None:
+        return gemini_models.get_cached(cached_content, generation_config)
+    return get_model(task, generation_config=generation_config)
+
+def get_context_cache_stats():
+    return gemini_context_cache.stats() if gemini_context_cache else {"enabled": False}
 
 # --- Feature Generation Functions (Modified for statelessness) ---
-def generate_quizzes(notes, original_text, existing_questions_json="[]", question_types=None, num_questions=5, difficulty="Apply"):
+def generate_quizzes(notes, original_text, existing_questions_json="[]", question_types=None, num_questions=5, difficulty="Apply", retrieval_index=None, cached_content=None, salvage_round=0):
     """Generate quiz questions based on provided text and notes, with difficulty control."""
     if not notes and not original_text:
         return {"error": "Cannot generate quiz without notes or original text."}
@@ -776,10 +3678,6 @@ def generate_quizzes(notes, original_text, existing_questions_json="[]", questio
     if not isinstance(question_types, list) or not question_types:
          question_types = ["MCQ"] # Fallback
 
-    quiz_context = f"**Study Notes Snippet:**\n{notes[:10000]}\n\n**Original Text Snippet:**\n{original_text[:10000]}"
-    if len(notes) > 10000 or len(original_text) > 10000:
-        quiz_context += "\n\n[... Content truncated for quiz generation prompt ...]"
-
     existing_questions = []
     try:
         parsed_existing = json.loads(existing_questions_json)
@@ -790,6 +3688,22 @@ def generate_quizzes(notes, original_text, existing_questions_json="[]", questio
 
     existing_question_texts = [q.get('question', '') for q in existing_questions if q and q.get('question')]
 
+    # Full material from the session's context cache, the most relevant chunks within the
+    # token budget (covering material not yet asked about), or budgeted slices
+    prompt_started = time.perf_counter()
+    budget = prompt_budgets.start("quiz")
+    if cached_content is not None:
+        notes_snippet, original_text_snippet = CACHED_NOTES_PLACEHOLDER, CACHED_ORIGINAL_TEXT_PLACEHOLDER
+    elif retrieval_index:
+        notes_snippet, original_text_snippet = retrieve_study_context(
+            retrieval_index, coverage_query(notes), budget.tokens_for("text"),
+            avoid_text=" ".join(existing_question_texts), fill=True)
+        budget.charge("text", notes_snippet + original_text_snippet)
+    else:
+        notes_snippet = budget.fit("text", notes, budget.tokens_for("text") // 2)
+        original_text_snippet = budget.fit("text", original_text)
+    existing_question_texts = budget.fit_items("history", existing_question_texts[:15])
+
     # --- MODIFIED PROMPT LOGIC FOR QUESTION TYPES ---
     question_types_instruction = ""
     if len(question_types) == 1:
@@ -802,13 +3716,13 @@ def generate_quizzes(notes, original_text, existing_questions_json="[]", questio
 Context for Quiz Generation:
 ---
 **Original Content Snippet:**
-{original_text[:6000]}
+{original_text_snippet}
 
 **Study Notes Snippet:**
-{notes[:6000]}
+{notes_snippet}
 ---
 
-{'EXISTING QUESTIONS (Avoid generating identical or near-identical questions):' + json.dumps(existing_question_texts[:15], indent=2) if existing_question_texts else "No existing questions provided."}
+{'EXISTING QUESTIONS (Avoid generating identical or near-identical questions):' + json.dumps(existing_question_texts, indent=2) if existing_question_texts else "No existing questions provided."}
 ---
 
 **Task:** Generate a high-quality quiz in English with exactly {num_questions} questions based **strictly and solely** on the provided Context snippets (Original Content and Study Notes). Do not use any external knowledge.
@@ -889,10 +3803,13 @@ Example MCQ Object (Reflecting Enhanced Guidelines):
 }}
 ```
 """
+    budget.finish()
+    record_stage("prompt_build", time.perf_counter() - prompt_started, task="quiz",
+                 chars=len(quiz_prompt), tokens=estimate_tokens(quiz_prompt), cached_context=cached_content is not None)
     try:
         # Use a model suitable for complex instruction following
-        quiz_model = genai.GenerativeModel(DEFAULT_GEMINI_MODEL)
-        quiz_response = quiz_model.generate_content(quiz_prompt)
+        quiz_model = study_model_for("quiz", cached_content, structured_output_config(QUIZ_SCHEMA))
+        quiz_response = gemini_generate(quiz_model, quiz_prompt, task="quiz")
 
         # Robust response handling (keep existing logic)
         response_text = ""
@@ -916,67 +3833,22 @@ Example MCQ Object (Reflecting Enhanced Guidelines):
                 print(f"Full quiz response object: {quiz_response}")
                 return {"error": "Failed to generate quiz: No valid response text found."}
 
-        # Clean and parse JSON (keep existing logic)
+        # Parse and validate each question against QUIZ_SCHEMA (JSON mode: no fences to strip)
         cleaned_text = response_text.strip()
-        if cleaned_text.startswith("```json"):
-            cleaned_text = cleaned_text[7:]
-        if cleaned_text.endswith("```"):
-            cleaned_text = cleaned_text[:-3]
-        cleaned_text = cleaned_text.strip()
-
-        # Validate JSON structure before returning (keep existing logic)
         try:
-            questions = json.loads(cleaned_text)
-            if not isinstance(questions, list):
-                if isinstance(questions, dict) and 'type' in questions: # Allow single object response
-                    print("Warning: Received single question object, wrapping in list.")
-                    questions = [questions]
-                else:
-                    raise ValueError("Generated response is not a JSON list of question objects.")
-
-            for q_idx, q in enumerate(questions):
-                if not isinstance(q, dict) or not all(k in q for k in ['type', 'question', 'options', 'correct_answer', 'explanation', 'difficulty']):
-                     required_keys = ['type', 'question', 'correct_answer', 'explanation', 'difficulty']
-                     if not all(k in q for k in required_keys):
-                         raise ValueError(f"Missing key fields in question object at index {q_idx}: {str(q)[:100]}...")
-                     if 'options' not in q:
-                          if q['type'] in ['Fill_in_the_Blank', 'Short_Answer']:
-                              q['options'] = []
-                          else:
-                              raise ValueError(f"Missing 'options' key for question type {q['type']} at index {q_idx}")
-
-                q_type = q.get('type')
-                options = q.get('options')
-                correct_answer = q.get('correct_answer')
-
-                if q_type == "MCQ":
-                    if not isinstance(options, list) or not (len(options) == 4):
-                        raise ValueError(f"Invalid 'options' format/count for MCQ at index {q_idx}. Expected array of 4 strings.")
-                    if not isinstance(correct_answer, str) or correct_answer not in options:
-                         raise ValueError(f"Invalid 'correct_answer' for MCQ at index {q_idx}. Must match one of the options.")
-                elif q_type == "True/False":
-                     if not isinstance(options, list) or options != ["True", "False"]:
-                         raise ValueError(f"Invalid 'options' for True/False at index {q_idx}. Expected ['True', 'False'].")
-                     if correct_answer not in ["True", "False"]:
-                          raise ValueError(f"Invalid 'correct_answer' for True/False at index {q_idx}.")
-                elif q_type == "Fill_in_the_Blank":
-                     if not isinstance(options, list) or options != []:
-                          raise ValueError(f"Invalid 'options' for Fill_in_the_Blank at index {q_idx}. Expected [].")
-                     if not isinstance(correct_answer, (str, list)):
-                          raise ValueError(f"Invalid 'correct_answer' for Fill_in_the_Blank at index {q_idx}.")
-                elif q_type == "Short_Answer":
-                      if not isinstance(options, list) or options != []:
-                          raise ValueError(f"Invalid 'options' for Short_Answer at index {q_idx}. Expected [].")
-                      if not isinstance(correct_answer, str):
-                           raise ValueError(f"Invalid 'correct_answer' for Short_Answer at index {q_idx}. Expected string.")
-                elif q_type == "Matching":
-                    if not isinstance(options, dict) or \
-                       not isinstance(options.get('column_a'), list) or len(options['column_a']) != 5 or \
-                       not isinstance(options.get('column_b'), list) or len(options['column_b']) != 5:
-                        raise ValueError(f"Invalid 'options' format/count for Matching at index {q_idx}. Expected object with column_a/b arrays of 5 strings.")
-                    if not isinstance(correct_answer, list) or len(correct_answer) != 5 or \
-                       not all(re.match(r'^\d+-\d+$', item) for item in correct_answer):
-                        raise ValueError(f"Invalid 'correct_answer' format/count for Matching at index {q_idx}. Expected array of 5 'X-Y' strings.")
+            questions, rejected = split_valid_items(normalize_quiz_response(json.loads(cleaned_text)), validate_quiz_question)
+
+            def regenerate_missing(missing):
+                top_up = generate_quizzes(notes, original_text, json.dumps(existing_questions + questions), question_types,
+                                          missing, difficulty, retrieval_index, cached_content, salvage_round=salvage_round + 1)
+                if 'error' in top_up:
+                    print(f"Quiz top-up failed: {top_up['error']}")
+                    return []
+                return top_up["questions"][:missing]
+
+            questions = top_up_batch("quiz", questions, rejected, num_questions, salvage_round, regenerate_missing)
+            if not questions:
+                raise SchemaValidationError(rejected[0] if rejected else "$: no questions generated")
 
             quiz_id = str(uuid.uuid4())
             return {
@@ -990,13 +3862,15 @@ Example MCQ Object (Reflecting Enhanced Guidelines):
             print(f"Error near position {e.pos}: ...{error_context}...")
             print(f"Received text: {cleaned_text}")
             return {"error": f"Failed to parse quiz JSON: {e}. Error near: '{error_context}'. Please try generating again."}
-        except ValueError as e:
+        except SchemaValidationError as e:
             print(f"Error validating quiz structure: {e}")
             print(f"Received data: {cleaned_text}")
             return {"error": f"Generated quiz data has incorrect structure: {e}"}
 
     except Exception as e:
         print(f"Error generating quiz with Gemini: {str(e)}")
+        if gemini_context_cache:
+            gemini_context_cache.discard(cached_content, e)
         if "429" in str(e) or "Resource has been exhausted" in str(e):
             return {"error": "Rate limit or quota exceeded during quiz generation."}
         if "block_reason: SAFETY" in str(e):
@@ -1004,16 +3878,11 @@ Example MCQ Object (Reflecting Enhanced Guidelines):
         return {"error": f"Failed to generate quiz: {str(e)}"}
 
 
-def generate_flashcards(notes, original_text, existing_flashcards_json="[]", num_flashcards=10):
+def generate_flashcards(notes, original_text, existing_flashcards_json="[]", num_flashcards=10, retrieval_index=None, cached_content=None, salvage_round=0):
     """Generate flashcards based on provided text and notes, ensuring JSON-safe LaTeX."""
     if not notes and not original_text:
         return {"error": "Cannot generate flashcards without notes or original text."}
 
-    # Limit context size (keep existing logic)
-    flashcard_context = f"**Study Notes Snippet:**\n{notes[:10000]}\n\n**Original Text Snippet:**\n{original_text[:10000]}"
-    if len(notes) > 10000 or len(original_text) > 10000:
-        flashcard_context += "\n\n[... Content truncated for flashcard generation prompt ...]"
-
     existing_cards = []
     try:
         parsed_existing = json.loads(existing_flashcards_json)
@@ -1027,20 +3896,36 @@ def generate_flashcards(notes, original_text, existing_flashcards_json="[]", num
         if card is not None and isinstance(card, dict) and card.get('question')
     ]
 
+    # Limit context size: full material from the session's context cache, the most relevant
+    # chunks within the token budget, or budgeted slices
+    prompt_started = time.perf_counter()
+    budget = prompt_budgets.start("flashcards")
+    if cached_content is not None:
+        notes_snippet, original_text_snippet = CACHED_NOTES_PLACEHOLDER, CACHED_ORIGINAL_TEXT_PLACEHOLDER
+    elif retrieval_index:
+        notes_snippet, original_text_snippet = retrieve_study_context(
+            retrieval_index, coverage_query(notes), budget.tokens_for("text"),
+            avoid_text=" ".join(existing_card_questions), fill=True)
+        budget.charge("text", notes_snippet + original_text_snippet)
+    else:
+        notes_snippet = budget.fit("text", notes, budget.tokens_for("text") // 2)
+        original_text_snippet = budget.fit("text", original_text)
+    prompt_card_questions = budget.fit_items("history", existing_card_questions)
+
     # --- Refined Prompt (Again, emphasizing correct escaping) ---
     flashcard_prompt = f"""
 Context for Flashcard Generation:
 ---
 **Original Content Snippet:**
-{original_text[:5000]}
+{original_text_snippet}
 
 **Study Notes Snippet:**
-{flashcard_context[:5000]}
+{notes_snippet}
 ---
 
 EXISTING FLASHCARD QUESTIONS (Avoid generating identical questions):
 ---
-{json.dumps(existing_card_questions, indent=2) if existing_card_questions else "No existing flashcards to avoid."}
+{json.dumps(prompt_card_questions, indent=2) if prompt_card_questions else "No existing flashcards to avoid."}
 ---
 
 Instructions:
@@ -1069,10 +3954,13 @@ Output Format Reminder:
 Return ONLY the valid JSON array `[...]`. Do not include ```json``` markers or any text outside the JSON array. Start with `[` and end with `]`.
 """
     # --- End Refined Prompt ---
+    budget.finish()
+    record_stage("prompt_build", time.perf_counter() - prompt_started, task="flashcards",
+                 chars=len(flashcard_prompt), tokens=estimate_tokens(flashcard_prompt), cached_context=cached_content is not None)
 
     try:
-        flashcard_model = genai.GenerativeModel(DEFAULT_GEMINI_MODEL)
-        flashcard_response = flashcard_model.generate_content(flashcard_prompt)
+        flashcard_model = study_model_for("flashcards", cached_content, structured_output_config(FLASHCARDS_SCHEMA))
+        flashcard_response = gemini_generate(flashcard_model, flashcard_prompt, task="flashcards")
 
         # Robust response handling (keep as is)
         response_text = ""
@@ -1096,44 +3984,23 @@ Return ONLY the valid JSON array `[...]`. Do not include ```json``` markers or a
                  return {"error": "Failed to generate flashcards: No valid response text found."}
 
 
-        # Clean markdown fences (keep as is)
+        # JSON mode with FLASHCARDS_SCHEMA: the decoder emits valid JSON escapes, so no fence
+        # stripping or backslash repair is needed before parsing
         cleaned_text = response_text.strip()
-        if cleaned_text.startswith("```json"): cleaned_text = cleaned_text[7:]
-        if cleaned_text.endswith("```"): cleaned_text = cleaned_text[:-3]
-        cleaned_text = cleaned_text.strip()
-
-        # --- ADDED: Pre-parsing Regex Fix for common LaTeX escape issues ---
         try:
-            # Attempt to fix single backslashes that should be doubled for JSON
-            # Looks for a single backslash followed by common LaTeX command chars or {, }, ^, _
-            # Important: Use raw string (r'...') for regex pattern
-            # Exclude cases where it's already correctly doubled (\\\\) or part of a JSON escape (\", \n, etc.)
-            fixed_text = re.sub(r'(?<!\\)\\(?!["\\/bfnrtu])([a-zA-Z{}()^_*])', r'\\\\\\1', cleaned_text)
+            flashcards, rejected = split_valid_items(json.loads(cleaned_text), validate_flashcard)
 
-            # Optional: Fix cases where the model might have over-escaped simple math chars
-            # fixed_text = re.sub(r'\\\\([+*/-])', r'\\1', fixed_text) # Uncomment carefully if needed
+            def regenerate_missing(missing):
+                top_up = generate_flashcards(notes, original_text, json.dumps(existing_cards + flashcards), missing,
+                                             retrieval_index, cached_content, salvage_round=salvage_round + 1)
+                if 'error' in top_up:
+                    print(f"Flashcard top-up failed: {top_up['error']}")
+                    return []
+                return top_up["flashcards"][:missing]
 
-            if fixed_text != cleaned_text:
-                print("Applied pre-parsing regex fix for LaTeX escapes.")
-                # print(f"Original: ...{cleaned_text[max(0, e.pos-40):min(len(cleaned_text), e.pos+40)]}...") # Debug
-                # print(f"Fixed   : ...{fixed_text[max(0, e.pos-40):min(len(fixed_text), e.pos+40)]}...") # Debug
-                cleaned_text = fixed_text # Use the fixed text for parsing
-        except Exception as regex_error:
-            print(f"Warning: Regex fix for LaTeX escapes failed: {regex_error}")
-            # Proceed with original cleaned_text if regex fails
-
-        # --- END ADDED Regex Fix ---
-
-
-        # Parse JSON (keep existing logic)
-        try:
-            flashcards = json.loads(cleaned_text)
-            if not isinstance(flashcards, list): raise ValueError("Generated response is not a JSON list.")
-            # ... (keep existing validation logic) ...
-            for card in flashcards:
-                 if not isinstance(card, dict) or 'question' not in card or 'answer' not in card:
-                     if card is None: raise ValueError("Invalid flashcard object structure: encountered None value.")
-                     raise ValueError(f"Invalid flashcard object structure in: {card}")
+            flashcards = top_up_batch("flashcards", flashcards, rejected, num_flashcards, salvage_round, regenerate_missing)
+            if not flashcards:
+                raise SchemaValidationError(rejected[0] if rejected else "$: no flashcards generated")
 
             flashcard_id = str(uuid.uuid4()) # Generate temporary ID
             return {
@@ -1143,17 +4010,19 @@ Return ONLY the valid JSON array `[...]`. Do not include ```json``` markers or a
             }
         except json.JSONDecodeError as e:
             print(f"Error parsing generated flashcards JSON: {e}")
-            print(f"Received text snippet (after potential regex fix): {cleaned_text[:500]}...")
+            print(f"Received text snippet: {cleaned_text[:500]}...")
             error_context = cleaned_text[max(0, e.pos - 40):min(len(cleaned_text), e.pos + 40)]
             return {"error": f"Failed to parse flashcards JSON: {e}. Check for invalid characters/escapes near '{error_context}'. Please try generating again."}
         # ... (keep existing exception handlers) ...
-        except ValueError as e:
+        except SchemaValidationError as e:
              print(f"Error validating flashcard structure: {e}")
              print(f"Received data: {cleaned_text}")
              return {"error": f"Generated flashcard data has incorrect structure: {e}"}
 
     except Exception as e:
         print(f"Error generating flashcards with Gemini: {str(e)}")
+        if gemini_context_cache:
+            gemini_context_cache.discard(cached_content, e)
         if "429" in str(e): return {"error": "Rate limit exceeded during flashcard generation."}
         if "block_reason: SAFETY" in str(e):
              return {"error": "Flashcard generation was blocked due to safety filters."}
@@ -1162,8 +4031,26 @@ Return ONLY the valid JSON array `[...]`. Do not include ```json``` markers or a
 # --- Place this modified function in app.py (replaces the old one) ---
 # Ensure necessary imports like `genai`, `re`, and helper functions are available
 
-def chat_with_content(notes, original_text, chat_history, user_message, web_search_enabled):
-    """Handles chat interaction based on notes, original text, and history using generate_content."""
+CHAT_SYSTEM_INSTRUCTION = """You are a helpful study assistant. Your primary goal is to help the user understand the provided study material.
+
+Each user message starts with **Study Material Snippets** and **Web Search Results** relevant to that question, followed by the **User Question**.
+
+**Instructions:**
+1.  **Prioritize Context:** Answer the user's questions based **first and foremost** on the provided **Study Material Snippets** and **Web Search Results** whenever the question relates to this content. Analyze the user's question to see if it relates to the provided material.
+2.  **Cite Web Sources:** If using information found *only* in the Web Search Results, incorporate it and clearly cite it using the [Web Source X] format.
+3.  **Acknowledge Context Limitations:** If the question *relates* to the study material but the answer *cannot be found* within the provided snippets or web results, state that you cannot find the answer within the given context.
+4.  **General Knowledge Fallback:** If the user's question is **clearly unrelated** to the provided study material context (e.g., asking "What is the capital of France?" when the context is about programming), you **MAY** answer using your general knowledge.
+5.  **Disclose Source:** When answering using general knowledge (fallback), **you MUST explicitly state** that the information comes from your general knowledge and not from the provided documents (e.g., "Based on my general knowledge, ...").
+6.  **Be Concise and Helpful:** Use Markdown for formatting.
+7.  **Stay Focused:** Preferentially discuss the study material unless the user clearly shifts to unrelated general knowledge questions. Do not proactively offer unrelated information.
+"""
+
+# Used when there is no study material at all
+CHAT_GENERAL_SYSTEM_INSTRUCTION = """You are a helpful general assistant. Answer the user's questions clearly and concisely using your general knowledge. Use Markdown for formatting."""
+
+@traced_stage("prompt_build", task="chat")
+def prepare_chat_request(notes, original_text, chat_history, user_message, web_search_enabled, retrieval_index=None, cached_content=None):
+    """Validate chat history, run the optional web search and build the system instruction and contents for a chat turn."""
     if not notes and not original_text:
         # If there's no context, it essentially becomes a general chatbot
         print("Warning: Chatting without notes or original text. Operating in general mode.")
@@ -1191,43 +4078,48 @@ def chat_with_content(notes, original_text, chat_history, user_message, web_sear
         chat_history = valid_history
 
     # Prepare context snippets for the chat model
-    chat_notes_snippet = notes[:8000] if notes else ""
-    chat_original_text_snippet = original_text[:8000] if original_text else ""
     context_truncated_warning = ""
-    if (notes and len(notes) > 8000) or (original_text and len(original_text) > 8000):
-        context_truncated_warning = "\n[Note: Provided study material snippets may be truncated for brevity in this context.]"
+    budget = prompt_budgets.start("chat")
+    if cached_content is not None:
+        # The full material is already in the session's context cache
+        chat_notes_snippet, chat_original_text_snippet = CACHED_NOTES_PLACEHOLDER, CACHED_ORIGINAL_TEXT_PLACEHOLDER
+    elif retrieval_index:
+        # Chunks most relevant to the question (and the previous user turn, for follow-ups)
+        previous_user_turns = [m['parts'][0] for m in chat_history if m.get('role') == 'user' and m.get('parts')]
+        retrieval_query = " ".join(previous_user_turns[-1:] + [user_message])
+        text_budget = min(budget.tokens_for("text"), CHAT_CONTEXT_TOKEN_BUDGET)
+        chat_notes_snippet, chat_original_text_snippet = retrieve_study_context(retrieval_index, retrieval_query, text_budget)
+        budget.charge("text", chat_notes_snippet + chat_original_text_snippet)
+        if estimate_tokens(notes or "") + estimate_tokens(original_text or "") > text_budget:
+            context_truncated_warning = "\n[Note: Only the excerpts of the study material most relevant to the question are shown.]"
+    else:
+        chat_notes_snippet = budget.fit("text", notes or "", budget.tokens_for("text") // 2)
+        chat_original_text_snippet = budget.fit("text", original_text or "")
+        if len(chat_notes_snippet) < len(notes or "") or len(chat_original_text_snippet) < len(original_text or ""):
+            context_truncated_warning = "\n[Note: Provided study material snippets may be truncated for brevity in this context.]"
 
     # --- Optional Web Search for Chat (Keep existing logic) ---
     web_context_for_prompt = ""
     web_sources_list = []
     # Only perform web search if context exists and search is enabled
-    if (chat_notes_snippet or chat_original_text_snippet) and web_search_enabled and SEARCH_ENGINE_ID:
+    if (chat_notes_snippet or chat_original_text_snippet) and web_search_enabled and SEARCH_ENGINE_ID and budget.tokens_for("web") > 0:
         print("Chat: Web search enabled. Generating queries...")
         try:
-            query_context = f"User question: {user_message}\n\nRelevant notes context:\n{chat_notes_snippet[:1000]}"
+            query_notes_context = (notes or "") if cached_content is not None else chat_notes_snippet
+            query_context = f"User question: {user_message}\n\nRelevant notes context:\n{query_notes_context[:1000]}"
             search_queries = generate_search_queries(query_context, num_queries=2) # generate_search_queries defined elsewhere
             print(f"Chat search queries: {search_queries}")
 
             if search_queries:
-                web_context_for_prompt += "\n\n--- Relevant Web Search Results for Current Question ---\n"
-                source_counter = 1
-                processed_urls = set()
-                for query in search_queries:
-                    print(f"Chat searching for: '{query}'")
-                    urls_data = search_web(query, num_results=1) # search_web defined elsewhere
-                    for url_data in urls_data:
-                        url = url_data['link']
-                        if url in processed_urls: continue
-                        print(f"Chat fetching: {url}")
-                        content = fetch_page_content(url) # fetch_page_content defined elsewhere
-                        processed_urls.add(url)
-                        if content:
-                            source_ref = f"Web Source {source_counter}"
-                            web_sources_list.append({"ref": source_ref, "url": url})
-                            web_context_for_prompt += f"\n[{source_ref}]\nURL: {url}\nContent Summary:\n{content[:1000]}...\n"
-                            source_counter += 1
-                            if len(web_context_for_prompt) > 5000: break
-                    if len(web_context_for_prompt) > 5000: break
+                web_context_for_prompt, web_sources_list = gather_web_context(
+                    search_queries,
+                    results_per_query=1,
+                    ref_label="Web Source",
+                    format_entry=lambda source_ref, url_data, content: f"\n[{source_ref}]\nURL: {url_data['link']}\nContent Summary:\n{content[:1000]}...\n",
+                    context=web_context_for_prompt + "\n\n--- Relevant Web Search Results for Current Question ---\n",
+                    char_budget=budget.char_budget("web")
+                )
+                budget.charge("web", web_context_for_prompt)
 
                 if web_sources_list:
                     web_context_for_prompt += "\nWhen using info *only* from these web results, cite [Web Source X]."
@@ -1236,12 +4128,14 @@ def chat_with_content(notes, original_text, chat_history, user_message, web_sear
             web_context_for_prompt = "\n[Note: Web search for this question failed.]"
     # --- End Web Search ---
 
-    # --- MODIFIED System Instruction ---
-    # Construct the System Instruction based on whether context exists
-    if chat_notes_snippet or chat_original_text_snippet:
-        system_instruction = f"""You are a helpful study assistant. Your primary goal is to help the user understand the provided study material.
-
---- Start of Study Material Snippets ---
+    # --- Per-turn context ---
+    # The system instructions are static so the chat model is reused across turns; this
+    # turn's snippets and web results travel with the question instead
+    has_study_context = bool(chat_notes_snippet or chat_original_text_snippet)
+    system_instruction = CHAT_SYSTEM_INSTRUCTION if has_study_context else CHAT_GENERAL_SYSTEM_INSTRUCTION
+    turn_context = ""
+    if has_study_context:
+        turn_context = f"""--- Start of Study Material Snippets ---
 **Study Notes Snippet:**
 {chat_notes_snippet}
 
@@ -1252,42 +4146,112 @@ def chat_with_content(notes, original_text, chat_history, user_message, web_sear
 
 {web_context_for_prompt if web_context_for_prompt else "[No relevant web search results provided for this question.]"}
 ---
-
-**Instructions:**
-1.  **Prioritize Context:** Answer the user's questions based **first and foremost** on the provided **Study Material Snippets** and **Web Search Results** above whenever the question relates to this content. Analyze the user's question to see if it relates to the provided material.
-2.  **Cite Web Sources:** If using information found *only* in the Web Search Results, incorporate it and clearly cite it using the [Web Source X] format.
-3.  **Acknowledge Context Limitations:** If the question *relates* to the study material but the answer *cannot be found* within the provided snippets or web results, state that you cannot find the answer within the given context.
-4.  **General Knowledge Fallback:** If the user's question is **clearly unrelated** to the provided study material context (e.g., asking "What is the capital of France?" when the context is about programming), you **MAY** answer using your general knowledge.
-5.  **Disclose Source:** When answering using general knowledge (fallback), **you MUST explicitly state** that the information comes from your general knowledge and not from the provided documents (e.g., "Based on my general knowledge, ...").
-6.  **Be Concise and Helpful:** Use Markdown for formatting.
-7.  **Stay Focused:** Preferentially discuss the study material unless the user clearly shifts to unrelated general knowledge questions. Do not proactively offer unrelated information.
 """
-    else:
-        # Simplified instruction if no context was provided
-        system_instruction = """You are a helpful general assistant. Answer the user's questions clearly and concisely using your general knowledge. Use Markdown for formatting."""
 
-    # --- End MODIFIED System Instruction ---
+    # --- End Per-turn context ---
 
 
     # Prepare history for the API call (Keep existing logic)
-    max_history_turns = 10
-    truncated_history = chat_history[-(max_history_turns * 2):]
+    truncated_history = budget.fit_items("history", chat_history[-(CHAT_MAX_HISTORY_TURNS * 2):],
+                                         text_of=lambda turn: "".join(str(part) for part in turn.get("parts", [])))
+    if truncated_history and truncated_history[0].get("role") != "user":
+        truncated_history = truncated_history[1:] # History sent to Gemini starts with a user turn
     current_turn_user_message_api_format = {"role": "user", "parts": [user_message]}
-    full_history_for_api = truncated_history + [current_turn_user_message_api_format]
+    current_turn_for_api = current_turn_user_message_api_format
+    if cached_content is not None:
+        # A cached context carries its own system instruction, so the chat instructions also
+        # travel with the question; history keeps the plain message
+        current_turn_for_api = {"role": "user", "parts": [f"{system_instruction}\n---\n{turn_context}**User Question:**\n{user_message}"]}
+    elif turn_context:
+        current_turn_for_api = {"role": "user", "parts": [f"{turn_context}**User Question:**\n{user_message}"]}
+
+    prompt_text = "".join(str(part) for turn in truncated_history + [current_turn_for_api] for part in turn.get("parts", []))
+    if cached_content is None:
+        prompt_text += system_instruction
+    budget.finish()
+    current_stage_span().set(chars=len(prompt_text), tokens=estimate_tokens(prompt_text), cached_context=cached_content is not None)
+
+    return {
+        "system_instruction": system_instruction,
+        "contents": truncated_history + [current_turn_for_api],
+        "chat_history": chat_history,
+        "user_turn": current_turn_user_message_api_format,
+        "web_sources": web_sources_list,
+        "cached_content": cached_content,
+    }
 
+def chat_model_for(chat_request):
+    if chat_request["cached_content"] is not None:
+        return study_model_for("chat", chat_request["cached_content"])
+    # Use generate_content with system instruction and history (Keep existing logic)
+    return get_model("chat", system_instruction=chat_request["system_instruction"])
+
+def web_source_links_for(response_text, web_sources_list):
+    """Build the '**Referenced Web Sources:**' block for the [Web Source N] citations used in response_text."""
+    if not web_sources_list:
+        return ""
+    cited_refs = re.findall(r'\[Web Source (\d+)\]', response_text)
+    if not cited_refs:
+        return ""
+    links_to_append = "\n\n**Referenced Web Sources:**\n"
+    added_links = set()
+    for ref_num_str in cited_refs:
+         try:
+             ref_num = int(ref_num_str)
+             if 1 <= ref_num <= len(web_sources_list) and ref_num not in added_links:
+                 source_info = web_sources_list[ref_num - 1]
+                 links_to_append += f"*   [{source_info['ref']}] {source_info['url']}\n"
+                 added_links.add(ref_num)
+         except (ValueError, IndexError) as link_err:
+              print(f"Warning: Could not process citation reference '[Web Source {ref_num_str}]': {link_err}")
+    return links_to_append if added_links else ""
+
+def finalize_chat(chat_request, assistant_response_text):
+    """Build the chat result dict (response text plus updated, truncated history)."""
+    if not assistant_response_text:
+        assistant_response_text = "[The assistant did not generate a response for this turn.]"
+        print("Warning: Assistant response text is empty after processing.")
+
+    # Append user message AND assistant response to the original chat_history state variable (Keep existing logic)
+    assistant_response_api_format = {"role": "model", "parts": [assistant_response_text]}
+    updated_history = chat_request["chat_history"] + [chat_request["user_turn"], assistant_response_api_format]
+
+    # Append source links to the response text if they were used/cited (Keep existing logic)
+    assistant_response_text += web_source_links_for(assistant_response_text, chat_request["web_sources"])
+
+    return {
+        "response": assistant_response_text,
+        "history": updated_history[-(CHAT_MAX_HISTORY_TURNS * 2):], # Return truncated history
+        "status": "success"
+    }
+
+def chat_generation_error(e):
+    # Keep existing exception handling logic
+    print(f"Error during chat interaction: {str(e)}")
+    import traceback
+    traceback.print_exc()
+    error_str = str(e).lower()
+    if "429" in error_str or "quota" in error_str or "resource has been exhausted" in error_str: return {"error": "Rate limit or quota exceeded during chat. Please try again later."}
+    elif "system_instruction" in error_str: return {"error": "There was an issue setting up the chat context with the AI model. Please try again."}
+    elif "safety" in error_str or "blocked" in error_str: return {"error": "Chat request blocked due to safety settings or content policy."}
+    elif "api key not valid" in error_str: return {"error": "Invalid API Key. Please check configuration."}
+    elif "deadline exceeded" in error_str or "timeout" in error_str: return {"error": "The request timed out while waiting for the AI. Please try again."}
+    return {"error": f"Failed to get chat response: An unexpected server error occurred ({type(e).__name__})."}
+
+def chat_with_content(notes, original_text, chat_history, user_message, web_search_enabled, retrieval_index=None, cached_content=None):
+    """Handles chat interaction based on notes, original text, and history using generate_content."""
+    chat_request = prepare_chat_request(notes, original_text, chat_history, user_message, web_search_enabled, retrieval_index, cached_content)
 
     try:
-        # Use generate_content with system instruction and history (Keep existing logic)
-        chat_model = genai.GenerativeModel(
-            model_name=DEFAULT_GEMINI_MODEL, # Or your chosen model
-            system_instruction=system_instruction
-        )
+        chat_model = chat_model_for(chat_request)
 
-        print(f"Sending chat request to generate_content. History length: {len(full_history_for_api)}")
+        print(f"Sending chat request to generate_content. History length: {len(chat_request['contents'])}")
         # print(f"System Instruction Snippet: {system_instruction[:500]}...") # Debug log more context
 
-        response = chat_model.generate_content(
-            contents=full_history_for_api,
+        response = gemini_generate(
+            chat_model,
+            chat_request["contents"],
+            task="chat",
             generation_config=genai.types.GenerationConfig(
                 temperature=0.7 # Adjust as needed
             ),
@@ -1299,14 +4263,7 @@ def chat_with_content(notes, original_text, chat_history, user_message, web_sear
         # ... (Keep the response extraction logic from the previous version) ...
         if response.candidates and response.candidates[0].content and response.candidates[0].content.parts:
              assistant_response_text = response.candidates[0].content.parts[0].text
-             finish_reason = getattr(response.candidates[0], 'finish_reason', None)
-             if finish_reason and finish_reason != 1: # 1 = STOP
-                  print(f"Warning: Chat response generation may be incomplete. Finish Reason: {finish_reason}")
-                  safety_ratings = getattr(response.candidates[0], 'safety_ratings', [])
-                  if any(hasattr(r, 'probability') and r.probability >= 3 for r in safety_ratings):
-                     assistant_response_text += "\n\n[Response may be incomplete due to safety filtering.]"
-                  elif finish_reason == 3:
-                      assistant_response_text += "\n\n[Response may be incomplete due to length limitations.]"
+             assistant_response_text += chat_finish_note(response.candidates[0])
         elif hasattr(response, 'prompt_feedback') and getattr(response.prompt_feedback, 'block_reason', None):
             block_reason = response.prompt_feedback.block_reason
             print(f"Chat prompt blocked. Reason: {block_reason}")
@@ -1319,55 +4276,69 @@ def chat_with_content(notes, original_text, chat_history, user_message, web_sear
                  if hasattr(response, 'error'): return {"error": f"Chat failed: API returned error - {response.error}"}
                  return {"error": "Chat failed: Could not extract valid response text from API."}
 
-        if not assistant_response_text:
-            assistant_response_text = "[The assistant did not generate a response for this turn.]"
-            print("Warning: Assistant response text is empty after processing.")
-
-        # Append user message AND assistant response to the original chat_history state variable (Keep existing logic)
-        assistant_response_api_format = {"role": "model", "parts": [assistant_response_text]}
-        updated_history = chat_history + [current_turn_user_message_api_format, assistant_response_api_format]
-
-        # Append source links to the response text if they were used/cited (Keep existing logic)
-        if web_sources_list:
-             cited_refs = re.findall(r'\[Web Source (\d+)\]', assistant_response_text)
-             if cited_refs:
-                 links_to_append = "\n\n**Referenced Web Sources:**\n"
-                 added_links = set()
-                 for ref_num_str in cited_refs:
-                      try:
-                          ref_num = int(ref_num_str)
-                          if 1 <= ref_num <= len(web_sources_list) and ref_num not in added_links:
-                              source_info = web_sources_list[ref_num - 1]
-                              links_to_append += f"*   [{source_info['ref']}] {source_info['url']}\n"
-                              added_links.add(ref_num)
-                      except (ValueError, IndexError) as link_err:
-                           print(f"Warning: Could not process citation reference '[Web Source {ref_num_str}]': {link_err}")
-                 if added_links:
-                    assistant_response_text += links_to_append
-
-
-        return {
-            "response": assistant_response_text,
-            "history": updated_history[-(max_history_turns * 2):], # Return truncated history
-            "status": "success"
-        }
+        return finalize_chat(chat_request, assistant_response_text)
 
     except Exception as e:
-        # Keep existing exception handling logic
-        print(f"Error during chat interaction: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        error_str = str(e).lower()
-        if "429" in error_str or "quota" in error_str or "resource has been exhausted" in error_str: return {"error": "Rate limit or quota exceeded during chat. Please try again later."}
-        elif "system_instruction" in error_str: return {"error": "There was an issue setting up the chat context with the AI model. Please try again."}
-        elif "safety" in error_str or "blocked" in error_str: return {"error": "Chat request blocked due to safety settings or content policy."}
-        elif "api key not valid" in error_str: return {"error": "Invalid API Key. Please check configuration."}
-        elif "deadline exceeded" in error_str or "timeout" in error_str: return {"error": "The request timed out while waiting for the AI. Please try again."}
-        return {"error": f"Failed to get chat response: An unexpected server error occurred ({type(e).__name__})."}
+        if gemini_context_cache:
+            gemini_context_cache.discard(cached_content, e)
+        return chat_generation_error(e)
+
+def chat_finish_note(candidate):
+    """Return a trailing note when a chat candidate stopped for a reason other than STOP."""
+    finish_reason = getattr(candidate, 'finish_reason', None)
+    if finish_reason and finish_reason != 1: # 1 = STOP
+         print(f"Warning: Chat response generation may be incomplete. Finish Reason: {finish_reason}")
+         safety_ratings = getattr(candidate, 'safety_ratings', None) or []
+         if any(hasattr(r, 'probability') and r.probability >= 3 for r in safety_ratings):
+            return "\n\n[Response may be incomplete due to safety filtering.]"
+         elif finish_reason == 3:
+             return "\n\n[Response may be incomplete due to length limitations.]"
+    return ""
+
+def stream_chat(chat_request):
+    """
+    Stream a chat turn with Gemini's stream mode.
+    Yields {"text": chunk} dicts as tokens arrive, or a single {"error": ...} dict on failure.
+    """
+    try:
+        chat_model = chat_model_for(chat_request)
+        print(f"Sending streaming chat request. History length: {len(chat_request['contents'])}")
+        response = gemini_generate(
+            chat_model,
+            chat_request["contents"],
+            task="chat",
+            generation_config=genai.types.GenerationConfig(
+                temperature=0.7 # Adjust as needed
+            ),
+            stream=True
+        )
+        for chunk in response:
+            if not (chunk.candidates and chunk.candidates[0].content and chunk.candidates[0].content.parts):
+                block_reason = getattr(getattr(chunk, 'prompt_feedback', None), 'block_reason', None)
+                if block_reason:
+                    print(f"Chat prompt blocked. Reason: {block_reason}")
+                    yield {"error": f"Chat failed due to prompt block: {block_reason}."}
+                    return
+                continue
+            chunk_text = "".join(part.text for part in chunk.candidates[0].content.parts if getattr(part, 'text', None))
+            if chunk_text:
+                yield {"text": chunk_text}
+
+        prompt_budgets.record_usage("chat", getattr(response, 'usage_metadata', None))
+        finish_note = chat_finish_note(response.candidates[0]) if response.candidates else ""
+        if finish_note:
+            yield {"text": finish_note}
+    except Exception as e:
+        if gemini_context_cache:
+            gemini_context_cache.discard(chat_request["cached_content"], e)
+        yield chat_generation_error(e)
 
 
 def evaluate_subjective_answer(question, ideal_answer, user_answer, notes_context):
     """Uses Gemini to evaluate a user's short/long answer."""
+    budget = prompt_budgets.start("evaluate")
+    notes_context = budget.fit("text", notes_context or "")
+    budget.finish()
 
     eval_prompt = f"""
 Context: The user was asked the following question based on some study material:
@@ -1379,7 +4350,7 @@ User's Answer: {user_answer}
 
 Relevant Study Notes Snippet (for context):
 ---
-{notes_context[:5000]}
+{notes_context}
 ---
 
 Task: Evaluate the user's answer based on the question and the ideal answer/key points derived from the study notes.
@@ -1416,8 +4387,8 @@ Example Output:
 Return ONLY the JSON object.
 """
     try:
-        eval_model = genai.GenerativeModel(DEFAULT_GEMINI_MODEL) # Use a capable model
-        eval_response = eval_model.generate_content(eval_prompt)
+        eval_model = get_model("evaluate") # Use a capable model (GEMINI_MODEL_EVALUATE to route elsewhere)
+        eval_response = gemini_generate(eval_model, eval_prompt, task="evaluate")
 
         # Robust response handling
         response_text = ""
@@ -1456,14 +4427,21 @@ Return ONLY the JSON object.
         return {"error": f"Failed to evaluate answer: {str(e)}"}
 
 
-def generate_mindmap_data(notes, original_text):
+def generate_mindmap_data(notes, original_text, cached_content=None):
     """Generates mind map data (Mermaid syntax) from notes."""
     if not notes and not original_text:
         return {"error": "Cannot generate mind map without notes or original text."}
 
-    mindmap_context = f"**Study Notes:**\n{notes[:15000]}\n\n**Original Text Snippet:**\n{original_text[:15000]}"
-    if len(notes) > 15000 or len(original_text) > 15000:
-        mindmap_context += "\n\n[... Content truncated for mind map generation prompt ...]"
+    prompt_started = time.perf_counter()
+    budget = prompt_budgets.start("mindmap")
+    if cached_content is not None:
+        mindmap_context = f"**Study Notes:**\n{CACHED_NOTES_PLACEHOLDER}\n\n**Original Text:**\n{CACHED_ORIGINAL_TEXT_PLACEHOLDER}"
+    else:
+        notes_snippet = budget.fit("text", notes, budget.tokens_for("text") // 2)
+        original_text_snippet = budget.fit("text", original_text)
+        mindmap_context = f"**Study Notes:**\n{notes_snippet}\n\n**Original Text Snippet:**\n{original_text_snippet}"
+        if len(notes_snippet) < len(notes) or len(original_text_snippet) < len(original_text):
+            mindmap_context += "\n\n[... Content truncated for mind map generation prompt ...]"
 
     mindmap_prompt = f"""
 Context for Mind Map Generation:
@@ -1513,10 +4491,13 @@ flowchart LR
 
 Generate ONLY the valid Mermaid syntax based on the context provided above.
 """
+    budget.finish()
+    record_stage("prompt_build", time.perf_counter() - prompt_started, task="mindmap",
+                 chars=len(mindmap_prompt), tokens=estimate_tokens(mindmap_prompt), cached_context=cached_content is not None)
     try:
         # Use a model good at structured output
-        mindmap_model = genai.GenerativeModel(DEFAULT_GEMINI_MODEL)
-        mindmap_response = mindmap_model.generate_content(mindmap_prompt)
+        mindmap_model = study_model_for("mindmap", cached_content)
+        mindmap_response = gemini_generate(mindmap_model, mindmap_prompt, task="mindmap")
 
        # Robust response handling (keep existing logic)
         response_text = ""
@@ -1567,6 +4548,8 @@ Generate ONLY the valid Mermaid syntax based on the context provided above.
 
     except Exception as e:
         print(f"Error generating mind map data: {str(e)}")
+        if gemini_context_cache:
+            gemini_context_cache.discard(cached_content, e)
         if "429" in str(e): return {"error": "Rate limit exceeded during mind map generation."}
         return {"error": f"Failed to generate mind map: {str(e)}"}
 
@@ -1574,9 +4557,184 @@ Generate ONLY the valid Mermaid syntax based on the context provided above.
 @app.route('/')
 def index():
     # Pass API Key status to template (optional, for client-side checks/warnings)
-    api_key_set = bool(os.environ.get("GOOGLE_API_KEY"))
+    api_key_set = bool(os.environ.get("GOOGLE_API_KEY")) or API_PROVIDER == "offline"
     return render_template('index.html', api_key_set=api_key_set)
 
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint for the per-stage histograms, size/cache counters and per-task token usage."""
+    if not METRICS_ENABLED:
+        return jsonify({"error": "Metrics are disabled (METRICS_ENABLED=false)."}), 404
+    return Response(stage_metrics.render() + prompt_budgets.render_metrics(), mimetype="text/plain; version=0.0.4")
+
+def parse_process_content_form(form_data, uploaded_files):
+    """Read /api/process-content form fields into an options dict."""
+    options = {
+        "urls": json.loads(form_data.get('urls', '[]')),
+        "topic": form_data.get('topic', '').strip(),
+        "description": form_data.get('description', '').strip(),
+        "web_search": form_data.get('web_search', 'true').lower() == 'true',
+        "generate_quiz": form_data.get('generate_quiz', 'false').lower() == 'true',
+        "generate_flashcards": form_data.get('generate_flashcards', 'false').lower() == 'true',
+        "generate_mindmap": form_data.get('generate_mindmap', 'false').lower() == 'true',
+    }
+    print(f"URLs: {options['urls']}")
+    print(f"Files: {[f.filename for f in uploaded_files]}")
+    print(f"Topic: '{options['topic']}'")
+    print(f"Description: '{options['description'][:50]}...'")
+    print(f"Web Search: {options['web_search']}")
+    print(f"Gen Quiz Initial: {options['generate_quiz']}")
+    print(f"Gen Flashcards Initial: {options['generate_flashcards']}")
+    print(f"Gen Mindmap Initial: {options['generate_mindmap']}")
+    return options
+
+def ingest_url_sources(urls, content_items, errors):
+    """Extract text from all URLs concurrently, appending successes to content_items and failures to errors."""
+    print("Processing URLs...")
+    ingest_start = time.time()
+    for url, content_data in ingest_urls(urls):
+        if 'error' in content_data:
+            print(f"Error processing URL {url}: {content_data['error']}")
+            errors.append(f"URL '{url}': {content_data['error']}")
+        else:
+             print(f"Success processing URL: {url} (Title: {content_data.get('title')})")
+             content_items.append(content_data) # Add text dict
+    if urls:
+        print(f"URL ingestion finished in {time.time() - ingest_start:.2f} seconds")
+
+def ingest_file_sources(uploaded_files, content_items, errors, uploaded_gemini_files_to_release):
+    """Upload all files concurrently. Returns per-file timing dicts."""
+    print("Processing Files (Upload Step)...")
+    valid_files = [f for f in uploaded_files if f and f.filename]
+    if len(valid_files) != len(uploaded_files):
+        print("Empty file part received, skipping.")
+    file_timings = []
+    if not valid_files:
+        return file_timings
+    upload_start = time.time()
+    print(f"Uploading files: {[f.filename for f in valid_files]}")
+    for file_storage, file_result in upload_files_to_gemini(valid_files):
+        file_timings.append({
+            "filename": file_storage.filename,
+            "seconds": file_result.get("processing_seconds"),
+            "cached": file_result.get("cached", False),
+            "status": "error" if 'error' in file_result else "active"
+        })
+        if 'error' in file_result:
+            print(f"Error uploading file {file_storage.filename}: {file_result['error']}")
+            errors.append(f"File Upload '{file_storage.filename}': {file_result['error']}")
+        else:
+             print(f"Success uploading file: {file_storage.filename} (Gemini Name: {file_result['file_object'].name}, {file_result['processing_seconds']}s)")
+             content_items.append(file_result) # Add dict containing {'file_object': ..., 'original_filename': ...}
+             # Add the Gemini file name to the list for release once the request is done
+             uploaded_gemini_files_to_release.append(file_result['file_object'].name)
+    print(f"File uploads finished in {time.time() - upload_start:.2f} seconds")
+    return file_timings
+
+INITIAL_FEATURES = (
+    # (option flag, task name, result key, label for logs/warnings)
+    ("generate_quiz", "quiz", "initial_quiz", "Initial Quiz Generation"),
+    ("generate_flashcards", "flashcards", "initial_flashcards", "Initial Flashcard Generation"),
+    ("generate_mindmap", "mindmap", "initial_mindmap", "Initial Mind Map Generation"),
+)
+
+def generate_initial_features(results, options, errors, should_stop=None):
+    """
+    Optionally generate the initial quiz, flashcards and mind map from freshly generated notes.
+    The three generators are independent, so they run concurrently under a shared deadline;
+    should_stop() is polled while they run so a cancelled job stops waiting for them.
+    """
+    if not results.get('notes'):
+        return
+    notes = results['notes']
+    original_text = results.get('original_text', '') # Use combined *text* input
+    retrieval_index = get_retrieval_index({
+        "content_id": results.get('content_id'),
+        "notes": notes,
+        "original_text": original_text,
+        "from_store": results.get('session_stored', False),
+    })
+    # Create the session's context cache once, before the generators run in parallel
+    study_context = {
+        "content_id": results.get('content_id'),
+        "notes": notes,
+        "original_text": original_text,
+        "from_store": results.get('session_stored', False),
+    }
+    cached_content = {task: get_context_cache(study_context, task) for task in ("quiz", "flashcards", "mindmap")}
+
+    task_fns = {
+        "quiz": lambda deps: generate_quizzes(
+            notes=notes,
+            original_text=original_text,
+            question_types=["MCQ"], # Example defaults
+            num_questions=5,
+            difficulty="Apply",
+            retrieval_index=retrieval_index,
+            cached_content=cached_content["quiz"]
+        ),
+        "flashcards": lambda deps: generate_flashcards(
+            notes=notes,
+            original_text=original_text,
+            num_flashcards=10, # Example default
+            retrieval_index=retrieval_index,
+            cached_content=cached_content["flashcards"]
+        ),
+        "mindmap": lambda deps: generate_mindmap_data(
+            notes=notes,
+            original_text=original_text,
+            cached_content=cached_content["mindmap"]
+        ),
+    }
+    tasks = {name: (task_fns[name], []) for flag, name, _, _ in INITIAL_FEATURES if options[flag]}
+    if not tasks:
+        return
+
+    print(f"Generating initial features concurrently: {', '.join(tasks)}")
+    features_start = time.time()
+    feature_results = run_task_graph(tasks, INITIAL_FEATURES_DEADLINE_SECONDS,
+                                     max_workers=INITIAL_FEATURES_MAX_WORKERS, thread_name_prefix="initial-features",
+                                     should_stop=should_stop)
+
+    for _, name, result_key, label in INITIAL_FEATURES:
+        if name not in feature_results:
+            continue
+        feature_result = feature_results[name]
+        if 'error' in feature_result:
+            print(f"Error in {label}: {feature_result['error']}")
+            errors.append(f"{label}: {feature_result['error']}")
+        else:
+            print(f"{label} done.")
+            results[result_key] = feature_result
+    print(f"Initial features finished in {time.time() - features_start:.2f} seconds")
+
+def release_gemini_files(file_names):
+    """Release successfully uploaded Gemini files (cached handles are kept for reuse)."""
+    if file_names:
+        print(f"Releasing {len(file_names)} successfully processed Gemini files...")
+        for file_name in file_names:
+            release_gemini_file(file_name)
+
+def log_request_stats(start_time):
+    print(f"--- process-content finished in {time.time() - start_time:.2f} seconds ---")
+    print(f"HTTP client stats: {get_http_stats()}")
+    print(f"Extraction cache stats: {get_extraction_cache_stats()}")
+    print(f"Search cache stats: {get_search_cache_stats()}")
+    print(f"Study session store stats: {get_study_session_stats()}")
+    print(f"Gemini context cache stats: {get_context_cache_stats()}")
+    print(f"Gemini model registry stats: {gemini_models.stats()}")
+    print(f"Gemini request coalescing stats: {gemini_coalescer.stats()}")
+    print(f"Batch salvage stats: {get_batch_salvage_stats()}")
+    if API_PROVIDER == "offline":
+        print(f"Offline provider stats: {genai_api.stats()}")
+    print(f"Rate limiter stats: gemini={gemini_rate_limiter.stats()} custom_search={custom_search_rate_limiter.stats()}")
+    print(f"Stage timings: {request_stage_summary()}")
+    print(f"Prompt budget stats: {get_prompt_budget_stats()}")
+    print(f"Job queue stats: {get_job_queue_stats()}")
+
+NO_INPUT_ERROR = "No input provided. Please add URLs, upload files, or enter a topic and description."
+NO_CONTENT_ERROR = "Failed to retrieve or upload valid content from any source."
+
 @app.route('/api/process-content', methods=['POST'])
 def process_content_route():
     start_time = time.time()
@@ -1584,87 +4742,36 @@ def process_content_route():
     results = {}
     errors = []
     content_items = [] # Will store text dicts AND file upload result dicts
-    uploaded_gemini_files_to_delete = [] # Keep track of successful uploads
+    uploaded_gemini_files_to_release = [] # Keep track of successful uploads
 
     try:
         # --- 1. Extract Data from Request ---
-        form_data = request.form
         uploaded_files = request.files.getlist('files') # FileStorage objects
+        options = parse_process_content_form(request.form, uploaded_files)
+        topic, description = options['topic'], options['description']
 
-        urls = json.loads(form_data.get('urls', '[]'))
-        topic = form_data.get('topic', '').strip()
-        description = form_data.get('description', '').strip()
-        web_search = form_data.get('web_search', 'true').lower() == 'true'
-        generate_quiz_initially = form_data.get('generate_quiz', 'false').lower() == 'true'
-        generate_flashcards_initially = form_data.get('generate_flashcards', 'false').lower() == 'true'
-        generate_mindmap_initially = form_data.get('generate_mindmap', 'false').lower() == 'true'
-
-        print(f"URLs: {urls}")
-        print(f"Files: {[f.filename for f in uploaded_files]}")
-        print(f"Topic: '{topic}'")
-        print(f"Description: '{description[:50]}...'")
-        print(f"Web Search: {web_search}")
-        print(f"Gen Quiz Initial: {generate_quiz_initially}")
-        print(f"Gen Flashcards Initial: {generate_flashcards_initially}")
-        print(f"Gen Mindmap Initial: {generate_mindmap_initially}")
-
-        if not urls and not uploaded_files and not (topic and description):
-            return jsonify({"error": "No input provided. Please add URLs, upload files, or enter a topic and description."}), 400
-
-        # --- 2. Process URLs (Extract Text) ---
-        print("Processing URLs...")
-        for url in urls:
-            url = url.strip()
-            if not url: continue
-            print(f"Processing URL: {url}")
-            if 'youtube.com' in url or 'youtu.be' in url:
-                content_data = extract_from_youtube(url) # Existing function
-            else:
-                content_data = extract_from_website(url) # Existing function
+        if not options['urls'] and not uploaded_files and not (topic and description):
+            return jsonify({"error": NO_INPUT_ERROR}), 400
 
-            if 'error' in content_data:
-                print(f"Error processing URL {url}: {content_data['error']}")
-                errors.append(f"URL '{url}': {content_data['error']}")
-            else:
-                 print(f"Success processing URL: {url} (Title: {content_data.get('title')})")
-                 content_items.append(content_data) # Add text dict
+        # --- 2. Process URLs (Extract Text, concurrently) ---
+        ingest_url_sources(options['urls'], content_items, errors)
 
-        # --- 3. Process Files (Upload Only) ---
-        print("Processing Files (Upload Step)...")
-        if uploaded_files:
-             for file_storage in uploaded_files:
-                 if file_storage and file_storage.filename:
-                     print(f"Uploading file: {file_storage.filename}")
-                     # Use the new upload function
-                     file_result = upload_file_to_gemini(file_storage)
-                     if 'error' in file_result:
-                         print(f"Error uploading file {file_storage.filename}: {file_result['error']}")
-                         errors.append(f"File Upload '{file_storage.filename}': {file_result['error']}")
-                     else:
-                          print(f"Success uploading file: {file_storage.filename} (Gemini Name: {file_result['file_object'].name})")
-                          content_items.append(file_result) # Add dict containing {'file_object': ..., 'original_filename': ...}
-                          # Add the Gemini file name to the list for later deletion
-                          uploaded_gemini_files_to_delete.append(file_result['file_object'].name)
-                 else:
-                     print("Empty file part received, skipping.")
+        # --- 3. Process Files (Upload Only, concurrently) ---
+        file_timings = ingest_file_sources(uploaded_files, content_items, errors, uploaded_gemini_files_to_release)
+        if file_timings:
+            results['file_upload_timings'] = file_timings
 
         # --- 4. Check if *any* content can be processed ---
         # Check if content_items has *any* non-error items or if topic/desc exists
         has_processable_content = any('error' not in item for item in content_items) or (topic or description)
         if not has_processable_content:
-             error_message = "Failed to retrieve or upload valid content from any source."
-             print(error_message, "Errors:", errors)
-             # Clean up any files that *did* upload successfully before failing others
-             if uploaded_gemini_files_to_delete:
-                 print(f"Cleaning up {len(uploaded_gemini_files_to_delete)} Gemini files due to overall content failure.")
-                 for file_name in uploaded_gemini_files_to_delete:
-                     try: genai_api.delete_file(file_name)
-                     except Exception as del_err: print(f"Warning: Failed to delete Gemini file {file_name}: {del_err}")
-             return jsonify({"error": error_message, "details": errors}), 400
+             print(NO_CONTENT_ERROR, "Errors:", errors)
+             # Files that *did* upload successfully are released in the finally block
+             return jsonify({"error": NO_CONTENT_ERROR, "details": errors}), 400
 
         # --- 5. Generate Notes (Core Multimodal Processing) ---
         print("Generating Notes (Multimodal)...")
-        notes_result = process_content(content_items, topic, description, web_search) # Pass the mixed list
+        notes_result = process_content(content_items, topic, description, options['web_search']) # Pass the mixed list
 
         if 'error' in notes_result:
             print(f"Error generating notes: {notes_result['error']}")
@@ -1674,58 +4781,13 @@ def process_content_route():
         else:
             print("Notes generated successfully.")
             results.update(notes_result)
-            # Keep track of file names processed within notes_result if needed, though we already have them
-            # file_names_processed_in_notes = notes_result.get("processed_file_names", [])
-
-        # --- 6. Optionally Generate Quiz (Based on generated notes & original *text*) ---
-        if generate_quiz_initially and results.get('notes'):
-            print("Generating Initial Quiz...")
-            quiz_result = generate_quizzes(
-                notes=results['notes'],
-                original_text=results.get('original_text', ''), # Use combined *text* input
-                question_types=["MCQ"], # Example defaults
-                num_questions=5,
-                difficulty="Apply"
-            )
-            if 'error' in quiz_result:
-                print(f"Error generating initial quiz: {quiz_result['error']}")
-                errors.append(f"Initial Quiz Generation: {quiz_result['error']}")
-            else:
-                print("Initial quiz generated.")
-                results['initial_quiz'] = quiz_result
-
-        # --- 7. Optionally Generate Flashcards (Based on generated notes & original *text*) ---
-        if generate_flashcards_initially and results.get('notes'):
-            print("Generating Initial Flashcards...")
-            flashcard_result = generate_flashcards(
-                notes=results['notes'],
-                original_text=results.get('original_text', ''), # Use combined *text* input
-                num_flashcards=10 # Example default
-            )
-            if 'error' in flashcard_result:
-                print(f"Error generating initial flashcards: {flashcard_result['error']}")
-                errors.append(f"Initial Flashcard Generation: {flashcard_result['error']}")
-            else:
-                print("Initial flashcards generated.")
-                results['initial_flashcards'] = flashcard_result
-
-        # --- 8. Optionally Generate Mind Map (Based on generated notes & original *text*) ---
-        if generate_mindmap_initially and results.get('notes'):
-            print("Generating Initial Mind Map...")
-            mindmap_result = generate_mindmap_data(
-                notes=results['notes'],
-                original_text=results.get('original_text', '') # Use combined *text* input
-            )
-            if 'error' in mindmap_result:
-                print(f"Error generating initial mind map: {mindmap_result['error']}")
-                errors.append(f"Initial Mind Map Generation: {mindmap_result['error']}")
-            else:
-                print("Initial mind map generated.")
-                results['initial_mindmap'] = mindmap_result
+            results['session_stored'] = save_study_session(results)
+
+        # --- 6. Optionally Generate Quiz / Flashcards / Mind Map ---
+        generate_initial_features(results, options, errors)
 
-        # --- 9. Final Response ---
-        end_time = time.time()
-        print(f"--- process-content finished in {end_time - start_time:.2f} seconds ---")
+        # --- 7. Final Response ---
+        log_request_stats(start_time)
 
         final_response = {
             "data": results,
@@ -1740,16 +4802,586 @@ def process_content_route():
         return jsonify({"error": f"An unexpected server error occurred: {str(e)}"}), 500
 
     finally:
-        # --- Clean up successfully uploaded Gemini files ---
-        if uploaded_gemini_files_to_delete:
-            print(f"Cleaning up {len(uploaded_gemini_files_to_delete)} successfully processed Gemini files...")
-            for file_name in uploaded_gemini_files_to_delete:
-                try:
-                    genai_api.delete_file(file_name)
-                    print(f"Deleted Gemini file: {file_name}")
-                except Exception as delete_error:
-                    # Log but don't fail the request
-                    print(f"Warning: Failed to delete Gemini file {file_name}: {delete_error}")
+        # --- Release successfully uploaded Gemini files (cached handles are kept for reuse) ---
+        release_gemini_files(uploaded_gemini_files_to_release)
+
+def sse_event(event, data, event_id=None):
+    """Format one Server-Sent Event."""
+    id_line = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{id_line}event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def process_content_events(options, uploaded_files, should_stop=None):
+    """
+    Run the full process-content pipeline, yielding (event, data) tuples: `progress` per
+    stage, `notes_chunk` as Gemini streams the notes, then one `complete` event carrying
+    the same payload as /api/process-content (or an `error` event). Shared by the SSE
+    route and background jobs; jobs pass should_stop so a cancel also interrupts the
+    feature stage, which yields no events of its own (ending with a `cancelled` event).
+    """
+    topic, description = options['topic'], options['description']
+    start_time = time.time()
+    results = {}
+    errors = []
+    content_items = []
+    uploaded_gemini_files_to_release = []
+    try:
+        if options['urls']:
+            yield "progress", {"stage": "ingestion", "message": f"Fetching {len(options['urls'])} URL(s)..."}
+            ingest_url_sources(options['urls'], content_items, errors)
+            yield "progress", {"stage": "ingestion_done", "message": "Content fetched.", "sources": len(content_items)}
+
+        if uploaded_files:
+            yield "progress", {"stage": "uploads", "message": f"Uploading {len(uploaded_files)} file(s)..."}
+            file_timings = ingest_file_sources(uploaded_files, content_items, errors, uploaded_gemini_files_to_release)
+            if file_timings:
+                results['file_upload_timings'] = file_timings
+            yield "progress", {"stage": "uploads_active", "message": "Files processed.", "files": file_timings}
+
+        has_processable_content = any('error' not in item for item in content_items) or (topic or description)
+        if not has_processable_content:
+            print(NO_CONTENT_ERROR, "Errors:", errors)
+            yield "error", {"error": NO_CONTENT_ERROR, "details": errors}
+            return
+
+        if options['web_search']:
+            yield "progress", {"stage": "web_search", "message": "Searching the web for additional context..."}
+        notes_request = prepare_notes_request(content_items, topic, description, options['web_search'])
+        if 'error' in notes_request:
+            errors.append(f"Notes Generation: {notes_request['error']}")
+            yield "error", with_retry_after({"error": "Failed to generate study notes.", "details": errors}, notes_request)
+            return
+        if options['web_search']:
+            yield "progress", {"stage": "web_search_done", "message": "Web search done.", "web_sources": len(notes_request['web_sources'])}
+
+        yield "progress", {"stage": "notes", "message": "Generating notes..."}
+        notes_chunks = []
+        for item in stream_notes(notes_request):
+            if 'error' in item:
+                print(f"Error generating notes: {item['error']}")
+                errors.append(f"Notes Generation: {item['error']}")
+                yield "error", with_retry_after({"error": "Failed to generate study notes.", "details": errors}, item)
+                return
+            notes_chunks.append(item['text'])
+            yield "notes_chunk", {"text": item['text']}
+
+        print("Notes generated successfully.")
+        results.update(finalize_notes(notes_request, "".join(notes_chunks)))
+        results['session_stored'] = save_study_session(results)
+
+        if options['generate_quiz'] or options['generate_flashcards'] or options['generate_mindmap']:
+            yield "progress", {"stage": "features", "message": "Generating quiz, flashcards and mind map..."}
+            generate_initial_features(results, options, errors, should_stop)
+            if should_stop is not None and should_stop():
+                yield "cancelled", {"error": "Job cancelled."}
+                return
+
+        log_request_stats(start_time)
+        yield "complete", {"data": results, "warnings": errors}
+    except Exception as e:
+        print(f"--- Unhandled exception in process-content pipeline: {str(e)} ---")
+        import traceback
+        traceback.print_exc()
+        yield "error", with_retry_after({"error": f"An unexpected server error occurred: {str(e)}"})
+    finally:
+        release_gemini_files(uploaded_gemini_files_to_release)
+
+@app.route('/api/process-content/stream', methods=['POST'])
+def process_content_stream_route():
+    """
+    Streaming variant of /api/process-content using Server-Sent Events.
+    Emits `progress` events per stage, `notes_chunk` events as Gemini streams
+    the notes, then a single `complete` event carrying the same payload as the
+    non-streaming route (or an `error` event).
+    """
+    print("\n--- Received /api/process-content/stream request ---")
+    uploaded_files = request.files.getlist('files') # FileStorage objects
+    options = parse_process_content_form(request.form, uploaded_files)
+    topic, description = options['topic'], options['description']
+    if not options['urls'] and not uploaded_files and not (topic and description):
+        return jsonify({"error": NO_INPUT_ERROR}), 400
+
+    def generate():
+        for event, data in process_content_events(options, uploaded_files):
+            yield sse_event(event, data)
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no' # Disable proxy buffering (nginx)
+    return response
+
+# --- Background Jobs (SQLite-backed queue + worker pool for process-content) ---
+JOB_QUEUE_ENABLED = os.environ.get("JOB_QUEUE_ENABLED", "true").lower() == "true"
+JOB_STORE_PATH = os.environ.get("JOB_STORE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), f"{LOCAL_DB_PREFIX}jobs.db"))
+JOB_UPLOAD_DIR = os.environ.get("JOB_UPLOAD_DIR", os.path.join(tempfile.gettempdir(), "study_assistant_jobs"))
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2")) # Per process; every process sharing JOB_STORE_PATH claims from the same queue
+JOB_POLL_INTERVAL_SECONDS = float(os.environ.get("JOB_POLL_INTERVAL_SECONDS", "1")) # Idle workers re-check for jobs queued by other processes
+JOB_PARTIAL_FLUSH_SECONDS = float(os.environ.get("JOB_PARTIAL_FLUSH_SECONDS", "0.5")) # Notes chunks are batched into one event per interval
+JOB_HEARTBEAT_SECONDS = float(os.environ.get("JOB_HEARTBEAT_SECONDS", "10"))
+JOB_LEASE_SECONDS = float(os.environ.get("JOB_LEASE_SECONDS", "120")) # Running jobs without a heartbeat this long are failed
+JOB_TTL_SECONDS = int(os.environ.get("JOB_TTL_SECONDS", str(24 * 3600))) # Finished jobs (and their events) are kept this long
+JOB_EVENTS_POLL_SECONDS = float(os.environ.get("JOB_EVENTS_POLL_SECONDS", "0.5"))
+JOB_EVENTS_STREAM_SECONDS = float(os.environ.get("JOB_EVENTS_STREAM_SECONDS", "25")) # Each events request ends after this; clients reconnect
+JOB_EVENTS_KEEPALIVE_SECONDS = 15
+JOB_EVENTS_RETRY_MS = 2000 # EventSource reconnect delay hint
+JOB_TERMINAL_EVENTS = {"complete": "succeeded", "error": "failed", "cancelled": "cancelled"}
+
+class JobStore:
+    """
+    SQLite-backed job queue: one row per job (status, current stage, partial notes,
+    compressed result) plus an append-only event log that clients can poll or replay
+    from a Last-Event-ID. Claims are conditional UPDATEs, so several processes can
+    share one database file.
+    """
+    def __init__(self, path, ttl_seconds):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._stats = {"submitted": 0, "claimed": 0, "succeeded": 0, "failed": 0, "cancelled": 0, "lost": 0, "purged": 0}
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                status TEXT NOT NULL,
+                payload BLOB NOT NULL,
+                stage TEXT,
+                message TEXT,
+                partial_notes TEXT NOT NULL DEFAULT '',
+                result BLOB,
+                error TEXT,
+                cancel_requested INTEGER NOT NULL DEFAULT 0,
+                worker TEXT,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                heartbeat_at REAL
+            )""")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS job_events (
+                event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_id TEXT NOT NULL,
+                event TEXT NOT NULL,
+                data TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_queue ON jobs (status, created_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_job_events_job ON job_events (job_id, event_id)")
+        self._conn.commit()
+
+    def create(self, job_id, kind, payload):
+        blob = zlib.compress(json.dumps(payload).encode('utf-8'))
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (job_id, kind, status, payload, stage, message, created_at) VALUES (?, ?, 'queued', ?, 'queued', ?, ?)",
+                (job_id, kind, blob, "Waiting for a worker...", time.time())
+            )
+            self._conn.commit()
+            self._stats["submitted"] += 1
+
+    def claim(self, worker):
+        """Move the oldest queued job to running and return {"job_id", "kind", "payload"}, or None."""
+        now = time.time()
+        with self._lock:
+            lost = self._conn.execute(
+                "SELECT job_id FROM jobs WHERE status = 'running' AND heartbeat_at < ?", (now - JOB_LEASE_SECONDS,)
+            ).fetchall()
+            for (job_id,) in lost:
+                self._finish_locked(job_id, "error", {"error": "The worker running this job stopped responding."}, now)
+                self._stats["lost"] += 1
+            while True:
+                row = self._conn.execute(
+                    "SELECT job_id, kind, payload FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+                ).fetchone()
+                if row is None:
+                    self._conn.commit()
+                    return None
+                cursor = self._conn.execute(
+                    "UPDATE jobs SET status = 'running', stage = 'starting', message = 'Starting...', worker = ?, started_at = ?, heartbeat_at = ? "
+                    "WHERE job_id = ? AND status = 'queued'",
+                    (worker, now, now, row[0])
+                )
+                self._conn.commit()
+                if cursor.rowcount == 1: # Otherwise another process claimed it first
+                    self._stats["claimed"] += 1
+                    return {"job_id": row[0], "kind": row[1], "payload": json.loads(zlib.decompress(row[2]).decode('utf-8'))}
+
+    def append_event(self, job_id, event, data):
+        """
+        Record a progress/notes_chunk event and fold it into the job row; terminal events finish
+        the job. A job flagged for cancellation finishes as cancelled even if its result arrived,
+        so every accepted cancel request is honoured.
+        """
+        now = time.time()
+        with self._lock:
+            if event in JOB_TERMINAL_EVENTS:
+                if event == "complete" and self._conn.execute(
+                        "SELECT cancel_requested FROM jobs WHERE job_id = ?", (job_id,)).fetchone()[0]:
+                    event, data = "cancelled", {"error": "Job cancelled."}
+                self._finish_locked(job_id, event, data, now)
+            else:
+                self._conn.execute("INSERT INTO job_events (job_id, event, data, created_at) VALUES (?, ?, ?, ?)",
+                                   (job_id, event, json.dumps(data), now))
+                if event == "notes_chunk":
+                    self._conn.execute("UPDATE jobs SET partial_notes = partial_notes || ?, stage = 'notes', heartbeat_at = ? WHERE job_id = ?",
+                                       (data.get("text", ""), now, job_id))
+                else:
+                    self._conn.execute("UPDATE jobs SET stage = ?, message = ?, heartbeat_at = ? WHERE job_id = ?",
+                                       (data.get("stage", event), data.get("message"), now, job_id))
+            self._conn.commit()
+
+    def _finish_locked(self, job_id, event, data, now):
+        status = JOB_TERMINAL_EVENTS[event]
+        result = zlib.compress(json.dumps(data).encode('utf-8')) if status == "succeeded" else None
+        error = None if status == "succeeded" else json.dumps(data)
+        # The full notes are in the result, so the partial copy is dropped
+        self._conn.execute(
+            "UPDATE jobs SET status = ?, stage = ?, message = NULL, result = ?, error = ?, finished_at = ?, "
+            "partial_notes = CASE WHEN ? = 'succeeded' THEN '' ELSE partial_notes END WHERE job_id = ?",
+            (status, status, result, error, now, status, job_id)
+        )
+        # The terminal event carries no payload in the log; clients fetch the result from the job itself
+        self._conn.execute("INSERT INTO job_events (job_id, event, data, created_at) VALUES (?, ?, ?, ?)",
+                           (job_id, event, json.dumps({"status": status} if status == "succeeded" else data), now))
+        self._stats[status] += 1
+
+    def heartbeat(self, job_ids):
+        if not job_ids:
+            return
+        with self._lock:
+            now = time.time()
+            self._conn.executemany("UPDATE jobs SET heartbeat_at = ? WHERE job_id = ? AND status = 'running'",
+                                   [(now, job_id) for job_id in job_ids])
+            self._conn.commit()
+
+    def request_cancel(self, job_id):
+        """Cancel a queued job at once, or flag a running one for its worker. Returns the job's status, or None if unknown."""
+        with self._lock:
+            row = self._conn.execute("SELECT status FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            if row[0] == "queued":
+                self._finish_locked(job_id, "cancelled", {"error": "Job cancelled."}, time.time())
+            elif row[0] == "running":
+                self._conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE job_id = ?", (job_id,))
+            self._conn.commit()
+            return self._conn.execute("SELECT status FROM jobs WHERE job_id = ?", (job_id,)).fetchone()[0]
+
+    def cancel_requested(self, job_id):
+        with self._lock:
+            row = self._conn.execute("SELECT cancel_requested FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT job_id, kind, status, stage, message, partial_notes, result, error, created_at, started_at, finished_at "
+                "FROM jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        keys = ("job_id", "kind", "status", "stage", "message", "partial_notes", "result", "error", "created_at", "started_at", "finished_at")
+        job = dict(zip(keys, row))
+        job["result"] = json.loads(zlib.decompress(job["result"]).decode('utf-8')) if job["result"] is not None else None
+        job["error"] = json.loads(job["error"]) if job["error"] else None
+        return job
+
+    def events_after(self, job_id, after_event_id=0, limit=500):
+        """[(event_id, event, data)] logged for job_id after after_event_id, oldest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT event_id, event, data FROM job_events WHERE job_id = ? AND event_id > ? ORDER BY event_id LIMIT ?",
+                (job_id, after_event_id, limit)
+            ).fetchall()
+        return [(event_id, event, json.loads(data)) for event_id, event, data in rows]
+
+    def purge_expired(self):
+        """Delete finished jobs older than the TTL. Returns their job IDs (for upload cleanup)."""
+        cutoff = time.time() - self.ttl_seconds
+        with self._lock:
+            job_ids = [r[0] for r in self._conn.execute(
+                "SELECT job_id FROM jobs WHERE status IN ('succeeded', 'failed', 'cancelled') AND finished_at < ?", (cutoff,))]
+            self._conn.executemany("DELETE FROM job_events WHERE job_id = ?", [(j,) for j in job_ids])
+            self._conn.executemany("DELETE FROM jobs WHERE job_id = ?", [(j,) for j in job_ids])
+            self._conn.commit()
+            self._stats["purged"] += len(job_ids)
+        return job_ids
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["by_status"] = dict(self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        return stats
+
+def stage_job_uploads(job_id, uploaded_files):
+    """Copy a request's uploads out of its spooled files so a worker can read them after the request ends."""
+    staged = []
+    for index, file_storage in enumerate(f for f in uploaded_files if f and f.filename):
+        path = os.path.join(JOB_UPLOAD_DIR, f"{job_id}-{index}")
+        with open(path, "wb") as out:
+            shutil.copyfileobj(file_storage.stream, out, UPLOAD_READ_CHUNK_BYTES)
+        staged.append({"path": path, "filename": file_storage.filename, "content_type": file_storage.content_type})
+    return staged
+
+def remove_job_uploads(job_id):
+    for path in pathlib.Path(JOB_UPLOAD_DIR).glob(f"{job_id}-*"):
+        try:
+            path.unlink()
+        except OSError as e:
+            print(f"Warning: Could not remove staged upload {path}: {e}")
+
+def process_content_job_events(payload, should_stop):
+    """process_content_events() over a job's staged uploads, removing them once the job is done."""
+    files = [FileStorage(stream=open(f["path"], "rb"), filename=f["filename"], content_type=f["content_type"])
+             for f in payload["files"]]
+    try:
+        yield from process_content_events(payload["options"], files, should_stop)
+    finally:
+        for file_storage in files:
+            file_storage.stream.close()
+
+JOB_KINDS = {"process_content": process_content_job_events} # kind -> fn(payload, should_stop) yielding (event, data)
+
+class JobWorkerPool:
+    """
+    Worker threads that claim jobs from a JobStore, run them and log their events.
+    Notes chunks are batched every JOB_PARTIAL_FLUSH_SECONDS; cancellation is checked
+    between events and passed to the job as should_stop for stages that yield none.
+    Threads start on first use, so importing the app starts nothing.
+    """
+    def __init__(self, store, max_workers):
+        self.store = store
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._threads = []
+        self._running = set() # job IDs being run in this process (heartbeated)
+
+    def ensure_started(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.max_workers):
+                thread = threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            threading.Thread(target=self._heartbeat, name="job-heartbeat", daemon=True).start()
+
+    def notify(self):
+        with self._wakeup:
+            self._wakeup.notify()
+
+    def _work(self):
+        worker = f"{os.getpid()}:{threading.current_thread().name}"
+        while True:
+            try:
+                job = self.store.claim(worker)
+            except Exception as e:
+                print(f"Job worker {worker} could not claim a job: {e}")
+                job = None
+            if job is None:
+                for job_id in self.store.purge_expired():
+                    remove_job_uploads(job_id)
+                with self._wakeup:
+                    self._wakeup.wait(JOB_POLL_INTERVAL_SECONDS)
+                continue
+            with self._lock:
+                self._running.add(job["job_id"])
+            try:
+                self._run(job)
+            finally:
+                with self._lock:
+                    self._running.discard(job["job_id"])
+                remove_job_uploads(job["job_id"])
+
+    def _run(self, job):
+        job_id = job["job_id"]
+        print(f"\n--- Running job {job_id} ({job['kind']}) ---")
+        begin_request_trace()
+        pending_text = []
+        last_flush = time.time()
+
+        def flush_notes():
+            nonlocal last_flush
+            if pending_text:
+                self.store.append_event(job_id, "notes_chunk", {"text": "".join(pending_text)})
+                pending_text.clear()
+            last_flush = time.time()
+
+        events = JOB_KINDS[job["kind"]](job["payload"], lambda: self.store.cancel_requested(job_id))
+        try:
+            for event, data in events:
+                if event == "notes_chunk":
+                    pending_text.append(data["text"])
+                    if time.time() - last_flush < JOB_PARTIAL_FLUSH_SECONDS:
+                        continue
+                    flush_notes()
+                else:
+                    flush_notes()
+                    self.store.append_event(job_id, event, data)
+                    if event in JOB_TERMINAL_EVENTS:
+                        return
+                if self.store.cancel_requested(job_id):
+                    print(f"Job {job_id} cancelled.")
+                    self.store.append_event(job_id, "cancelled", {"error": "Job cancelled."})
+                    return
+            flush_notes()
+            self.store.append_event(job_id, "error", {"error": "Job ended without a result."})
+        except Exception as e:
+            print(f"--- Job {job_id} failed: {e} ---")
+            self.store.append_event(job_id, "error", {"error": f"An unexpected server error occurred: {str(e)}"})
+        finally:
+            events.close() # Runs the pipeline's cleanup (Gemini file release) if it stopped early
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(JOB_HEARTBEAT_SECONDS)
+            with self._lock:
+                running = list(self._running)
+            try:
+                self.store.heartbeat(running)
+            except Exception as e:
+                print(f"Warning: Job heartbeat failed: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {"workers": len(self._threads), "running": len(self._running)}
+
+def _create_job_store():
+    if not JOB_QUEUE_ENABLED:
+        return None
+    try:
+        os.makedirs(JOB_UPLOAD_DIR, exist_ok=True)
+        return JobStore(JOB_STORE_PATH, JOB_TTL_SECONDS)
+    except Exception as e:
+        print(f"Warning: Background jobs disabled, could not open {JOB_STORE_PATH}: {e}")
+        return None
+
+job_store = _create_job_store()
+job_workers = JobWorkerPool(job_store, JOB_WORKERS) if job_store else None
+
+def get_job_queue_stats():
+    if not job_store:
+        return {"enabled": False}
+    return {**job_store.stats(), **job_workers.stats()}
+
+def _iso_timestamp(value):
+    return datetime.fromtimestamp(value, timezone.utc).isoformat() if value else None
+
+def job_status_payload(job):
+    payload = {
+        "job_id": job["job_id"],
+        "kind": job["kind"],
+        "status": job["status"],
+        "stage": job["stage"],
+        "message": job["message"],
+        "created_at": _iso_timestamp(job["created_at"]),
+        "started_at": _iso_timestamp(job["started_at"]),
+        "finished_at": _iso_timestamp(job["finished_at"]),
+        "events_url": f"/api/jobs/{job['job_id']}/events",
+    }
+    if job["partial_notes"]:
+        payload["partial_notes"] = job["partial_notes"]
+    if job["result"] is not None:
+        payload["result"] = job["result"] # Same shape as the /api/process-content response
+    if job["error"] is not None:
+        payload["error"] = job["error"]
+    return payload
+
+@app.route('/api/process-content/jobs', methods=['POST'])
+def submit_process_content_job_route():
+    """
+    Job variant of /api/process-content: stages the uploads, queues the work and returns
+    202 with the job ID at once. Poll GET /api/jobs/<id> or subscribe to its events.
+    """
+    print("\n--- Received /api/process-content/jobs request ---")
+    if not job_store:
+        return jsonify({"error": "Background jobs are disabled on this server (JOB_QUEUE_ENABLED=false)."}), 503
+    uploaded_files = request.files.getlist('files') # FileStorage objects
+    options = parse_process_content_form(request.form, uploaded_files)
+    if not options['urls'] and not uploaded_files and not (options['topic'] and options['description']):
+        return jsonify({"error": NO_INPUT_ERROR}), 400
+
+    job_id = uuid.uuid4().hex
+    try:
+        staged_files = stage_job_uploads(job_id, uploaded_files)
+        job_store.create(job_id, "process_content", {"options": options, "files": staged_files})
+    except Exception as e:
+        remove_job_uploads(job_id)
+        print(f"Error queueing job {job_id}: {e}")
+        return jsonify({"error": f"Could not queue the job: {str(e)}"}), 500
+    job_workers.ensure_started()
+    job_workers.notify()
+    print(f"Queued job {job_id} with {len(staged_files)} staged file(s).")
+    status_url = f"/api/jobs/{job_id}"
+    return jsonify({"job_id": job_id, "status": "queued", "status_url": status_url, "events_url": f"{status_url}/events"}), 202, {"Location": status_url}
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status_route(job_id):
+    """Job status, current stage, notes generated so far and, once finished, the result or error."""
+    job = job_store.get(job_id) if job_store else None
+    if job is None:
+        return jsonify({"error": "Job not found. It may have expired."}), 404
+    if job["status"] in ("queued", "running"):
+        job_workers.ensure_started() # Pick up jobs queued before this process started
+    return jsonify(job_status_payload(job)), 200
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+def cancel_job_route(job_id):
+    """
+    Cancel a queued job, or ask a running job to stop after its current step (202). A job
+    that has already succeeded or failed cannot be cancelled (409).
+    """
+    status = job_store.request_cancel(job_id) if job_store else None
+    if status is None:
+        return jsonify({"error": "Job not found. It may have expired."}), 404
+    if status in ("succeeded", "failed"):
+        return jsonify({"job_id": job_id, "status": status, "cancel_requested": False,
+                        "error": f"Job already {status}; it was not cancelled."}), 409
+    return jsonify({"job_id": job_id, "status": status, "cancel_requested": status == "running"}), 202 if status == "running" else 200
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def job_events_route(job_id):
+    """
+    Server-Sent Events for a job: replays its logged events after Last-Event-ID (or ?after=),
+    then follows new ones until a terminal event or JOB_EVENTS_STREAM_SECONDS, whichever comes
+    first, so a long job never holds a request worker for its whole run. EventSource reconnects
+    with Last-Event-ID and resumes without gaps. The `complete` event carries the full result.
+    """
+    job = job_store.get(job_id) if job_store else None
+    if job is None:
+        return jsonify({"error": "Job not found. It may have expired."}), 404
+    job_workers.ensure_started()
+    try:
+        after_event_id = int(request.headers.get('Last-Event-ID') or request.args.get('after', 0))
+    except ValueError:
+        after_event_id = 0
+
+    def generate():
+        nonlocal after_event_id
+        yield f"retry: {int(JOB_EVENTS_RETRY_MS)}\n\n"
+        last_sent = time.time()
+        deadline = last_sent + JOB_EVENTS_STREAM_SECONDS
+        while True:
+            for event_id, event, data in job_store.events_after(job_id, after_event_id):
+                after_event_id = event_id
+                if event == "complete":
+                    data = (job_store.get(job_id) or {}).get("result") or data
+                yield sse_event(event, data, event_id)
+                last_sent = time.time()
+                if event in JOB_TERMINAL_EVENTS:
+                    return
+            if time.time() >= deadline:
+                return # The client reconnects after `retry` and picks up from its Last-Event-ID
+            if time.time() - last_sent >= JOB_EVENTS_KEEPALIVE_SECONDS:
+                yield ": keepalive\n\n" # Keeps proxies from closing an idle stream
+                last_sent = time.time()
+            time.sleep(JOB_EVENTS_POLL_SECONDS)
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no' # Disable proxy buffering (nginx)
+    return response
 
 # --- Routes for Generating Features On-Demand ---
 
@@ -1757,8 +5389,11 @@ def process_content_route():
 def generate_quizzes_route():
     print("Received /api/generate-quizzes request")
     data = request.json
-    notes = data.get('notes')
-    original_text = data.get('original_text')
+    context = load_study_context(data)
+    if 'error' in context:
+        return jsonify({"error": context['error']}), context['status_code']
+    notes = context['notes']
+    original_text = context['original_text']
     # Existing questions are less relevant if replacing, but backend handles it
     existing_questions = data.get('existing_questions', '[]')
     question_types = data.get('question_types', ["MCQ"])
@@ -1774,7 +5409,8 @@ def generate_quizzes_route():
          difficulty = "Apply"
 
     # Pass the difficulty to the generation function
-    result = generate_quizzes(notes, original_text, existing_questions, question_types, num_questions, difficulty)
+    result = generate_quizzes(notes, original_text, existing_questions, question_types, num_questions, difficulty,
+                              retrieval_index=get_retrieval_index(context), cached_content=get_context_cache(context, "quiz"))
     if 'error' in result:
         # Return 500 for server-side errors, 400 for specific known issues like safety blocks
         status_code = 500
@@ -1782,7 +5418,7 @@ def generate_quizzes_route():
             status_code = 400
         elif "parse quiz json" in result.get("error","").lower() or "incorrect structure" in result.get("error","").lower():
             status_code = 500 # Internal error likely from LLM structure
-        return jsonify(result), status_code
+        return rate_limited_error_response(result, status_code)
     print("Quiz generation successful.")
     return jsonify(result), 200
 
@@ -1790,17 +5426,21 @@ def generate_quizzes_route():
 def generate_flashcards_route():
     print("Received /api/generate-flashcards request")
     data = request.json
-    notes = data.get('notes')
-    original_text = data.get('original_text')
+    context = load_study_context(data)
+    if 'error' in context:
+        return jsonify({"error": context['error']}), context['status_code']
+    notes = context['notes']
+    original_text = context['original_text']
     existing_flashcards = data.get('existing_flashcards', '[]') # Pass as JSON string
     num_flashcards = data.get('num_flashcards', 10)
 
     if not notes and not original_text:
         return jsonify({"error": "Missing notes or original_text"}), 400
 
-    result = generate_flashcards(notes, original_text, existing_flashcards, num_flashcards)
+    result = generate_flashcards(notes, original_text, existing_flashcards, num_flashcards,
+                                 retrieval_index=get_retrieval_index(context), cached_content=get_context_cache(context, "flashcards"))
     if 'error' in result:
-        return jsonify(result), 500
+        return rate_limited_error_response(result)
     print("Flashcard generation successful.")
     return jsonify(result), 200
 
@@ -1808,15 +5448,18 @@ def generate_flashcards_route():
 def generate_mindmap_route():
     print("Received /api/generate-mindmap request")
     data = request.json
-    notes = data.get('notes')
-    original_text = data.get('original_text')
+    context = load_study_context(data)
+    if 'error' in context:
+        return jsonify({"error": context['error']}), context['status_code']
+    notes = context['notes']
+    original_text = context['original_text']
 
     if not notes and not original_text:
         return jsonify({"error": "Missing notes or original_text"}), 400
 
-    result = generate_mindmap_data(notes, original_text)
+    result = generate_mindmap_data(notes, original_text, cached_content=get_context_cache(context, "mindmap"))
     if 'error' in result:
-        return jsonify(result), 500
+        return rate_limited_error_response(result)
     print("Mind map generation successful.")
     return jsonify(result), 200
 
@@ -1827,23 +5470,78 @@ def generate_mindmap_route():
 def chat_route():
     print("Received /api/chat request")
     data = request.json
-    notes = data.get('notes')
-    original_text = data.get('original_text')
-    history = data.get('history', []) # Expecting list of {"role": ..., "parts": ...}
+    context = load_study_context(data)
+    if 'error' in context:
+        return jsonify({"error": context['error']}), context['status_code']
+    notes = context['notes']
+    original_text = context['original_text']
+    history = data.get('history', context['chat_history']) # Expecting list of {"role": ..., "parts": ...}
     message = data.get('message')
-    web_search_enabled = data.get('web_search_enabled', False) # Get flag from client state
+    web_search_enabled = data.get('web_search_enabled', context['web_search_enabled']) # Get flag from client state
 
     if not message:
         return jsonify({"error": "No message provided"}), 400
     if not notes and not original_text:
         return jsonify({"error": "Missing context (notes or original_text) for chat"}), 400
 
-    result = chat_with_content(notes, original_text, history, message, web_search_enabled)
+    result = chat_with_content(notes, original_text, history, message, web_search_enabled,
+                               retrieval_index=get_retrieval_index(context), cached_content=get_context_cache(context, "chat"))
     if 'error' in result:
-        return jsonify(result), 500
+        return rate_limited_error_response(result)
+    if context['from_store']:
+        study_session_store.update(context['content_id'], chat_history=result['history'])
     print("Chat response generated.")
     return jsonify(result), 200
 
+@app.route('/api/chat/stream', methods=['POST'])
+def chat_stream_route():
+    """
+    Streaming variant of /api/chat using Server-Sent Events.
+    Emits `chunk` events with response tokens as they arrive; the final `complete`
+    event carries the same payload as /api/chat (including appended web source links).
+    """
+    print("Received /api/chat/stream request")
+    data = request.json
+    context = load_study_context(data)
+    if 'error' in context:
+        return jsonify({"error": context['error']}), context['status_code']
+    notes = context['notes']
+    original_text = context['original_text']
+    history = data.get('history', context['chat_history'])
+    message = data.get('message')
+    web_search_enabled = data.get('web_search_enabled', context['web_search_enabled'])
+
+    if not message:
+        return jsonify({"error": "No message provided"}), 400
+    if not notes and not original_text:
+        return jsonify({"error": "Missing context (notes or original_text) for chat"}), 400
+
+    def generate():
+        try:
+            if web_search_enabled:
+                yield sse_event("progress", {"stage": "web_search", "message": "Searching the web..."})
+            chat_request = prepare_chat_request(notes, original_text, history, message, web_search_enabled,
+                                                retrieval_index=get_retrieval_index(context), cached_content=get_context_cache(context, "chat"))
+            response_chunks = []
+            for item in stream_chat(chat_request):
+                if 'error' in item:
+                    yield sse_event("error", with_retry_after(item))
+                    return
+                response_chunks.append(item['text'])
+                yield sse_event("chunk", {"text": item['text']})
+            result = finalize_chat(chat_request, "".join(response_chunks))
+            if context['from_store']:
+                study_session_store.update(context['content_id'], chat_history=result['history'])
+            print("Chat response streamed.")
+            yield sse_event("complete", result)
+        except Exception as e:
+            yield sse_event("error", with_retry_after(chat_generation_error(e)))
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no' # Disable proxy buffering (nginx)
+    return response
+
 
 # --- Subjective Evaluation Route ---
 
@@ -1855,13 +5553,18 @@ def evaluate_answer_route():
     ideal_answer = data.get('ideal_answer')
     user_answer = data.get('user_answer')
     notes_context = data.get('notes_context') # Pass relevant notes snippet
+    if not notes_context and data.get('content_id'):
+        context = load_study_context(data)
+        if 'error' in context:
+            return jsonify({"error": context['error']}), context['status_code']
+        notes_context = context['notes']
 
     if not all([question, ideal_answer, user_answer is not None, notes_context]):
         return jsonify({"error": "Missing required parameters for evaluation"}), 400
 
     result = evaluate_subjective_answer(question, ideal_answer, user_answer, notes_context)
     if 'error' in result:
-        return jsonify(result), 500
+        return rate_limited_error_response(result)
     print("Subjective answer evaluation successful.")
     return jsonify(result), 200
 
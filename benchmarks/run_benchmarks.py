@@ -0,0 +1,311 @@
+"""
+End-to-end benchmarks for the Study Assistant request pipeline.
+
+Each (scenario, concurrency) run starts a fresh app.py server with API_PROVIDER=offline,
+so Gemini, Custom Search, page fetches and YouTube transcripts are answered locally
+from benchmarks/fixtures with simulated latency: no keys or quota are needed and the
+numbers measure the app's own overhead and concurrency limits.
+
+Usage:
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --scenarios chat quiz --concurrency 1 8 --requests-per-client 5
+    python benchmarks/run_benchmarks.py --compare benchmarks/results/bench-20260101-120000.json
+
+Results are written as JSON (see --output) and can be compared run to run with --compare.
+"""
+import argparse
+import datetime
+import json
+import os
+import pathlib
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parent.parent
+FIXTURES_DIR = REPO_ROOT / "benchmarks" / "fixtures"
+RESULTS_DIR = REPO_ROOT / "benchmarks" / "results"
+RESULTS_SCHEMA_VERSION = 1
+
+# URLs are never fetched: the offline provider serves fixtures/pages/<last path segment>.html
+FIXTURE_URLS = ["https://bench.example/biology/photosynthesis", "https://bench.example/biology/cellular-respiration"]
+FIXTURE_VIDEO_URL = "https://www.youtube.com/watch?v=benchLecture1" # fixtures/transcripts/benchLecture1.json
+FIXTURE_FILE = FIXTURES_DIR / "files" / "lecture_notes.txt"
+
+DEFAULT_CONCURRENCY = [1, 8, 32, 128]
+SERVER_START_TIMEOUT_SECONDS = 60
+REQUEST_TIMEOUT_SECONDS = 600
+UNLIMITED_RATE = "100000000" # Lifts the app's upstream rate limits unless --keep-rate-limits is given
+
+# --- Scenarios ---
+def _process_content(session, base_url, urls=(), with_file=False, web_search=False):
+    form = {
+        "urls": json.dumps(list(urls)),
+        "topic": "Energy in cells",
+        "description": "Photosynthesis and cellular respiration",
+        "web_search": "true" if web_search else "false",
+        "generate_quiz": "false",
+        "generate_flashcards": "false",
+        "generate_mindmap": "false",
+    }
+    files = [("files", (FIXTURE_FILE.name, FIXTURE_FILE.read_bytes(), "text/plain"))] if with_file else None
+    return session.post(f"{base_url}/api/process-content", data=form, files=files, timeout=REQUEST_TIMEOUT_SECONDS)
+
+def _study_session(base_url):
+    """Create one study session (notes over the URL fixtures) for the chat/quiz/flashcard scenarios."""
+    response = _process_content(requests.Session(), base_url, urls=FIXTURE_URLS)
+    response.raise_for_status()
+    return {"content_id": response.json()["data"]["content_id"]}
+
+SCENARIOS = {
+    # name: (setup(base_url) -> context or None, request(session, base_url, context) -> Response)
+    "process_urls": (None, lambda s, base, ctx: _process_content(s, base, urls=FIXTURE_URLS)),
+    "process_urls_web_search": (None, lambda s, base, ctx: _process_content(s, base, urls=FIXTURE_URLS, web_search=True)),
+    "process_files": (None, lambda s, base, ctx: _process_content(s, base, with_file=True)),
+    "process_files_web_search": (None, lambda s, base, ctx: _process_content(s, base, with_file=True, web_search=True)),
+    "process_mixed": (None, lambda s, base, ctx: _process_content(s, base, urls=[FIXTURE_URLS[0], FIXTURE_VIDEO_URL], with_file=True)),
+    "process_mixed_web_search": (None, lambda s, base, ctx: _process_content(s, base, urls=[FIXTURE_URLS[0], FIXTURE_VIDEO_URL], with_file=True, web_search=True)),
+    "chat": (_study_session, lambda s, base, ctx: s.post(f"{base}/api/chat", json={
+        "content_id": ctx["content_id"], "message": "How does the Calvin cycle use the products of the light reactions?"},
+        timeout=REQUEST_TIMEOUT_SECONDS)),
+    "quiz": (_study_session, lambda s, base, ctx: s.post(f"{base}/api/generate-quizzes", json={
+        "content_id": ctx["content_id"], "question_types": ["MCQ", "True/False"], "num_questions": 5, "difficulty": "Apply"},
+        timeout=REQUEST_TIMEOUT_SECONDS)),
+    "flashcards": (_study_session, lambda s, base, ctx: s.post(f"{base}/api/generate-flashcards", json={
+        "content_id": ctx["content_id"], "num_flashcards": 10}, timeout=REQUEST_TIMEOUT_SECONDS)),
+}
+
+# --- Server Process ---
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def _server_env(args, data_dir):
+    env = dict(os.environ)
+    env.update({
+        "API_PROVIDER": "offline",
+        "OFFLINE_FIXTURES_DIR": str(FIXTURES_DIR),
+        "OFFLINE_LATENCY_MS": str(args.latency_ms),
+        "OFFLINE_LATENCY_JITTER_MS": str(args.latency_jitter_ms),
+        "OFFLINE_RATE_LIMIT_ERROR_RATE": str(args.rate_limit_error_rate),
+        "OFFLINE_FILE_PROCESSING_SECONDS": str(args.file_processing_seconds),
+        "OFFLINE_SEED": str(args.seed),
+        # Fresh local caches per run, so runs do not warm each other up
+        "EXTRACTION_CACHE_PATH": str(data_dir / "extraction_cache.db"),
+        "SESSION_STORE_PATH": str(data_dir / "study_sessions.db"),
+        "SEARCH_CACHE_PATH": str(data_dir / "search_cache.db"),
+        "PYTHONUNBUFFERED": "1",
+    })
+    if not args.keep_rate_limits:
+        for name in ("GEMINI_REQUESTS_PER_MINUTE", "GEMINI_TOKENS_PER_MINUTE",
+                     "CUSTOM_SEARCH_REQUESTS_PER_DAY", "CUSTOM_SEARCH_REQUESTS_PER_MINUTE"):
+            env[name] = UNLIMITED_RATE
+    return env
+
+def start_server(args, data_dir, log_file):
+    """Start app.py on a free port (threaded Werkzeug server, no reloader); returns (process, base_url)."""
+    port = _free_port()
+    command = [sys.executable, "-c",
+               f"import app; app.app.run(host='127.0.0.1', port={port}, threaded=True, use_reloader=False)"]
+    process = subprocess.Popen(command, cwd=REPO_ROOT, env=_server_env(args, data_dir),
+                               stdout=log_file, stderr=subprocess.STDOUT)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + SERVER_START_TIMEOUT_SECONDS
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited during startup (code {process.returncode}); see {log_file.name}")
+        try:
+            if requests.get(f"{base_url}/", timeout=2).status_code == 200:
+                return process, base_url
+        except requests.exceptions.ConnectionError:
+            pass
+        time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"Server did not start within {SERVER_START_TIMEOUT_SECONDS}s; see {log_file.name}")
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+def read_process_usage(pid):
+    """(cpu_seconds, peak_rss_mb) of a process from /proc; (None, None) where /proc is unavailable."""
+    try:
+        stat_fields = pathlib.Path(f"/proc/{pid}/stat").read_text().rsplit(")", 1)[1].split()
+        cpu_seconds = (int(stat_fields[11]) + int(stat_fields[12])) / os.sysconf("SC_CLK_TCK") # utime + stime
+        peak_rss_kb = next(int(line.split()[1]) for line in pathlib.Path(f"/proc/{pid}/status").read_text().splitlines()
+                           if line.startswith("VmHWM:"))
+        return cpu_seconds, round(peak_rss_kb / 1024, 1)
+    except (OSError, ValueError, IndexError, StopIteration):
+        return None, None
+
+# --- Load Generation ---
+def percentile(sorted_values, fraction):
+    """Linear-interpolated percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    position = (len(sorted_values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+def run_clients(request_fn, base_url, context, concurrency, requests_per_client):
+    """Run `concurrency` clients, each sending requests back to back. Returns (samples, wall_seconds)."""
+    samples = []
+    samples_lock = threading.Lock()
+    start_barrier = threading.Barrier(concurrency)
+
+    def client():
+        session = requests.Session()
+        start_barrier.wait()
+        for _ in range(requests_per_client):
+            started = time.perf_counter()
+            try:
+                status = request_fn(session, base_url, context).status_code
+            except requests.exceptions.RequestException as e:
+                status = type(e).__name__
+            with samples_lock:
+                samples.append((time.perf_counter() - started, status))
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(client) for _ in range(concurrency)]:
+            future.result()
+    return samples, time.perf_counter() - wall_start
+
+def summarize(scenario, concurrency, samples, wall_seconds, cpu_seconds, peak_rss_mb):
+    latencies = sorted(latency * 1000 for latency, _ in samples)
+    statuses = Counter(str(status) for _, status in samples)
+    ok = statuses.get("200", 0)
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": len(samples),
+        "ok": ok,
+        "errors": len(samples) - ok,
+        "status_counts": dict(statuses),
+        "wall_seconds": round(wall_seconds, 3),
+        "throughput_rps": round(ok / wall_seconds, 2) if wall_seconds else None,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50), 1),
+            "p95": round(percentile(latencies, 0.95), 1),
+            "p99": round(percentile(latencies, 0.99), 1),
+            "mean": round(sum(latencies) / len(latencies), 1),
+            "max": round(latencies[-1], 1),
+        },
+        "server": {
+            "peak_rss_mb": peak_rss_mb,
+            "cpu_seconds": round(cpu_seconds, 2) if cpu_seconds is not None else None,
+            "cpu_percent": round(100 * cpu_seconds / wall_seconds, 1) if cpu_seconds is not None and wall_seconds else None,
+        },
+    }
+
+def run_benchmark(args, scenario, concurrency, work_dir):
+    setup, request_fn = SCENARIOS[scenario]
+    data_dir = pathlib.Path(tempfile.mkdtemp(prefix=f"{scenario}-c{concurrency}-", dir=work_dir))
+    with open(data_dir / "server.log", "w") as log_file:
+        process, base_url = start_server(args, data_dir, log_file)
+        try:
+            context = setup(base_url) if setup else None
+            session = requests.Session()
+            for _ in range(args.warmup):
+                request_fn(session, base_url, context)
+            cpu_before, _ = read_process_usage(process.pid)
+            samples, wall_seconds = run_clients(request_fn, base_url, context, concurrency, args.requests_per_client)
+            cpu_after, peak_rss_mb = read_process_usage(process.pid)
+        finally:
+            stop_server(process)
+    cpu_seconds = cpu_after - cpu_before if cpu_before is not None and cpu_after is not None else None
+    return summarize(scenario, concurrency, samples, wall_seconds, cpu_seconds, peak_rss_mb)
+
+# --- Reporting ---
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_result(result):
+    latency, server = result["latency_ms"], result["server"]
+    print(f"{result['scenario']:<26} c={result['concurrency']:<4} n={result['requests']:<5} errors={result['errors']:<4} "
+          f"p50={latency['p50']:>8.1f}ms p95={latency['p95']:>8.1f}ms p99={latency['p99']:>8.1f}ms "
+          f"{result['throughput_rps']:>7.2f} req/s  rss={server['peak_rss_mb']}MB cpu={server['cpu_percent']}%")
+
+def compare_results(baseline_path, results, threshold_percent):
+    """Print p95 latency / throughput changes against a previous results file; returns the number of regressions."""
+    baseline = {(r["scenario"], r["concurrency"]): r for r in json.loads(pathlib.Path(baseline_path).read_text())["results"]}
+    regressions = 0
+    print(f"\nCompared with {baseline_path} (regression threshold {threshold_percent}%):")
+    for result in results:
+        previous = baseline.get((result["scenario"], result["concurrency"]))
+        if not previous:
+            continue
+        p95_change = 100 * (result["latency_ms"]["p95"] - previous["latency_ms"]["p95"]) / previous["latency_ms"]["p95"]
+        throughput_change = 100 * (result["throughput_rps"] - previous["throughput_rps"]) / previous["throughput_rps"] if previous["throughput_rps"] else 0.0
+        regressed = p95_change > threshold_percent or throughput_change < -threshold_percent
+        regressions += regressed
+        print(f"{'REGRESSION ' if regressed else ''}{result['scenario']} c={result['concurrency']}: "
+              f"p95 {p95_change:+.1f}%, throughput {throughput_change:+.1f}%")
+    return regressions
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Study Assistant request pipeline against the offline provider.")
+    parser.add_argument("--scenarios", nargs="+", choices=sorted(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--concurrency", nargs="+", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--requests-per-client", type=int, default=3)
+    parser.add_argument("--warmup", type=int, default=2, help="Unmeasured sequential requests before each run")
+    parser.add_argument("--latency-ms", type=float, default=300, help="Simulated mean upstream latency")
+    parser.add_argument("--latency-jitter-ms", type=float, default=100.0)
+    parser.add_argument("--rate-limit-error-rate", type=float, default=0.0, help="Fraction of upstream calls answered with a 429")
+    parser.add_argument("--file-processing-seconds", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keep-rate-limits", action="store_true", help="Keep the app's configured upstream rate limits")
+    parser.add_argument("--output", help="Results JSON path (default: benchmarks/results/bench-<timestamp>.json)")
+    parser.add_argument("--compare", help="Previous results JSON to compare against")
+    parser.add_argument("--regression-threshold", type=float, default=10.0, help="Percent change in p95 or throughput counted as a regression")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    started_at = datetime.datetime.now()
+    output_path = pathlib.Path(args.output) if args.output else RESULTS_DIR / f"bench-{started_at:%Y%m%d-%H%M%S}.json"
+    results = []
+    with tempfile.TemporaryDirectory(prefix="study-assistant-bench-") as work_dir:
+        for scenario in args.scenarios:
+            for concurrency in args.concurrency:
+                result = run_benchmark(args, scenario, concurrency, work_dir)
+                print_result(result)
+                results.append(result)
+
+    report = {
+        "schema_version": RESULTS_SCHEMA_VERSION,
+        "started_at": started_at.isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "settings": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "results": results,
+    }
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    output_path.write_text(json.dumps(report, indent=2))
+    print(f"\nWrote {output_path}")
+
+    if args.compare and compare_results(args.compare, results, args.regression_threshold):
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,15 @@
 document.addEventListener('DOMContentLoaded', () => {
+    // Minimum interval between incremental re-renders of streamed notes and chat replies
+    const NOTES_STREAM_RENDER_INTERVAL_MS = 150;
+    const MAX_RATE_LIMIT_RETRY_DELAY_MS = 30000; // Longest Retry-After wait before giving up on a 429
+
     // --- State Variables ---
     let appState = {
         currentView: 'input-view',
         isLoading: false,
         loadingMessage: '',
         contentId: null, // Temporary ID for the current processing session
+        sessionStored: false, // Server keeps notes/original text for contentId, so follow-up requests send only the ID
         notes: '',
         originalText: '',
         title: '',
@@ -453,6 +458,7 @@ document.addEventListener('DOMContentLoaded', () => {
     function resetAppStateForNewContent() {
         console.log("Resetting app state for new content");
         appState.contentId = null;
+        appState.sessionStored = false;
         appState.notes = '';
         appState.originalText = '';
         appState.title = '';
@@ -547,7 +553,10 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     // IMPROVED: Process Markdown and render MathJax/Mermaid with better error handling and retries
-    function renderFormattedContent(element, text) {
+    // Pass { streaming: true } for intermediate renders of partially received text:
+    // MathJax and mermaid are skipped (half-received blocks would only produce errors)
+    // and run once on the final, complete render.
+    function renderFormattedContent(element, text, options = {}) {
         if (!text) {
             element.innerHTML = '';
             return;
@@ -615,7 +624,7 @@ document.addEventListener('DOMContentLoaded', () => {
             element.innerHTML = html;
 
             // 6. Process MathJax with retry mechanism
-            if (window.MathJax && (html.includes('$') || html.includes('\\(') || html.includes('\\['))) {
+            if (!options.streaming && window.MathJax && (html.includes('$') || html.includes('\\(') || html.includes('\\['))) {
                 try {
                     MathJax.Hub.Queue(["Typeset", MathJax.Hub, element]);
 
@@ -646,7 +655,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
             // 7. Process Mermaid Placeholders using mermaid.run()
             const mermaidPlaceholders = element.querySelectorAll('.mermaid-placeholder');
-            if (mermaidPlaceholders.length > 0 && window.mermaid) {
+            if (!options.streaming && mermaidPlaceholders.length > 0 && window.mermaid) {
                 mermaidPlaceholders.forEach(placeholderPre => {
                      const index = parseInt(placeholderPre.dataset.mermaidIndex);
                      const mermaidSyntax = mermaidBlocks[index];
@@ -1061,6 +1070,15 @@ document.addEventListener('DOMContentLoaded', () => {
                 data = responseTextForError; // Store text as data for non-JSON
             }
 
+            // Rate limited: wait as long as the server asks (capped) and retry
+            if (response.status === 429 && retries > 0) {
+                const retryAfterSeconds = parseFloat(response.headers.get('Retry-After')) || 5;
+                const retryDelay = Math.min(retryAfterSeconds * 1000, MAX_RATE_LIMIT_RETRY_DELAY_MS);
+                console.warn(`Rate limited on ${endpoint}, retrying in ${retryDelay / 1000}s... (${retries} attempts left)`);
+                await new Promise(resolve => setTimeout(resolve, retryDelay));
+                return apiCall(endpoint, options, retries - 1);
+            }
+
             if (!response.ok) {
                 // Try to extract error from JSON data, otherwise use text
                 const errorMessage = (typeof data === 'object' && data && data.error)
@@ -1107,6 +1125,174 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    // POSTs to a Server-Sent Events endpoint and dispatches each event to onEvent(eventName, data).
+    // Resolves with the data of the final `complete` event; rejects on an `error` event.
+    // Only rate-limit errors (a 429, or an `error` event carrying retry_after) are retried, and only
+    // before any output was shown; other failures are not, as the request may carry large uploads.
+    async function streamApiCall(endpoint, options = {}, onEvent = () => {}, timeoutDuration = 300000, retries = 3) {
+        const controller = new AbortController();
+        const timeoutId = setTimeout(() => controller.abort(), timeoutDuration);
+        let outputShown = false;
+
+        try {
+            const response = await fetch(endpoint, {
+                ...options,
+                headers: { 'Accept': 'text/event-stream', ...options.headers },
+                signal: controller.signal
+            });
+
+            const contentType = response.headers.get("content-type") || '';
+            if (!response.ok || !contentType.includes("text/event-stream")) {
+                // Validation errors are returned as plain JSON before the stream starts
+                const responseText = await response.text();
+                let data = null;
+                try { data = JSON.parse(responseText); } catch (e) { /* not JSON */ }
+                const errorMessage = (data && data.error) ? data.error : `HTTP error ${response.status}: ${response.statusText}`;
+                const errorDetails = (data && data.details) ? data.details.join(', ') : '';
+                const error = new Error(`${errorMessage}${errorDetails ? ' - Details: ' + errorDetails : ''}`);
+                if (response.status === 429) {
+                    error.retryAfter = parseFloat(response.headers.get('Retry-After')) || 5;
+                }
+                throw error;
+            }
+
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            let completeData = null;
+
+            const dispatch = (rawEvent) => {
+                let eventName = 'message';
+                const dataLines = [];
+                rawEvent.split('\n').forEach(line => {
+                    if (line.startsWith('event:')) {
+                        eventName = line.slice(6).trim();
+                    } else if (line.startsWith('data:')) {
+                        dataLines.push(line.slice(5).replace(/^ /, ''));
+                    }
+                });
+                if (dataLines.length === 0) return;
+                const data = JSON.parse(dataLines.join('\n'));
+                if (eventName === 'error') {
+                    const errorDetails = data.details ? data.details.join(', ') : '';
+                    const error = new Error(`${data.error}${errorDetails ? ' - Details: ' + errorDetails : ''}`);
+                    error.retryAfter = data.retry_after;
+                    throw error;
+                }
+                if (eventName === 'complete') {
+                    completeData = data;
+                } else if (eventName !== 'progress') {
+                    outputShown = true; // A chunk of the reply or notes reached the page
+                }
+                onEvent(eventName, data);
+            };
+
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true }).replace(/\r\n/g, '\n');
+                let boundary;
+                while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                    const rawEvent = buffer.slice(0, boundary);
+                    buffer = buffer.slice(boundary + 2);
+                    dispatch(rawEvent);
+                }
+            }
+            if (buffer.trim()) dispatch(buffer);
+
+            if (!completeData) {
+                throw new Error(`Stream from ${endpoint} ended before completion. Check server logs.`);
+            }
+            return completeData;
+
+        } catch (error) {
+            if (error.name === 'AbortError') {
+                console.error(`Request timeout for ${endpoint}`);
+                throw new Error(`Request to ${endpoint} timed out after ${timeoutDuration / 1000} seconds. The server might be busy or the task is too complex. Please try again.`);
+            }
+            // Rate limited: wait as long as the server asks (capped) and retry, unless output is already on screen
+            if (error.retryAfter && !outputShown && retries > 0) {
+                clearTimeout(timeoutId);
+                const retryDelay = Math.min(error.retryAfter * 1000, MAX_RATE_LIMIT_RETRY_DELAY_MS);
+                console.warn(`Rate limited on ${endpoint}, retrying in ${retryDelay / 1000}s... (${retries} attempts left)`);
+                await new Promise(resolve => setTimeout(resolve, retryDelay));
+                return streamApiCall(endpoint, options, onEvent, timeoutDuration, retries - 1);
+            }
+            console.error(`Network or API stream error (${endpoint}):`, error);
+            throw error;
+        } finally {
+            clearTimeout(timeoutId);
+        }
+    }
+
+    // Submits a background job, then follows its Server-Sent Events with EventSource. The server ends each
+    // events request after a short window; EventSource reconnects on its own and resumes from Last-Event-ID
+    // (the same happens if a proxy drops the connection). Dispatches each event to
+    // onEvent(eventName, data) and resolves with the data of the final `complete` event. A job that fails
+    // on a rate limit (its `error` event carries retry_after) is resubmitted after that delay (capped),
+    // as long as none of its notes were shown yet.
+    // Returns null if the server has background jobs disabled, so the caller can fall back to streaming.
+    async function jobApiCall(endpoint, options = {}, onEvent = () => {}, retries = 3) {
+        const response = await fetch(endpoint, { ...options, headers: { 'Accept': 'application/json', ...options.headers } });
+        const responseText = await response.text();
+        let data = null;
+        try { data = JSON.parse(responseText); } catch (e) { /* not JSON */ }
+        if (response.status === 503) return null;
+        if (!response.ok || !data || !data.events_url) {
+            const errorMessage = (data && data.error) ? data.error : `HTTP error ${response.status}: ${response.statusText}`;
+            const errorDetails = (data && data.details) ? data.details.join(', ') : '';
+            throw new Error(`${errorMessage}${errorDetails ? ' - Details: ' + errorDetails : ''}`);
+        }
+        console.log(`Queued job ${data.job_id}`);
+
+        return new Promise((resolve, reject) => {
+            const events = new EventSource(data.events_url);
+            let outputShown = false;
+            const fail = (eventData) => {
+                events.close();
+                const errorDetails = eventData.details ? eventData.details.join(', ') : '';
+                reject(new Error(`${eventData.error}${errorDetails ? ' - Details: ' + errorDetails : ''}`));
+            };
+            const handle = (eventName) => (event) => {
+                try {
+                    const eventData = JSON.parse(event.data);
+                    if (eventName === 'complete') {
+                        events.close();
+                        onEvent(eventName, eventData);
+                        resolve(eventData);
+                    } else {
+                        if (eventName !== 'progress') outputShown = true;
+                        onEvent(eventName, eventData);
+                    }
+                } catch (error) {
+                    events.close();
+                    reject(error);
+                }
+            };
+            events.addEventListener('progress', handle('progress'));
+            events.addEventListener('notes_chunk', handle('notes_chunk'));
+            events.addEventListener('complete', handle('complete'));
+            events.addEventListener('cancelled', (event) => fail(JSON.parse(event.data)));
+            events.addEventListener('error', (event) => {
+                if (event.data) {
+                    const eventData = JSON.parse(event.data); // Job failed (server-sent `error` event)
+                    if (eventData.retry_after && !outputShown && retries > 0) {
+                        events.close();
+                        const retryDelay = Math.min(eventData.retry_after * 1000, MAX_RATE_LIMIT_RETRY_DELAY_MS);
+                        console.warn(`Job ${data.job_id} was rate limited, resubmitting in ${retryDelay / 1000}s... (${retries} attempts left)`);
+                        setTimeout(() => resolve(jobApiCall(endpoint, options, onEvent, retries - 1)), retryDelay);
+                    } else {
+                        fail(eventData);
+                    }
+                } else if (events.readyState === EventSource.CLOSED) {
+                    fail({ error: `Lost the connection to job ${data.job_id}. Check server logs.` });
+                } else {
+                    console.log(`Job ${data.job_id} event stream closed; reconnecting...`);
+                }
+            });
+        });
+    }
+
     // Utility function for debouncing API calls
     function debounce(func, wait) {
         let timeout;
@@ -1117,6 +1303,15 @@ document.addEventListener('DOMContentLoaded', () => {
         };
     }
 
+    // Study material for follow-up requests: just the session ID when the server stored the session,
+    // otherwise the full notes and original text
+    function studyContextPayload() {
+        if (appState.sessionStored) {
+            return { content_id: appState.contentId };
+        }
+        return { content_id: appState.contentId, notes: appState.notes, original_text: appState.originalText };
+    }
+
     // --- Event Handlers ---
     async function handleProcessContent() {
         const urls = urlsInput.value.trim().split('\n').map(u => u.trim()).filter(u => u);
@@ -1162,114 +1357,148 @@ document.addEventListener('DOMContentLoaded', () => {
         let processingErrors = []; // Local array to collect errors during this run
 
         try {
-            console.log("Sending API request to /api/process-content");
+            console.log("Submitting job to /api/process-content/jobs");
             const startTime = performance.now();
 
-            const result = await apiCall('/api/process-content', {
-                method: 'POST',
-                body: formData,
-            });
+            // Render notes incrementally as chunks arrive, throttled so long notes don't re-parse on every chunk
+            let streamedNotes = '';
+            let lastNotesRender = 0;
+            let notesRenderTimer = null;
+            const renderStreamedNotes = () => {
+                notesRenderTimer = null;
+                lastNotesRender = performance.now();
+                renderFormattedContent(notesContent, streamedNotes, { streaming: true });
+            };
+
+            const onProcessEvent = (eventName, data) => {
+                if (eventName === 'progress') {
+                    console.log("Processing progress:", data.stage);
+                    setLoading(true, data.message || 'Processing...');
+                } else if (eventName === 'notes_chunk') {
+                    if (!streamedNotes) {
+                        resetAppStateForNewContent(); // Clear previous content before showing the new notes
+                        switchView('notes-view');
+                    }
+                    streamedNotes += data.text;
+                    if (!notesRenderTimer) {
+                        const wait = Math.max(0, NOTES_STREAM_RENDER_INTERVAL_MS - (performance.now() - lastNotesRender));
+                        notesRenderTimer = setTimeout(renderStreamedNotes, wait);
+                    }
+                }
+            };
+            // Background job (frees the server's request thread); streaming request if jobs are disabled
+            let result = await jobApiCall('/api/process-content/jobs', { method: 'POST', body: formData }, onProcessEvent);
+            if (result === null) {
+                console.log("Background jobs disabled; sending streaming API request to /api/process-content/stream");
+                result = await streamApiCall('/api/process-content/stream', { method: 'POST', body: formData }, onProcessEvent);
+            }
+            clearTimeout(notesRenderTimer);
 
             const responseTime = ((performance.now() - startTime) / 1000).toFixed(2);
             console.log(`API response received and processed in ${responseTime} seconds`);
 
+            applyProcessContentResult(result, processingErrors);
 
-            if (!result || !result.data) {
-                console.error("Missing data in response:", result);
-                throw new Error("Server returned an invalid response structure");
-            }
-
-            // Store warnings from the main processing stage
-            if (result.warnings && Array.isArray(result.warnings)) {
-                processingErrors.push(...result.warnings.map(w => `Warning: ${w}`)); // Prefix warnings
-            }
+        } catch (error) {
+            console.error("Error processing content:", error);
+            // Display the main error from streamApiCall
+            displayProcessingFeedback(null, [error.message]);
+            setFeatureAvailability(false); // Features require content
+        } finally {
+            setLoading(false);
+        }
+    }
 
-            console.log("Processing successful (main content):", result.data.content_id);
-            resetAppStateForNewContent(); // Clear previous state first
+    // Store and display a completed /api/process-content result (notes plus any initial quiz/flashcards/mind map)
+    function applyProcessContentResult(result, processingErrors) {
+        if (!result || !result.data) {
+            console.error("Missing data in response:", result);
+            throw new Error("Server returned an invalid response structure");
+        }
 
-            // Store core data
-            appState.contentId = result.data.content_id;
-            appState.notes = result.data.notes || '';
-            appState.originalText = result.data.original_text || '';
-            appState.title = result.data.title || 'Study Notes';
-            appState.webSearchEnabled = result.data.web_search_enabled;
+        // Store warnings from the main processing stage
+        if (result.warnings && Array.isArray(result.warnings)) {
+            processingErrors.push(...result.warnings.map(w => `Warning: ${w}`)); // Prefix warnings
+        }
 
-            // Update UI immediately with core info
-            notesTitle.textContent = appState.title;
+        console.log("Processing successful (main content):", result.data.content_id);
+        resetAppStateForNewContent(); // Clear previous state first
 
-            console.log("Rendering notes content");
-            if (appState.notes) {
-                renderFormattedContent(notesContent, appState.notes);
-                console.log("Notes rendered successfully");
-            } else {
-                console.warn("No notes content received from the server");
-                notesContent.innerHTML = '<p class="text-yellow-500">No notes content was generated. Please try again or check the server logs.</p>';
-                processingErrors.push("Notes Generation: No notes content was generated.");
-            }
-
-            // Handle initial quiz data (REPLACE logic)
-            if (result.data.initial_quiz) {
-                 if (result.data.initial_quiz.status === 'success' && result.data.initial_quiz.questions) {
-                     appState.quizzes = [result.data.initial_quiz]; // *** REPLACE ***
-                     console.log("Initial quiz loaded with", result.data.initial_quiz.questions.length, "questions");
-                     displayQuiz(); // Display immediately if generated
-                 } else if (result.data.initial_quiz.error) {
-                     console.warn("Error generating initial quiz:", result.data.initial_quiz.error);
-                     processingErrors.push(`Initial Quiz Generation: ${result.data.initial_quiz.error}`);
-                     quizContent.innerHTML = `<p class="text-yellow-500 italic text-center py-10">Could not generate initial quiz: ${escapeHtml(result.data.initial_quiz.error)}</p>`;
-                 } else {
-                      console.warn("Initial quiz data is invalid.");
-                      processingErrors.push("Initial Quiz Generation: Received invalid data structure.");
-                 }
-            }
+        // Store core data
+        appState.contentId = result.data.content_id;
+        appState.sessionStored = !!result.data.session_stored;
+        appState.notes = result.data.notes || '';
+        appState.originalText = result.data.original_text || '';
+        appState.title = result.data.title || 'Study Notes';
+        appState.webSearchEnabled = result.data.web_search_enabled;
 
-            // Handle initial flashcards (REPLACE logic)
-            if (result.data.initial_flashcards) {
-                 if (result.data.initial_flashcards.status === 'success' && result.data.initial_flashcards.flashcards) {
-                    appState.flashcards = [result.data.initial_flashcards]; // *** REPLACE ***
-                    appState.currentFlashcardSetIndex = 0;
-                    appState.currentFlashcardIndex = 0; // Reset index for the new set
-                    console.log("Initial flashcards loaded with", result.data.initial_flashcards.flashcards.length, "cards");
-                    displayFlashcards(); // Display immediately
-                 } else if (result.data.initial_flashcards.error) {
-                     console.warn("Error generating initial flashcards:", result.data.initial_flashcards.error);
-                     processingErrors.push(`Initial Flashcard Generation: ${result.data.initial_flashcards.error}`);
-                 } else {
-                     console.warn("Initial flashcard data is invalid.");
-                     processingErrors.push("Initial Flashcard Generation: Received invalid data structure.");
-                 }
-            }
+        // Update UI immediately with core info
+        notesTitle.textContent = appState.title;
 
+        console.log("Rendering notes content");
+        if (appState.notes) {
+            renderFormattedContent(notesContent, appState.notes);
+            console.log("Notes rendered successfully");
+        } else {
+            console.warn("No notes content received from the server");
+            notesContent.innerHTML = '<p class="text-yellow-500">No notes content was generated. Please try again or check the server logs.</p>';
+            processingErrors.push("Notes Generation: No notes content was generated.");
+        }
 
-            // Handle initial mindmap
-            if (result.data.initial_mindmap) {
-                 if (result.data.initial_mindmap.status === 'success' && result.data.initial_mindmap.mindmap_syntax) {
-                    appState.mindMapSyntax = result.data.initial_mindmap.mindmap_syntax;
-                    console.log("Initial mind map loaded with", appState.mindMapSyntax.length, "characters of syntax");
-                    // Rendering happens when switching to the view
-                 } else if (result.data.initial_mindmap.error) {
-                     console.warn("Error generating initial mind map:", result.data.initial_mindmap.error);
-                     processingErrors.push(`Initial Mind Map Generation: ${result.data.initial_mindmap.error}`);
-                 } else {
-                     console.warn("Initial mind map data is invalid.");
-                     processingErrors.push("Initial Mind Map Generation: Received invalid data structure.");
-                 }
-            }
+        // Handle initial quiz data (REPLACE logic)
+        if (result.data.initial_quiz) {
+             if (result.data.initial_quiz.status === 'success' && result.data.initial_quiz.questions) {
+                 appState.quizzes = [result.data.initial_quiz]; // *** REPLACE ***
+                 console.log("Initial quiz loaded with", result.data.initial_quiz.questions.length, "questions");
+                 displayQuiz(); // Display immediately if generated
+             } else if (result.data.initial_quiz.error) {
+                 console.warn("Error generating initial quiz:", result.data.initial_quiz.error);
+                 processingErrors.push(`Initial Quiz Generation: ${result.data.initial_quiz.error}`);
+                 quizContent.innerHTML = `<p class="text-yellow-500 italic text-center py-10">Could not generate initial quiz: ${escapeHtml(result.data.initial_quiz.error)}</p>`;
+             } else {
+                  console.warn("Initial quiz data is invalid.");
+                  processingErrors.push("Initial Quiz Generation: Received invalid data structure.");
+             }
+        }
 
-            // Display collected warnings/errors
-            displayProcessingFeedback(processingErrors, null); // Pass all collected issues as warnings
+        // Handle initial flashcards (REPLACE logic)
+        if (result.data.initial_flashcards) {
+             if (result.data.initial_flashcards.status === 'success' && result.data.initial_flashcards.flashcards) {
+                appState.flashcards = [result.data.initial_flashcards]; // *** REPLACE ***
+                appState.currentFlashcardSetIndex = 0;
+                appState.currentFlashcardIndex = 0; // Reset index for the new set
+                console.log("Initial flashcards loaded with", result.data.initial_flashcards.flashcards.length, "cards");
+                displayFlashcards(); // Display immediately
+             } else if (result.data.initial_flashcards.error) {
+                 console.warn("Error generating initial flashcards:", result.data.initial_flashcards.error);
+                 processingErrors.push(`Initial Flashcard Generation: ${result.data.initial_flashcards.error}`);
+             } else {
+                 console.warn("Initial flashcard data is invalid.");
+                 processingErrors.push("Initial Flashcard Generation: Received invalid data structure.");
+             }
+        }
 
-            // Switch to notes view after successful processing
-            switchView('notes-view');
 
-        } catch (error) {
-            console.error("Error processing content:", error);
-            // Display the main error from apiCall
-            displayProcessingFeedback(null, [error.message]);
-            setFeatureAvailability(false); // Features require content
-        } finally {
-            setLoading(false);
+        // Handle initial mindmap
+        if (result.data.initial_mindmap) {
+             if (result.data.initial_mindmap.status === 'success' && result.data.initial_mindmap.mindmap_syntax) {
+                appState.mindMapSyntax = result.data.initial_mindmap.mindmap_syntax;
+                console.log("Initial mind map loaded with", appState.mindMapSyntax.length, "characters of syntax");
+                // Rendering happens when switching to the view
+             } else if (result.data.initial_mindmap.error) {
+                 console.warn("Error generating initial mind map:", result.data.initial_mindmap.error);
+                 processingErrors.push(`Initial Mind Map Generation: ${result.data.initial_mindmap.error}`);
+             } else {
+                 console.warn("Initial mind map data is invalid.");
+                 processingErrors.push("Initial Mind Map Generation: Received invalid data structure.");
+             }
         }
+
+        // Display collected warnings/errors
+        displayProcessingFeedback(processingErrors, null); // Pass all collected issues as warnings
+
+        // Switch to notes view after successful processing
+        switchView('notes-view');
     }
 
 
@@ -1362,8 +1591,7 @@ document.addEventListener('DOMContentLoaded', () => {
             const response = await apiCall('/api/generate-quizzes', {
                 method: 'POST',
                 body: JSON.stringify({
-                    notes: appState.notes,
-                    original_text: appState.originalText,
+                    ...studyContextPayload(),
                     existing_questions: '[]', // Send empty list for replacement logic
                     question_types: selectedTypes,
                     num_questions: numQuestions,
@@ -1789,7 +2017,9 @@ document.addEventListener('DOMContentLoaded', () => {
                                     question: q.question,
                                     ideal_answer: q.correct_answer,
                                     user_answer: userAnswer,
-                                    notes_context: appState.notes // Send relevant notes
+                                    ...(appState.sessionStored
+                                        ? { content_id: appState.contentId } // Server looks up the notes
+                                        : { notes_context: appState.notes }) // Send relevant notes
                                 })
                             }).then(evalResult => {
                                 if (evalResult.status === 'success') {
@@ -1920,8 +2150,7 @@ document.addEventListener('DOMContentLoaded', () => {
             const response = await apiCall('/api/generate-flashcards', {
                 method: 'POST',
                 body: JSON.stringify({
-                    notes: appState.notes,
-                    original_text: appState.originalText,
+                    ...studyContextPayload(),
                     existing_flashcards: '[]', // Send empty list for replacement logic
                     num_flashcards: 10 // Or get from UI if you add an input
                 })
@@ -2052,8 +2281,7 @@ document.addEventListener('DOMContentLoaded', () => {
             const response = await apiCall('/api/generate-mindmap', {
                 method: 'POST',
                 body: JSON.stringify({
-                    notes: appState.notes,
-                    original_text: appState.originalText
+                    ...studyContextPayload()
                 })
             });
     
@@ -2657,22 +2885,53 @@ document.addEventListener('DOMContentLoaded', () => {
         appState.chatHistory.push({ role: 'user', parts: [currentMessage] });
 
         try {
+            // Stream the reply: the assistant bubble is created on the first token and re-rendered as tokens arrive
+            let streamedText = '';
+            let assistantBubble = null;
+            let lastRender = 0;
+            let renderTimer = null;
+            const renderStreamedReply = () => {
+                renderTimer = null;
+                lastRender = performance.now();
+                renderFormattedContent(assistantBubble, streamedText, { streaming: true });
+                chatHistoryDiv.scrollTop = chatHistoryDiv.scrollHeight;
+            };
+
             // Send recent history + new message
-            const response = await apiCall('/api/chat', {
+            const response = await streamApiCall('/api/chat/stream', {
                 method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
                 body: JSON.stringify({
-                    notes: appState.notes,
-                    original_text: appState.originalText,
-                    // Send only the last few turns to keep payload reasonable
-                    history: appState.chatHistory.slice(-10),
+                    ...studyContextPayload(),
+                    // Stored sessions keep their chat history server-side; otherwise send only the last few turns
+                    ...(appState.sessionStored ? {} : { history: appState.chatHistory.slice(-10) }),
                     message: currentMessage,
                     web_search_enabled: appState.webSearchEnabled
                 })
-            });
+            }, (eventName, data) => {
+                if (eventName === 'progress') {
+                    setLoading(true, data.message || 'Getting response...');
+                } else if (eventName === 'chunk') {
+                    streamedText += data.text;
+                    if (!assistantBubble) {
+                        assistantBubble = appendChatMessage('assistant', streamedText, { streaming: true });
+                        lastRender = performance.now();
+                    } else if (!renderTimer) {
+                        const wait = Math.max(0, NOTES_STREAM_RENDER_INTERVAL_MS - (performance.now() - lastRender));
+                        renderTimer = setTimeout(renderStreamedReply, wait);
+                    }
+                }
+            }, 60000);
+            clearTimeout(renderTimer);
 
             if (response.status === "success" && response.response) {
-                // Add assistant response to UI
-                appendChatMessage('assistant', response.response);
+                // Final render of the complete reply (includes appended web source links, MathJax and mermaid)
+                if (assistantBubble) {
+                    renderFormattedContent(assistantBubble, response.response);
+                    chatHistoryDiv.scrollTop = chatHistoryDiv.scrollHeight;
+                } else {
+                    appendChatMessage('assistant', response.response);
+                }
                 // Update state history with the returned history (which includes the latest exchange)
                 // Ensure the returned history is valid before updating
                 if (Array.isArray(response.history)) {
@@ -2699,7 +2958,8 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
 
-    function appendChatMessage(role, text) {
+    // Returns the message bubble element so streamed replies can be re-rendered in place.
+    function appendChatMessage(role, text, options = {}) {
         // Clear initial placeholder if present
         if (chatHistoryDiv.querySelector('.text-center')) {
             chatHistoryDiv.innerHTML = '';
@@ -2718,7 +2978,7 @@ document.addEventListener('DOMContentLoaded', () => {
         } else if (role === 'assistant') {
             messageContainer.className = 'mb-4 flex justify-start';
             // Assistant messages can contain Markdown/LaTeX/Mermaid, use renderFormattedContent
-            renderFormattedContent(messageDiv, text);
+            renderFormattedContent(messageDiv, text, options);
         } else { // Error
             messageContainer.className = 'mb-4 flex justify-center';
             messageDiv.innerHTML = `
@@ -2735,6 +2995,7 @@ document.addEventListener('DOMContentLoaded', () => {
         setTimeout(() => {
              chatHistoryDiv.scrollTop = chatHistoryDiv.scrollHeight;
         }, 50);
+        return messageDiv;
     }
 
 